@@ -0,0 +1,138 @@
+#!/usr/bin/env python2
+"""
+NAME: assemblysummary.py
+=========
+
+DESCRIPTION
+===========
+Shared parser for NCBI assembly_summary.txt files.
+
+Only the columns the scripts need are kept, stored column-wise (one list per
+column) with the highly repetitive strings (version_status, assembly_level,
+seq_rel_date) interned. The parsed columns are cached next to the file
+(assembly_summary.txt.cache) with marshal and reused as long as the size and
+mtime of the file are unchanged.
+
+VERSION HISTORY
+===============
+
+0.0.1   2026/10/18    Initial version.
+
+LICENCE
+=======
+2016, copyright Sebastian Schmeier (s.schmeier@gmail.com), sschmeier.com
+
+template version: 1.6 (2016/11/09)
+"""
+import sys
+import os
+import os.path
+import marshal
+
+try:
+    intern = sys.intern  # python3
+except AttributeError:
+    pass  # python2 builtin
+
+
+__version__ = '0.0.1'
+__date__ = '2026/10/18'
+__email__ = 's.schmeier@gmail.com'
+__author__ = 'Sebastian Schmeier'
+
+
+# columns kept from assembly_summary.txt
+COLUMNS = [('accession', 0),
+           ('taxid', 5),
+           ('species_taxid', 6),
+           ('organism_name', 7),
+           ('version_status', 10),
+           ('assembly_level', 11),
+           ('seq_rel_date', 14),
+           ('ftp_path', 19)]
+INTERNED = ['version_status', 'assembly_level', 'seq_rel_date']
+CACHE_VERSION = 2
+
+
+def parse(filename):
+    """
+    Parse an assembly_summary.txt file, skipping comment lines and rows with
+    too few columns.
+    return {column: [value, ...]}
+    """
+    columns = dict([(name, []) for name, idx in COLUMNS])
+    min_len = max([idx for name, idx in COLUMNS]) + 1
+    appends = [(columns[name].append, idx, name in INTERNED) for name, idx in COLUMNS]
+    infile = open(filename)
+    for line in infile:
+        if line[:1] == '#':
+            continue
+        a = line.rstrip('\r\n').split('\t')
+        if len(a) < min_len:
+            continue
+        for append, idx, interned in appends:
+            if interned:
+                append(intern(a[idx]))
+            else:
+                append(a[idx])
+    infile.close()
+    return columns
+
+
+class AssemblySummary(object):
+    """
+    Column-wise table of an assembly_summary.txt file. Columns are accessed
+    by name, e.g. summary['ftp_path'][i].
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.columns = self._load()
+
+    def _stamp(self):
+        stat = os.stat(self.filename)
+        return (CACHE_VERSION, stat.st_size, int(stat.st_mtime), sys.version_info[0])
+
+    def _load(self):
+        cachename = self.filename + '.cache'
+        stamp = self._stamp()
+        if os.path.isfile(cachename):
+            infile = open(cachename, 'rb')
+            try:
+                # marshal keeps interned strings interned
+                cached_stamp, columns = marshal.load(infile)
+                if tuple(cached_stamp) == stamp:
+                    return columns
+            except (EOFError, ValueError, TypeError):
+                pass  # unreadable cache: rebuild
+            finally:
+                infile.close()
+
+        columns = parse(self.filename)
+        tmpname = '%s.%i.tmp' % (cachename, os.getpid())
+        try:
+            outfile = open(tmpname, 'wb')
+            marshal.dump((stamp, columns), outfile, 2)
+            outfile.close()
+            os.rename(tmpname, cachename)
+        except (IOError, OSError):
+            sys.stderr.write('Could not write %s.\n' % cachename)
+        return columns
+
+    def __len__(self):
+        return len(self.columns['accession'])
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def latest(self):
+        """ Row indices of the assemblies with version_status 'latest'. """
+        status = self.columns['version_status']
+        return [i for i in range(len(status)) if status[i] == 'latest']
+
+    def level_stats(self):
+        """ Number of 'latest' assemblies per assembly_level. """
+        d = {}
+        levels = self.columns['assembly_level']
+        for i in self.latest():
+            d[levels[i]] = d.get(levels[i], 0) + 1
+        return d
@@ -0,0 +1,442 @@
+#!/usr/bin/env python2
+"""
+NAME: benchmark.py
+=========
+
+DESCRIPTION
+===========
+Benchmarks of the hot paths of the scripts on synthetic RefSeq fixtures, no
+network access needed.
+
+Fixtures (generated once per scale and reused):
+genomes/refseq/bench/assembly_summary.txt  and one gzipped genomic fasta-file
+                                           per assembly
+taxonomy/names.dmp, taxonomy/nodes.dmp     a synthetic taxonomy tree
+kraken.out                                 Kraken result file
+taxids.txt                                 tax-ids to look up
+
+Cases:
+parse_assemblyfile  getKrakenFna.parse_assemblyfile, without parse cache
+convert             getKrakenFna.my_func on all assemblies, on -w processes
+annotate            getTaxNames.py on the Kraken result file, with -p processes
+lookup              findKrakenFnaByTax.py on the tax-ids
+
+Each case runs in a sub-process of its own, so that its peak RSS can be
+measured. A case is repeated and the best time is reported. The results can
+be saved as a baseline and later runs compared against it: a throughput drop
+or RSS growth beyond the tolerance is reported as a REGRESSION and the script
+exits with 1. Timings depend on the machine, so no baseline is shipped: save
+one on the commit to compare against and run the comparison on the same
+machine.
+
+VERSION HISTORY
+===============
+
+0.0.1   2026/10/18    Initial version.
+
+LICENCE
+=======
+2016, copyright Sebastian Schmeier (s.schmeier@gmail.com), sschmeier.com
+
+template version: 1.6 (2016/11/09)
+"""
+from timeit import default_timer as timer
+from multiprocessing import Pool
+import sys
+import os
+import os.path
+import argparse
+import gzip
+import json
+import random
+import subprocess
+# the scripts under test, imported here so that their import time is not
+# measured with the first repeat of a case
+import getKrakenFna
+import getTaxNames
+import findKrakenFnaByTax
+
+
+__version__ = '0.0.1'
+__date__ = '2026/10/18'
+__email__ = 's.schmeier@gmail.com'
+__author__ = 'Sebastian Schmeier'
+
+
+SCALES = {'small': {'genomes': 50, 'genome_size': 20000, 'taxa': 1000, 'reads': 20000},
+          'medium': {'genomes': 200, 'genome_size': 200000, 'taxa': 10000, 'reads': 200000},
+          'large': {'genomes': 500, 'genome_size': 2000000, 'taxa': 100000, 'reads': 2000000}}
+CASES = ['parse_assemblyfile', 'convert', 'annotate', 'lookup']
+PARALLEL_CASES = ['convert', 'annotate']
+RANKS = ['superkingdom', 'phylum', 'class', 'order', 'family', 'genus', 'species']
+BRANCH = 'bench'
+SEED = 42
+
+
+def parse_cmdline():
+    """ Parse command-line args. """
+    description = 'Benchmark the hot paths of the scripts on synthetic RefSeq fixtures.'
+    version = 'version %s, date %s' % (__version__, __date__)
+    epilog = 'Copyright %s (%s)' % (__author__, __email__)
+
+    parser = argparse.ArgumentParser(description=description, epilog=epilog)
+
+    parser.add_argument('--version',
+                        action='version',
+                        version='%s' % (version))
+
+    parser.add_argument('-d',
+        '--dir',
+        dest='str_dir',
+        metavar='DIR',
+        type=str,
+        default='bench_fixtures',
+        help='Directory of the fixtures, one sub-directory per scale. Fixtures are generated if missing. [default: bench_fixtures]')
+
+    parser.add_argument('-s',
+        '--scales',
+        dest='str_scales',
+        metavar='STRING',
+        type=str,
+        default='small',
+        help='Scales to run, separated by comma, out of %s. [default: small]' % ','.join(sorted(SCALES)))
+
+    parser.add_argument('-c',
+        '--cases',
+        dest='str_cases',
+        metavar='STRING',
+        type=str,
+        default=','.join(CASES),
+        help='Cases to run, separated by comma. [default: %s]' % ','.join(CASES))
+
+    parser.add_argument('-w',
+        '--workers',
+        dest='str_workers',
+        metavar='STRING',
+        type=str,
+        default='1,4',
+        help='Worker counts to run the parallel cases (%s) with, separated by comma. [default: 1,4]' % ','.join(PARALLEL_CASES))
+
+    parser.add_argument('-r',
+        '--repeat',
+        dest='repeat',
+        metavar='INT',
+        type=int,
+        default=3,
+        help='Number of runs per case, the best is reported. [default: 3]')
+
+    parser.add_argument('--save',
+        dest='str_save',
+        metavar='FILE',
+        type=str,
+        default=None,
+        help='Save the results as baseline to FILE (JSON). [default: None]')
+
+    parser.add_argument('--baseline',
+        dest='str_baseline',
+        metavar='FILE',
+        type=str,
+        default=None,
+        help='Compare the results against the baseline in FILE. [default: None]')
+
+    parser.add_argument('--tolerance',
+        dest='tolerance',
+        metavar='FLOAT',
+        type=float,
+        default=0.2,
+        help='Allowed relative throughput drop (or peak RSS growth) against the baseline. [default: 0.2]')
+
+    # internal: run one case in this process
+    parser.add_argument('--run-case', dest='run_case', default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--run-scale', dest='run_scale', default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--run-workers', dest='run_workers', type=int, default=1, help=argparse.SUPPRESS)
+
+    args = parser.parse_args()
+    return args, parser
+
+
+#-----------------------------------------------------------------------------
+# FIXTURES
+#-----------------------------------------------------------------------------
+def make_taxonomy(dirname, num_taxa, rnd):
+    """
+    Write names.dmp and nodes.dmp of a tree with num_taxa nodes below the
+    root, spread over RANKS.
+    return list of the species tax-ids
+    """
+    names = open(os.path.join(dirname, 'names.dmp'), 'w')
+    nodes = open(os.path.join(dirname, 'nodes.dmp'), 'w')
+    names.write('1\t|\troot\t|\t\t|\tscientific name\t|\n')
+    nodes.write('1\t|\t1\t|\tno rank\t|\t\t|\n')
+    level = [1]
+    taxid = 2
+    per_level = max(1, num_taxa // len(RANKS))
+    for depth, rank in enumerate(RANKS):
+        # levels grow towards the species, as in the real tree
+        count = max(len(level), per_level * (depth + 1) * 2 // len(RANKS))
+        next_level = []
+        for i in range(count):
+            parent = level[i] if i < len(level) else rnd.choice(level)
+            nodes.write('%i\t|\t%i\t|\t%s\t|\t\t|\n' % (taxid, parent, rank))
+            names.write('%i\t|\t%s %i\t|\t\t|\tscientific name\t|\n' % (taxid, rank.capitalize(), taxid))
+            if rnd.random() < 0.3:
+                names.write('%i\t|\tSynonym %i\t|\t\t|\tsynonym\t|\n' % (taxid, taxid))
+            next_level.append(taxid)
+            taxid += 1
+        level = next_level
+    names.close()
+    nodes.close()
+    return level
+
+
+def random_sequence(length, rnd, pool):
+    """ Random DNA of length, cut out of a pre-made random pool. """
+    parts = []
+    while length > 0:
+        start = rnd.randint(0, len(pool) - 1)
+        part = pool[start:start + length]
+        parts.append(part)
+        length -= len(part)
+    return ''.join(parts)
+
+
+def make_genomes(dirname, num_genomes, genome_size, species, rnd):
+    """
+    Write assembly_summary.txt and one gzipped genomic fasta-file (a few
+    records, 80 bases per line) per assembly.
+    """
+    pool = ''.join([rnd.choice('ACGT') for i in range(1 << 16)])
+    summary = open(os.path.join(dirname, 'assembly_summary.txt'), 'w')
+    summary.write('# See ftp://ftp.ncbi.nlm.nih.gov/genomes/README_assembly_summary.txt for a description of the columns in this file.\n')
+    summary.write('# assembly_accession\tbioproject\tbiosample\twgs_master\trefseq_category\ttaxid\tspecies_taxid\torganism_name\tinfraspecific_name\tisolate\tversion_status\tassembly_level\trelease_type\tgenome_rep\tseq_rel_date\tasm_name\tsubmitter\tgbrs_paired_asm\tpaired_asm_comp\tftp_path\texcluded_from_refseq\n')
+    for i in range(num_genomes):
+        accession = 'GCF_%09i.1' % (i + 1)
+        asm_name = 'ASM%iv1' % (i + 1)
+        taxid = rnd.choice(species)
+        ftp_path = 'ftp://ftp.ncbi.nlm.nih.gov/genomes/all/GCF/%03i/%03i/%03i/%s_%s' % \
+                   ((i + 1) // 1000000 % 1000, (i + 1) // 1000 % 1000, (i + 1) % 1000, accession, asm_name)
+        summary.write('\t'.join([accession, 'PRJNA1', 'SAMN1', '', 'na', str(taxid), str(taxid),
+                                 'Species %i strain %i' % (taxid, i), '', '', 'latest',
+                                 'Complete Genome', 'Major', 'Full', '2016/12/01', asm_name,
+                                 'bench', '', 'identical', ftp_path, '']) + '\n')
+
+        outfile = gzip.open(os.path.join(dirname, os.path.basename(ftp_path) + '_genomic.fna.gz'), 'wb', 6)
+        num_records = rnd.randint(1, 3)
+        for r in range(num_records):
+            outfile.write(('>NC_%06i.%i Species %i chromosome %i, complete genome\n' % (i, r + 1, taxid, r + 1)).encode('ascii'))
+            seq = random_sequence(genome_size // num_records, rnd, pool)
+            outfile.write(''.join([seq[j:j + 80] + '\n' for j in range(0, len(seq), 80)]).encode('ascii'))
+        outfile.close()
+    summary.close()
+
+
+def make_kraken_results(filename, num_reads, species, rnd):
+    """ Write a Kraken result file, 20% of the reads unclassified. """
+    outfile = open(filename, 'w')
+    for i in range(num_reads):
+        if rnd.random() < 0.2:
+            outfile.write('U\tread%i\t0\t150\t0:116\n' % i)
+        else:
+            taxid = rnd.choice(species)
+            outfile.write('C\tread%i\t%i\t150\t%i:80 0:36\n' % (i, taxid, taxid))
+    outfile.close()
+
+
+def make_fixtures(dirname, scale):
+    """ Generate the fixtures of a scale into dirname, unless present. """
+    stamp = os.path.join(dirname, 'fixtures.json')
+    if os.path.isfile(stamp) and json.load(open(stamp)) == SCALES[scale]:
+        return
+    sys.stderr.write('Generating %s fixtures in %s\n' % (scale, dirname))
+    rnd = random.Random(SEED)
+    conf = SCALES[scale]
+    genomedir = os.path.join(dirname, 'genomes', 'refseq', BRANCH)
+    taxdir = os.path.join(dirname, 'taxonomy')
+    for d in (genomedir, taxdir):
+        if not os.path.exists(d):
+            os.makedirs(d)
+    species = make_taxonomy(taxdir, conf['taxa'], rnd)
+    make_genomes(genomedir, conf['genomes'], conf['genome_size'], species, rnd)
+    make_kraken_results(os.path.join(dirname, 'kraken.out'), conf['reads'], species, rnd)
+    outfile = open(os.path.join(dirname, 'taxids.txt'), 'w')
+    for taxid in rnd.sample(species, min(len(species), 1000)):
+        outfile.write('%i\n' % taxid)
+    outfile.close()
+    json.dump(conf, open(stamp, 'w'))
+
+
+#-----------------------------------------------------------------------------
+# CASES, each run in a sub-process of its own
+#-----------------------------------------------------------------------------
+def call_main(module, argv):
+    """ Run the main() of a script with argv, its stdout is discarded. """
+    stdout = sys.stdout
+    saved_argv = sys.argv
+    sys.stdout = open(os.devnull, 'w')
+    sys.argv = [module.__name__ + '.py'] + argv
+    try:
+        module.main()
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+        sys.argv = saved_argv
+
+
+def case_parse_assemblyfile(dirname, workers):
+    summary = os.path.join(dirname, 'genomes', 'refseq', BRANCH, 'assembly_summary.txt')
+    if os.path.isfile(summary + '.cache'):
+        os.remove(summary + '.cache')
+    jobs, d, latest = getKrakenFna.parse_assemblyfile(BRANCH, ['Complete Genome'],
+                                                      os.path.join(dirname, 'genomes', 'refseq'),
+                                                      os.path.join(dirname, 'kraken'))
+    return len(latest), os.path.getsize(summary)
+
+
+def case_convert(dirname, workers):
+    jobs, d, latest = getKrakenFna.parse_assemblyfile(BRANCH, ['Complete Genome'],
+                                                      os.path.join(dirname, 'genomes', 'refseq'),
+                                                      os.path.join(dirname, 'kraken'))
+    krakendir = os.path.join(dirname, 'kraken', BRANCH)
+    if not os.path.exists(krakendir):
+        os.makedirs(krakendir)
+    pool = Pool(processes=workers)
+    units = getKrakenFna.make_units(jobs, workers)
+    pool.map(getKrakenFna.my_unit_func, [unit for size, unit in units], chunksize=1)
+    pool.close()
+    pool.join()
+    return len(jobs), sum([size for size, unit in units])
+
+
+def case_annotate(dirname, workers):
+    results = os.path.join(dirname, 'kraken.out')
+    call_main(getTaxNames, ['-p', str(workers), '-o', os.devnull,
+                            os.path.join(dirname, 'taxonomy', 'names.dmp'), results])
+    return SCALES[os.path.basename(dirname)]['reads'], os.path.getsize(results)
+
+
+def case_lookup(dirname, workers):
+    taxids = os.path.join(dirname, 'taxids.txt')
+    summary = os.path.join(dirname, 'genomes', 'refseq', BRANCH, 'assembly_summary.txt')
+    call_main(findKrakenFnaByTax, [summary, taxids])
+    return len(open(taxids).readlines()), os.path.getsize(summary)
+
+
+def run_case(case, dirname, workers, repeat):
+    """
+    Run a case repeat times in this process.
+    return {seconds (best run), items, bytes}
+    """
+    func = globals()['case_' + case]
+    best = None
+    for i in range(repeat):
+        start = timer()
+        items, num_bytes = func(dirname, workers)
+        seconds = timer() - start
+        if best is None or seconds < best:
+            best = seconds
+    return {'seconds': best, 'items': items, 'bytes': num_bytes}
+
+
+def measure(case, scale, workers, dirname, repeat):
+    """
+    Run a case in a sub-process and measure its peak RSS.
+    return {seconds, items, bytes, items_per_s, mb_per_s, maxrss_mb}
+    """
+    cmd = [sys.executable, os.path.abspath(__file__),
+           '--run-case', case, '--run-scale', scale, '--run-workers', str(workers),
+           '--dir', dirname, '--repeat', str(repeat)]
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    output = proc.stdout.read()
+    # wait4 gives the resource usage of this very child (and its workers)
+    pid, status, rusage = os.wait4(proc.pid, 0)
+    proc.returncode = status
+    if status != 0:
+        raise RuntimeError('case %s (%s, %i workers) failed' % (case, scale, workers))
+    result = json.loads(output.decode('ascii'))
+    result['items_per_s'] = result['items'] / max(result['seconds'], 1e-9)
+    result['mb_per_s'] = result['bytes'] / 1024.0 ** 2 / max(result['seconds'], 1e-9)
+    result['maxrss_mb'] = rusage.ru_maxrss / 1024.0  # KB on linux
+    return result
+
+
+def compare(result, base, tolerance):
+    """ return list of regressions of result against its baseline """
+    regressions = []
+    if result['items_per_s'] < base['items_per_s'] * (1 - tolerance):
+        regressions.append('throughput %.1f%%' % (100.0 * result['items_per_s'] / base['items_per_s'] - 100))
+    if result['maxrss_mb'] > base['maxrss_mb'] * (1 + tolerance):
+        regressions.append('peak RSS +%.1f%%' % (100.0 * result['maxrss_mb'] / base['maxrss_mb'] - 100))
+    return regressions
+
+
+def main():
+    """ The main function. """
+    args, parser = parse_cmdline()
+
+    if args.run_case:
+        dirname = os.path.abspath(args.str_dir)
+        result = run_case(args.run_case, os.path.join(dirname, args.run_scale),
+                          args.run_workers, args.repeat)
+        sys.stdout.write(json.dumps(result) + '\n')
+        return
+
+    scales = [s.strip() for s in args.str_scales.split(',')]
+    cases = [s.strip() for s in args.str_cases.split(',')]
+    try:
+        workers = [int(s) for s in args.str_workers.split(',')]
+    except ValueError:
+        parser.error('-w has to be a list of numbers: EXIT.')
+    for scale in scales:
+        if scale not in SCALES:
+            parser.error('unknown scale %s: EXIT.' % scale)
+    for case in cases:
+        if case not in CASES:
+            parser.error('unknown case %s: EXIT.' % case)
+    if args.repeat < 1:
+        parser.error('-r has to be > 0: EXIT.')
+
+    baseline = {}
+    if args.str_baseline:
+        baseline = json.load(open(args.str_baseline))
+
+    results = {}
+    num_regressions = 0
+    sys.stdout.write('#case\tscale\tworkers\tseconds\titems/s\tMB/s\tpeak-RSS-MB\tbaseline\n')
+    for scale in scales:
+        dirname = os.path.join(os.path.abspath(args.str_dir), scale)
+        make_fixtures(dirname, scale)
+        for case in cases:
+            for num_workers in (workers if case in PARALLEL_CASES else [1]):
+                key = '%s|%s|%i' % (case, scale, num_workers)
+                result = measure(case, scale, num_workers, os.path.abspath(args.str_dir), args.repeat)
+                results[key] = result
+                if key in baseline:
+                    regressions = compare(result, baseline[key], args.tolerance)
+                    if regressions:
+                        num_regressions += 1
+                        status = 'REGRESSION: ' + ', '.join(regressions)
+                    else:
+                        status = 'ok (%.2fx)' % (result['items_per_s'] / baseline[key]['items_per_s'])
+                else:
+                    status = '-'
+                sys.stdout.write('%s\t%s\t%i\t%.3f\t%.1f\t%.1f\t%.1f\t%s\n' % (case, scale, num_workers,
+                                                                           result['seconds'],
+                                                                           result['items_per_s'],
+                                                                           result['mb_per_s'],
+                                                                           result['maxrss_mb'],
+                                                                           status))
+                sys.stdout.flush()
+
+    if args.str_save:
+        outfile = open(args.str_save, 'w')
+        json.dump(results, outfile, indent=1, sort_keys=True)
+        outfile.close()
+
+    if num_regressions:
+        sys.stderr.write('%i REGRESSION(S) against %s\n' % (num_regressions, args.str_baseline))
+        return 1
+    return
+
+
+if __name__ == '__main__':
+    sys.exit(main())
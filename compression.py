@@ -0,0 +1,303 @@
+#!/usr/bin/env python2
+"""
+NAME: compression.py
+=========
+
+DESCRIPTION
+===========
+Compressed input and output files.
+
+Input (open_input, used by load_file of all scripts):
+.gz files are decompressed by the fastest available decompressor, in the
+order of INPUT_METHODS:
+isal        the igzip module of python-isal (ISA-L), optional
+igzip       the igzip command-line tool (ISA-L), in a sub-process
+zlib-ng     the gzip_ng module of python-zlib-ng, optional
+pigz        the pigz command-line tool, in a sub-process
+gzip        the gzip module
+A sub-process runs in parallel to the reading process and hands out the data
+through a pipe, so decompression is taken off the consumer's CPU. .bz2 and
+.zip (first member) files are read with the bz2 and zipfile modules. All
+inputs are binary file objects.
+
+Output (open_output, used by getKrakenFna.py):
+gzip    single-stream gzip via the gzip module.
+bgzf    block-gzip (as used by samtools/htslib). The data is cut into blocks
+        of < 64KB that are compressed in parallel by a pool of threads (zlib
+        releases the GIL). The result is a valid multi-member gzip-file that
+        any gzip reader can decompress and that can be indexed for random
+        access (e.g. with bgzip -r).
+zstd    zstandard via the optional zstandard module, or the zstd command-line
+        tool if the module is not installed.
+
+VERSION HISTORY
+===============
+
+0.0.1   2026/10/18    Initial version.
+
+LICENCE
+=======
+2016, copyright Sebastian Schmeier (s.schmeier@gmail.com), sschmeier.com
+
+template version: 1.6 (2016/11/09)
+"""
+from multiprocessing.pool import ThreadPool
+import os
+import gzip
+import bz2
+import zipfile
+import struct
+import subprocess
+import zlib
+
+try:
+    import zstandard  # non-standard lib, optional
+except ImportError:
+    zstandard = None
+try:
+    from isal import igzip  # non-standard lib, optional
+except ImportError:
+    igzip = None
+try:
+    from zlib_ng import gzip_ng  # non-standard lib, optional
+except ImportError:
+    gzip_ng = None
+
+
+__version__ = '0.0.1'
+__date__ = '2026/10/18'
+__email__ = 's.schmeier@gmail.com'
+__author__ = 'Sebastian Schmeier'
+
+
+METHODS = ['gzip', 'bgzf', 'zstd']
+EXTENSIONS = {'gzip': '.gz', 'bgzf': '.gz', 'zstd': '.zst'}
+DEFAULT_LEVELS = {'gzip': 6, 'bgzf': 6, 'zstd': 3}
+
+INPUT_METHODS = ['isal', 'igzip', 'zlib-ng', 'pigz', 'gzip']
+# buffer of the pipe from a decompressing sub-process
+PIPE_BUFSIZE = 1 << 20
+
+# uncompressed bytes per bgzf block, as in htslib
+BGZF_BLOCKSIZE = 0xff00
+# empty block that marks the end of a bgzf-file
+BGZF_EOF = b'\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00'
+
+
+def which(tool):
+    """ True if tool is an executable in the PATH. """
+    for path in os.environ.get('PATH', '').split(os.pathsep):
+        if os.access(os.path.join(path, tool), os.X_OK):
+            return True
+    return False
+
+
+def zstd_available():
+    """ True if zstd output can be written. """
+    return zstandard is not None or which('zstd')
+
+
+def input_available(method):
+    """ True if .gz input can be decompressed with method. """
+    if method == 'isal':
+        return igzip is not None
+    elif method == 'zlib-ng':
+        return gzip_ng is not None
+    elif method in ('igzip', 'pigz'):
+        return which(method)
+    return method == 'gzip'
+
+
+def input_method(method=None):
+    """
+    The decompressor of .gz input: method if it is available, else the
+    fastest available one of INPUT_METHODS.
+    """
+    if method and method != 'auto' and input_available(method):
+        return method
+    for name in INPUT_METHODS:
+        if input_available(name):
+            return name
+
+
+class PipeReader(object):
+    """
+    Read-only binary file object of the output of a decompressing tool that
+    runs in a sub-process. An exit code other than 0 raises an IOError once
+    the output is read to its end.
+    """
+    def __init__(self, cmd):
+        self.cmd = cmd
+        self.proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, bufsize=PIPE_BUFSIZE)
+        self.fileobj = self.proc.stdout
+
+    def check(self):
+        if self.proc.wait() != 0:
+            raise IOError('%s exited with code %i' % (' '.join(self.cmd), self.proc.returncode))
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        if not data and size != 0:
+            self.check()
+        return data
+
+    def __iter__(self):
+        for line in self.fileobj:
+            yield line
+        self.check()
+
+    def close(self):
+        self.fileobj.close()
+        if self.proc.poll() is None:
+            # the consumer stopped early
+            self.proc.kill()
+        self.proc.wait()
+
+
+def open_input(filename, method=None):
+    """
+    Open a (compressed) input file for reading, .gz with the decompressor
+    given by method (one of INPUT_METHODS) or the fastest available one.
+    """
+    ext = filename.split('.')[-1]
+    if ext == 'gz':
+        method = input_method(method)
+        if method == 'isal':
+            return igzip.open(filename, 'rb')
+        elif method == 'zlib-ng':
+            return gzip_ng.open(filename, 'rb')
+        elif method in ('igzip', 'pigz'):
+            return PipeReader([method, '-d', '-c', filename])
+        return gzip.open(filename, 'rb')
+    elif ext == 'bz2':
+        return bz2.BZ2File(filename, 'rb')
+    elif ext == 'zip':
+        zfile = zipfile.ZipFile(filename)
+        return zfile.open(zfile.namelist()[0])
+    return open(filename, 'rb')
+
+
+def bgzf_block(data, level=6):
+    """ Compress up to BGZF_BLOCKSIZE bytes into one bgzf block. """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = compressor.compress(data) + compressor.flush()
+    header = b'\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00'
+    return (header + struct.pack('<H', len(cdata) + 25) + cdata +
+            struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data)))
+
+
+def bgzf_size(filename):
+    """
+    Uncompressed size of a bgzf-file, summed up from the sizes stored at the
+    end of its blocks, None if the file is not bgzf.
+    """
+    infile = open(filename, 'rb')
+    size = 0
+    offset = 0
+    while True:
+        infile.seek(offset)
+        header = infile.read(18)
+        if not header:
+            break
+        if len(header) < 18 or header[:4] != b'\x1f\x8b\x08\x04' or header[12:14] != b'BC':
+            infile.close()
+            return None
+        offset += struct.unpack('<H', header[16:18])[0] + 1
+        infile.seek(offset - 4)
+        size += struct.unpack('<I', infile.read(4))[0]
+    infile.close()
+    return size
+
+
+class BgzfWriter(object):
+    """
+    Write-only file object producing a bgzf-file. Data is buffered until
+    threads * 16 blocks are collected, which are then compressed in parallel
+    and written in order.
+    """
+    def __init__(self, filename, level=6, threads=1):
+        self.fileobj = open(filename, 'wb')
+        self.level = level
+        self.threads = threads
+        if threads > 1:
+            self.pool = ThreadPool(threads)
+        else:
+            self.pool = None
+        self.buffer = []
+        self.buffered = 0
+        self.flushsize = BGZF_BLOCKSIZE * 16 * threads
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.flushsize:
+            self._flush_blocks(False)
+
+    def _flush_blocks(self, final):
+        data = b''.join(self.buffer)
+        num_blocks = len(data) // BGZF_BLOCKSIZE
+        if final and len(data) % BGZF_BLOCKSIZE:
+            num_blocks += 1
+        blocks = [data[i * BGZF_BLOCKSIZE:(i + 1) * BGZF_BLOCKSIZE] for i in range(num_blocks)]
+        rest = data[num_blocks * BGZF_BLOCKSIZE:]
+        self.buffer = [rest]
+        self.buffered = len(rest)
+
+        level = self.level
+        if self.pool is not None:
+            cblocks = self.pool.map(lambda block: bgzf_block(block, level), blocks)
+        else:
+            cblocks = [bgzf_block(block, level) for block in blocks]
+        for cblock in cblocks:
+            self.fileobj.write(cblock)
+
+    def close(self):
+        self._flush_blocks(True)
+        self.fileobj.write(BGZF_EOF)
+        self.fileobj.close()
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+
+
+class ZstdWriter(object):
+    """
+    Write-only file object producing a zstd-file, with the zstandard module
+    if installed, otherwise by piping into the zstd command-line tool.
+    """
+    def __init__(self, filename, level=6, threads=1):
+        if zstandard is not None:
+            self.proc = None
+            self.fileobj = open(filename, 'wb')
+            compressor = zstandard.ZstdCompressor(level=level, threads=threads)
+            self.writer = compressor.stream_writer(self.fileobj)
+        else:
+            self.fileobj = None
+            self.proc = subprocess.Popen(['zstd', '-q', '-f', '-%i' % level,
+                                          '-T%i' % threads, '-o', filename],
+                                         stdin=subprocess.PIPE)
+            self.writer = self.proc.stdin
+
+    def write(self, data):
+        self.writer.write(data)
+
+    def close(self):
+        self.writer.close()
+        if self.proc is not None:
+            if self.proc.wait() != 0:
+                raise IOError('zstd exited with code %i' % self.proc.returncode)
+        elif not self.fileobj.closed:
+            self.fileobj.close()
+
+
+def open_output(filename, method, level=None, threads=1):
+    """ Open a compressed file for writing with one of METHODS. """
+    if level is None:
+        level = DEFAULT_LEVELS.get(method, 6)
+    if method == 'gzip':
+        return gzip.open(filename, 'wb', level)
+    elif method == 'bgzf':
+        return BgzfWriter(filename, level, threads)
+    elif method == 'zstd':
+        return ZstdWriter(filename, level, threads)
+    raise ValueError('unknown compression method: %s' % method)
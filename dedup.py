@@ -0,0 +1,255 @@
+#!/usr/bin/env python2
+"""
+NAME: dedup.py
+=========
+
+DESCRIPTION
+===========
+Deduplication of assemblies for getKrakenFna.py.
+
+One streaming pass over a genomic fasta-file gives
+- the md5 of the sequence of each record (upper case, no line breaks), to
+  find exact duplicate records, and
+- a bottom-k MinHash sketch of the canonical k-mers of the assembly (the
+  smallest hash values, as in Mash), to estimate the distance between two
+  assemblies: d = -1/k * ln(2j / (1 + j)) for the Jaccard estimate j.
+
+Sketches are cached per accession and reused while the size and mtime of the
+input file are unchanged, so re-runs only sketch new genomes.
+
+Needs numpy.
+
+VERSION HISTORY
+===============
+
+0.0.1   2026/10/18    Initial version.
+
+LICENCE
+=======
+2016, copyright Sebastian Schmeier (s.schmeier@gmail.com), sschmeier.com
+
+template version: 1.6 (2016/11/09)
+"""
+import sys
+import os
+import os.path
+import hashlib
+import marshal
+import math
+import compression
+
+try:
+    import numpy  # non-standard lib, optional: only needed for deduplication
+except ImportError:
+    numpy = None
+
+
+__version__ = '0.0.1'
+__date__ = '2026/10/18'
+__email__ = 's.schmeier@gmail.com'
+__author__ = 'Sebastian Schmeier'
+
+
+K = 21  # k-mer length, 2 bits per base fit into 64 bits
+SKETCH_SIZE = 1000
+BLOCKSIZE = 4 * 1024 * 1024
+CACHE_VERSION = 1
+# preference of assembly levels when picking representatives
+LEVELS = ['Complete Genome', 'Chromosome', 'Scaffold', 'Contig']
+
+if numpy is not None:
+    # base => 2-bit code, everything else (N, IUPAC codes) => 4
+    CODES = numpy.full(256, 4, dtype=numpy.uint8)
+    for i, base in enumerate('ACGT'):
+        CODES[ord(base)] = i
+        CODES[ord(base.lower())] = i
+
+
+def kmer_hashes(seq, k=K):
+    """
+    Hash values of the canonical k-mers (the smaller of k-mer and its
+    reverse complement) of a sequence chunk. k-mers with other bases than
+    ACGT are left out.
+    return numpy uint64 array
+    """
+    codes = CODES[numpy.frombuffer(seq, dtype=numpy.uint8)]
+    num = len(codes) - k + 1
+    if num <= 0:
+        return numpy.zeros(0, dtype=numpy.uint64)
+    invalid = numpy.concatenate([[0], numpy.cumsum(codes == 4)])
+    valid = (invalid[k:] - invalid[:num]) == 0
+
+    bases = (codes & 3).astype(numpy.uint64)
+    fwd = numpy.zeros(num, dtype=numpy.uint64)
+    rev = numpy.zeros(num, dtype=numpy.uint64)
+    for j in range(k):
+        fwd = (fwd << numpy.uint64(2)) | bases[j:j + num]
+        rev |= (numpy.uint64(3) - bases[j:j + num]) << numpy.uint64(2 * j)
+    x = numpy.minimum(fwd, rev)[valid]
+
+    # fmix64 of murmur3
+    x ^= x >> numpy.uint64(33)
+    x *= numpy.uint64(0xff51afd7ed558ccd)
+    x ^= x >> numpy.uint64(33)
+    x *= numpy.uint64(0xc4ceb9fe1a85ec53)
+    x ^= x >> numpy.uint64(33)
+    return x
+
+
+class Sketcher(object):
+    """ Streaming record hashes and MinHash sketch of one assembly. """
+    def __init__(self, k=K, size=SKETCH_SIZE):
+        self.k = k
+        self.size = size
+        self.sketch = numpy.zeros(0, dtype=numpy.uint64)
+        self.record_hashes = []
+        self.md5 = None
+        self.carry = b''  # last k-1 bases of the current record
+
+    def new_record(self):
+        self.end_record()
+        self.md5 = hashlib.md5()
+        self.carry = b''
+
+    def end_record(self):
+        if self.md5 is not None:
+            self.record_hashes.append(self.md5.hexdigest())
+            self.md5 = None
+
+    def feed(self, seq):
+        """ Add a chunk of sequence (without line breaks) of the current record. """
+        if self.md5 is None:  # sequence before the first header
+            self.new_record()
+        seq = seq.upper()
+        self.md5.update(seq)
+        seq = self.carry + seq
+        self.carry = seq[len(seq) - self.k + 1:]
+        hashes = kmer_hashes(seq, self.k)
+        if len(self.sketch) == self.size:
+            hashes = hashes[hashes < self.sketch[-1]]
+        if len(hashes):
+            self.sketch = numpy.unique(numpy.concatenate([self.sketch, hashes]))[:self.size]
+
+
+def sketch_file(filename, k=K, size=SKETCH_SIZE, blocksize=BLOCKSIZE):
+    """
+    One streaming pass over a (gzipped) fasta-file.
+    return (record_hashes, sketch): md5 hex-digest per record in file order
+    and the sorted numpy uint64 sketch of the assembly.
+    """
+    infile = compression.open_input(filename)
+    sketcher = Sketcher(k, size)
+    rest = b''
+    while True:
+        block = infile.read(blocksize)
+        if not block:
+            if not rest:
+                break
+            data = rest + b'\n'
+            rest = b''
+        else:
+            data = rest + block
+            cut = data.rfind(b'\n') + 1
+            data, rest = data[:cut], data[cut:]
+
+        # data holds whole lines only
+        pos = 0
+        end = len(data)
+        while pos < end:
+            if data[pos:pos + 1] == b'>':
+                sketcher.new_record()
+                pos = data.find(b'\n', pos) + 1
+            else:
+                nxt = data.find(b'\n>', pos)
+                stop = end if nxt == -1 else nxt + 1
+                sketcher.feed(data[pos:stop].translate(None, b'\r\n'))
+                pos = stop
+    infile.close()
+    sketcher.end_record()
+    return sketcher.record_hashes, sketcher.sketch
+
+
+def cached_sketch(args):
+    """
+    Sketch of a file, from its cache file if the file is unchanged. Top-level
+    function so that it can be distributed with Pool.map.
+    args = (filename, cachename, sketch size)
+
+    return (record_hashes, sketch)
+    """
+    filename, cachename, size = args
+    stat = os.stat(filename)
+    stamp = (CACHE_VERSION, stat.st_size, int(stat.st_mtime), K, size)
+    if os.path.isfile(cachename):
+        infile = open(cachename, 'rb')
+        try:
+            cached_stamp, record_hashes, sketch = marshal.load(infile)
+            if tuple(cached_stamp) == stamp:
+                return record_hashes, numpy.frombuffer(sketch, dtype=numpy.uint64)
+        except (EOFError, ValueError, TypeError):
+            pass  # unreadable cache: sketch again
+        finally:
+            infile.close()
+
+    record_hashes, sketch = sketch_file(filename, K, size)
+    tmpname = '%s.%i.tmp' % (cachename, os.getpid())
+    try:
+        outfile = open(tmpname, 'wb')
+        marshal.dump((stamp, record_hashes, sketch.tobytes()), outfile, 2)
+        outfile.close()
+        os.rename(tmpname, cachename)
+    except (IOError, OSError):
+        sys.stderr.write('Could not write %s.\n' % cachename)
+    return record_hashes, sketch
+
+
+def distance(a, b, k=K, size=SKETCH_SIZE):
+    """ Mash distance of two sketches, 1.0 if they share nothing. """
+    union = numpy.union1d(a, b)[:size]
+    if len(union) == 0:
+        return 1.0
+    shared = numpy.intersect1d(numpy.intersect1d(a, b, assume_unique=True),
+                               union, assume_unique=True)
+    j = float(len(shared)) / len(union)
+    if j == 0:
+        return 1.0
+    return max(0.0, -math.log(2 * j / (1 + j)) / k)
+
+
+def representatives(sketches, max_distance, size=SKETCH_SIZE):
+    """
+    Greedy selection of representatives: an assembly is kept unless it lies
+    within max_distance of an assembly kept before it.
+    sketches = [(key, sketch), ...] in order of preference
+
+    return (kept keys, {dropped key: key of its representative})
+    """
+    kept = []
+    dropped = {}
+    for key, sketch in sketches:
+        for rep_key, rep_sketch in kept:
+            if distance(sketch, rep_sketch, K, size) <= max_distance:
+                dropped[key] = rep_key
+                break
+        else:
+            kept.append((key, sketch))
+    return [key for key, sketch in kept], dropped
+
+
+def duplicate_records(record_hashes):
+    """
+    Exact duplicate records: each record after the first with the same
+    sequence.
+    record_hashes = [(key, [md5, ...]), ...] in order of preference
+
+    return {key: set of record indices (in file order) to skip}
+    """
+    seen = set()
+    skip = {}
+    for key, hashes in record_hashes:
+        for idx, md5 in enumerate(hashes):
+            if md5 in seen:
+                skip.setdefault(key, set()).add(idx)
+            else:
+                seen.add(md5)
+    return skip
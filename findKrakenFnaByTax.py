@@ -28,12 +28,12 @@ import os
 import os.path
 import argparse
 import csv
-import gzip
-import bz2
-import zipfile
 import urllib
 import hashlib
 import time
+import taxonomy
+import assemblysummary
+import compression
 
 
 __version__ = '0.0.1'
@@ -59,7 +59,8 @@ def parse_cmdline():
         dest='str_assembly',
         metavar='assembly_summary.txt',
         type=str,
-        help='Assembly summary file for the branch of the tax-ids.')
+        nargs='+',
+        help='Assembly summary file(s) of the branches to search, e.g. genomes/refseq/*/assembly_summary.txt. With more than one file the file paths in the output are prefixed by the branch.')
 
     parser.add_argument(
         dest='str_file',
@@ -67,6 +68,21 @@ def parse_cmdline():
         type=str,
         help='One column file containing the taxonomy id ["-" for reading from stdin]')
 
+    parser.add_argument('-d',
+        '--descendants',
+        dest='descendants',
+        default=False,
+        action='store_true',
+        help='Also report the assemblies of all tax-ids below each given tax-id. An extra last column gives the tax-id of the assembly. Needs nodes.dmp.')
+
+    parser.add_argument(
+        '--nodes',
+        dest='str_nodes',
+        metavar='FILE',
+        type=str,
+        default=None,
+        help='Kraken taxonomy nodes.dmp file for --descendants.')
+
     # if no arguments supplied print help
     if len(sys.argv)==1:
         parser.print_help()
@@ -76,88 +92,114 @@ def parse_cmdline():
     return args, parser
 
 
+def text_lines(filehandle):
+    """
+    Lines of a binary file object as str, for the csv module. Compressed
+    inputs are opened in binary mode, which yields bytes on python 3.
+    """
+    for line in filehandle:
+        if not isinstance(line, str):
+            line = line.decode('utf-8')
+        yield line
+
+
 def load_file(filename):
     """ LOADING FILES """
     if filename in ['-', 'stdin']:
         filehandle = sys.stdin
-    elif filename.split('.')[-1] == 'gz':
-        filehandle = gzip.open(filename)
-    elif filename.split('.')[-1] == 'bz2':
-        filehandle = bz2.BZFile(filename)
-    elif filename.split('.')[-1] == 'zip':
-        filehandle = zipfile.Zipfile(filename)
+    elif filename.split('.')[-1] in ['gz', 'bz2', 'zip']:
+        filehandle = text_lines(compression.open_input(filename))
     else:
         filehandle = open(filename)
     return filehandle
 
 
-def parse_assemblyfile(taxa, fname):
-
+def parse_assemblyfile(fname, prefix=''):
+    """
+    Index an assembly summary file by tax-id. The file is parsed with the
+    shared assemblysummary module, which caches the parsed columns next to it.
+    return {taxid: [(name, basename, assembly_level, version_status), ...]}
+    """
     if not os.path.isfile(fname):
         sys.stderr.write("ERROR: '%s' not found.\nEXIT\n\n"
                              % (fname))
         sys.exit(1)
-    else:
-        jobs = {}
-        # read file, extract ftp paths and download each file
-        oR = csv.reader(load_file(fname), delimiter = '\t')
-        # for each line in assembly_summary.txt
-        for a in oR:
-            if a[0][0] == '#':
-                continue
-            
-            taxid = a[5]
-            
-            if taxid not in taxa:
-                continue
-
-            name = a[7]
-            version_status = a[10]
-            basename = os.path.basename(a[19]) + '_genomic.tax.fna'
-            assembly_level = a[11]
-            if taxid not in jobs:
-                jobs[taxid] = set()
-                
-            jobs[taxid].add((name,
-                            basename,
-                            assembly_level,
-                            version_status))
-        
+
+    oSummary = assemblysummary.AssemblySummary(fname)
+    taxids = oSummary['taxid']
+    names = oSummary['organism_name']
+    status = oSummary['version_status']
+    levels = oSummary['assembly_level']
+    ftp_paths = oSummary['ftp_path']
+    jobs = {}
+    for i in range(len(oSummary)):
+        basename = prefix + os.path.basename(ftp_paths[i]) + '_genomic.tax.fna'
+        row = (names[i], basename, levels[i], status[i])
+        if taxids[i] in jobs:
+            jobs[taxids[i]].append(row)
+        else:
+            jobs[taxids[i]] = [row]
     return jobs
 
     
 def main():
     """ The main function. """
     args, parser = parse_cmdline()
-    file_assembly = args.str_assembly
 
-    # load tax ids to add to files
+    # load tax ids to look up, in input order
     file_in = load_file(args.str_file)
     reader = csv.reader(file_in, delimiter = '\t')
+    taxa = []
     dTax = {}
     for a in reader:
-        dTax[a[0]] = None
+        if a and a[0] not in dTax:
+            dTax[a[0]] = None
+            taxa.append(a[0])
+
+    # tax-id index over all branches
+    dIndex = {}
+    for file_assembly in args.str_assembly:
+        prefix = ''
+        if len(args.str_assembly) > 1:
+            prefix = os.path.basename(os.path.dirname(os.path.abspath(file_assembly))) + '/'
+        index = parse_assemblyfile(file_assembly, prefix)
+        for taxid in index:
+            if taxid in dIndex:
+                dIndex[taxid] = dIndex[taxid] + index[taxid]
+            else:
+                dIndex[taxid] = index[taxid]
+
+    if args.descendants:
+        if not args.str_nodes or not os.path.isfile(args.str_nodes):
+            parser.error('--descendants needs nodes.dmp, use --nodes: EXIT.')
+        oNodes = taxonomy.NodesTable(args.str_nodes)
 
-    job_list = []
-    taxa = dTax.keys()
-    jobs_br = parse_assemblyfile(taxa, file_assembly)
-    job_list += jobs_br
-       
     for taxid in taxa:
-        if taxid not in jobs_br:
-            sys.stdout.write('%s\tn/a\tn/a\tn/a\tn/a\n' %( taxid ))
+        if args.descendants:
+            try:
+                query = [taxid] + [str(t) for t in oNodes.descendants(int(taxid))]
+            except ValueError:
+                query = [taxid]
         else:
-            for t in jobs_br[taxid]:
-                asem_stat = t[2]
-                v_stat = t[3]
-                filepath = t[1]
-                name= t[0]
-                   
-                sys.stdout.write('%s\t%s\t%s\t%s\t%s\n' %( taxid, name, asem_stat, v_stat, filepath ))
+            query = [taxid]
+
+        found = False
+        for tax in query:
+            for t in dIndex.get(tax, []):
+                found = True
+                name, filepath, asem_stat, v_stat = t
+                if args.descendants:
+                    sys.stdout.write('%s\t%s\t%s\t%s\t%s\t%s\n' %( taxid, name, asem_stat, v_stat, filepath, tax ))
+                else:
+                    sys.stdout.write('%s\t%s\t%s\t%s\t%s\n' %( taxid, name, asem_stat, v_stat, filepath ))
+        if not found:
+            if args.descendants:
+                sys.stdout.write('%s\tn/a\tn/a\tn/a\tn/a\tn/a\n' %( taxid ))
+            else:
+                sys.stdout.write('%s\tn/a\tn/a\tn/a\tn/a\n' %( taxid ))
                 
     return
 
 
 if __name__ == '__main__':
     sys.exit(main())
-
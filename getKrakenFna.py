@@ -26,18 +26,22 @@ template version: 1.6 (2016/11/09)
 """
 from timeit import default_timer as timer
 from multiprocessing import Pool
-from Bio import SeqIO # non-standard lib BioPython
 import sys
 import os
 import os.path
 import argparse
-import csv
 import gzip
-import bz2
-import zipfile
 import urllib
 import hashlib
-import time
+import struct
+import glob
+import manifest
+import compression
+import instrument
+import assemblysummary
+import taxonomy
+import dedup
+import masking
 
 
 __version__ = '0.0.2'
@@ -45,6 +49,20 @@ __date__ = '2017/01/20'
 __email__ = 's.schmeier@gmail.com'
 __author__ = 'Sebastian Schmeier'
 
+# compression, deduplication and masking of the output files and the
+# decompressor of the input files, set in each worker by init_worker()
+OUTPUT = {'compress': None, 'level': None, 'threads': 1, 'skip': {}, 'mask': None,
+          'decompress': None}
+
+# size of the blocks copied from the input to the output fasta-file
+BLOCKSIZE = 4 * 1024 * 1024
+# input bytes per work unit of small assemblies
+UNIT_SIZE = 64 * 1024 * 1024
+# merged sequence-id to tax-id map of a branch in --map mode
+MAP_FNAME = 'seqid2taxid.map'
+# sub-directory of the maps of the single assemblies, kept out of the library
+MAPS_DIR = 'maps'
+
 
 def parse_cmdline():
     """ Parse command-line args. """
@@ -93,7 +111,69 @@ def parse_cmdline():
         dest='gzip',
         default=False,
         action='store_true',
-        help='Create gzip-ed output files. (process takes a lot longer)')
+        help='Create compressed output files, with the method given by -c. [default: uncompressed]')
+
+    parser.add_argument('-c',
+        '--compress',
+        dest='compress',
+        metavar='METHOD',
+        choices=compression.METHODS,
+        default=None,
+        help='Compression method of the output files, implies -z: gzip (single stream), bgzf (block-gzip compressed by --threads threads, readable by any gzip tool) or zstd (needs the zstandard module or zstd tool). [default: bgzf]')
+
+    parser.add_argument(
+        '--compress-level',
+        dest='compress_level',
+        metavar='INT',
+        type=int,
+        default=None,
+        help='Compression level. [default: 6 for gzip/bgzf, 3 for zstd]')
+
+    parser.add_argument(
+        '--decompress',
+        dest='decompress',
+        metavar='METHOD',
+        choices=['auto'] + compression.INPUT_METHODS,
+        default='auto',
+        help='Decompressor of the .fna.gz input files: isal or zlib-ng (accelerated python modules), igzip or pigz (command-line tools in a sub-process), gzip (python gzip module), or auto for the fastest available one. [default: auto]')
+
+    parser.add_argument('-s',
+        '--shard-size',
+        dest='str_shard_size',
+        metavar='SIZE',
+        type=str,
+        default=None,
+        help='Write each branch into a few large library shards (library_0001.fna, ...) of about SIZE bytes each instead of one file per assembly, e.g. 4G or 500M. The byte ranges of the assemblies in the shards are listed in library.index.txt. [default: one file per assembly]')
+
+    parser.add_argument('-m',
+        '--map',
+        dest='seqid_map',
+        default=False,
+        action='store_true',
+        help='Header-only mode: do not rewrite the sequences, only scan the headers of each file and write a merged %s (sequence-id<TAB>tax-id) per branch. The original .fna.gz-files are hard-linked (or, across file systems, symlinked) into the branch directory.' % MAP_FNAME)
+
+    parser.add_argument('-i',
+        '--incremental',
+        dest='incremental',
+        default=False,
+        action='store_true',
+        help='Incremental refresh: diff assembly_summary.txt against the manifest of previously processed files and only convert new or changed assemblies. Files of retired assemblies (no longer "latest") are removed.')
+
+    parser.add_argument(
+        '--taxon',
+        dest='str_taxon',
+        metavar='TAXIDS',
+        type=str,
+        default=None,
+        help='Only convert the assemblies of these clades: tax-ids separated by comma, each selecting itself and all tax-ids below it, e.g. 543 for all Enterobacteriaceae. Needs --nodes. [default: all]')
+
+    parser.add_argument(
+        '--nodes',
+        dest='str_nodes',
+        metavar='FILE',
+        type=str,
+        default=None,
+        help='Kraken taxonomy nodes.dmp file for --taxon.')
 
     parser.add_argument('-a',
         '--assembly',
@@ -102,6 +182,66 @@ def parse_cmdline():
         action='store_true',
         help='Print assembly stats for branches and exits.')
 
+    parser.add_argument(
+        '--log',
+        dest='str_log',
+        metavar='FILE',
+        type=str,
+        default=None,
+        help='Append a machine-readable run log (JSON lines) to FILE: wall time, bytes in and out and records of each conversion and the totals of the run.')
+
+    group2 = parser.add_argument_group('Deduplication',
+                                       'Deduplication of the assemblies before the library is built (needs numpy):')
+
+    group2.add_argument(
+        '--dedup',
+        dest='dedup',
+        default=False,
+        action='store_true',
+        help='Drop assemblies of a species (grouped by the species_taxid of assembly_summary.txt, so strains of a species are compared with each other) that are near-identical to a better one (MinHash sketches of 21-mers, see --dedup-distance) and leave out exact duplicate sequences within a tax-id.')
+
+    group2.add_argument(
+        '--dedup-distance',
+        metavar='FLOAT',
+        type=float,
+        dest='dedup_distance',
+        default=0.001,
+        help='Drop an assembly within this Mash distance of a kept assembly of the same species, about 1 - average nucleotide identity. [default: 0.001]')
+
+    group2.add_argument(
+        '--sketch-size',
+        metavar='INT',
+        type=int,
+        dest='sketch_size',
+        default=dedup.SKETCH_SIZE,
+        help='Number of hashes per sketch. [default: %i]' % dedup.SKETCH_SIZE)
+
+    group3 = parser.add_argument_group('Masking',
+                                       'Masking of the sequences while they are written (needs numpy), the sequences are wrapped at %i bases per line:' % masking.LINE_WIDTH)
+
+    group3.add_argument(
+        '--dust',
+        dest='dust',
+        default=False,
+        action='store_true',
+        help='Mask low-complexity regions with N (DUST-style scores of windows of 64 triplets).')
+
+    group3.add_argument(
+        '--dust-threshold',
+        metavar='FLOAT',
+        type=float,
+        dest='dust_threshold',
+        default=masking.DUST_THRESHOLD,
+        help='Mask windows scoring above this threshold, lower masks more. [default: %g]' % masking.DUST_THRESHOLD)
+
+    group3.add_argument(
+        '--max-n-run',
+        metavar='INT',
+        type=int,
+        dest='max_n_run',
+        default=None,
+        help='Cut runs of N (including masked regions) down to INT bases. [default: keep]')
+
     group1 = parser.add_argument_group('Threading',
                                        'Multithreading arguments:')
 
@@ -117,6 +257,16 @@ def parse_cmdline():
         ' It is only logical to not give more processes'+\
         ' than cpus/cores are available. [default: 1]')
 
+    group1.add_argument(
+        '--threads',
+        metavar='INT',
+        type=int,
+        dest='threads',
+        default=1,
+        help=
+        'Number of compression threads per output file (bgzf, zstd).'+\
+        ' Each of the -p processes uses this many threads. [default: 1]')
+
     # if no arguments supplied print help
     if len(sys.argv)==1:
         parser.print_help()
@@ -130,60 +280,495 @@ def load_file(filename):
     """ LOADING FILES """
     if filename in ['-', 'stdin']:
         filehandle = sys.stdin
-    elif filename.split('.')[-1] == 'gz':
-        filehandle = gzip.open(filename)
-    elif filename.split('.')[-1] == 'bz2':
-        filehandle = bz2.BZFile(filename)
-    elif filename.split('.')[-1] == 'zip':
-        filehandle = zipfile.Zipfile(filename)
+    elif filename.split('.')[-1] in ['gz', 'bz2', 'zip']:
+        filehandle = compression.open_input(filename, OUTPUT['decompress'])
     else:
         filehandle = open(filename)
     return filehandle
 
 
-def new_file(outfile_name):
+def new_file(outfile_name, compress=None, level=None, threads=1):
     # create outfile object
-    if not outfile_name:
+    if compress:
+        outfileobj = compression.open_output(outfile_name, compress, level, threads)
+    elif not outfile_name:
         outfileobj = sys.stdout
     elif outfile_name in ['-', 'stdout']:
         outfileobj = sys.stdout
     elif outfile_name.split('.')[-1] == 'gz':
         outfileobj = gzip.open(outfile_name, 'wb')
     else:
-        outfileobj = open(outfile_name, 'w')
+        outfileobj = open(outfile_name, 'wb')
     return outfileobj
 
 
+def init_worker(compress, level, threads, skip=None, mask=None, decompress=None):
+    """
+    Pool initializer: set the output compression of a worker, the
+    duplicate records to leave out, {infile-path: set of record indices},
+    the masking, (dust threshold or None, maximum N-run or None), and the
+    decompressor of the input files.
+    """
+    OUTPUT['compress'] = compress
+    OUTPUT['level'] = level
+    OUTPUT['threads'] = threads
+    OUTPUT['skip'] = skip or {}
+    OUTPUT['mask'] = mask
+    OUTPUT['decompress'] = decompress
+
+
+def new_masker():
+    """ Masker of the worker for one file, None without masking. """
+    if OUTPUT['mask'] is None:
+        return None
+    threshold, max_n_run = OUTPUT['mask']
+    if threshold is None:
+        return masking.Masker(max_n_run=max_n_run, dust=False)
+    return masking.Masker(threshold, max_n_run)
+
+
+def rewrite_header(header, tag):
+    """
+    Insert the kraken tag after the sequence id of a header line
+    (without line break): >seq1 blah => >seq1|kraken:taxid|12345 blah
+    """
+    parts = header.split(None, 1)
+    if len(parts) == 1:
+        return parts[0] + tag
+    # keep the original whitespace between id and description
+    return parts[0] + tag + header[len(parts[0]):]
+
+
+def rewrite_headers(infile, outfile, taxid, blocksize=BLOCKSIZE, skip=None):
+    """
+    Stream a fasta-file from infile to outfile and rewrite each header line
+    into the kraken form >seq1|kraken:taxid|12345 blah.
+    Sequence lines are copied through in large blocks without being parsed,
+    so the original line wrapping is kept. Records whose index (in file
+    order) is in skip are left out.
+
+    return (number of records, number of bytes written)
+    """
+    tag = b'|kraken:taxid|' + str(taxid).encode('ascii')
+    num_records = 0
+    num_bytes = 0
+    record = -1  # index of the current input record
+    skipping = False
+    line_start = True  # position 0 of the next block starts a line
+    pending = b''  # header line cut by a block boundary
+    while True:
+        block = infile.read(blocksize)
+        if not block:
+            break
+        if pending:
+            block = pending + block
+            pending = b''
+
+        pos = 0
+        end = len(block)
+        while pos < end:
+            if line_start and block[pos:pos + 1] == b'>':
+                eol = block.find(b'\n', pos)
+                if eol == -1:
+                    # header continues in the next block
+                    pending = block[pos:]
+                    break
+                record += 1
+                skipping = skip is not None and record in skip
+                if not skipping:
+                    header = rewrite_header(block[pos:eol], tag)
+                    outfile.write(header)
+                    num_bytes += len(header)
+                    num_records += 1
+                pos = eol
+                line_start = False
+            else:
+                # copy everything up to the next header line
+                nxt = block.find(b'\n>', pos)
+                if nxt == -1:
+                    if not skipping:
+                        outfile.write(block[pos:])
+                        num_bytes += end - pos
+                    line_start = block[-1:] == b'\n'
+                    break
+                if not skipping:
+                    outfile.write(block[pos:nxt + 1])
+                    num_bytes += nxt + 1 - pos
+                pos = nxt + 1
+                line_start = True
+
+    if pending and (skip is None or record + 1 not in skip):
+        header = rewrite_header(pending, tag)
+        outfile.write(header)
+        num_bytes += len(header)
+        num_records += 1
+    return num_records, num_bytes
+
+
+def rewrite_masked(infile, outfile, taxid, masker, blocksize=BLOCKSIZE, skip=None):
+    """
+    As rewrite_headers, but the sequences go through masker (a
+    masking.Masker), which masks them and wraps them anew.
+
+    return (number of records, number of bytes written)
+    """
+    tag = b'|kraken:taxid|' + str(taxid).encode('ascii')
+    num_records = 0
+    num_bytes = 0
+    record = -1
+    skipping = False
+    rest = b''
+    while True:
+        block = infile.read(blocksize)
+        if not block:
+            if not rest:
+                break
+            data = rest + b'\n'
+            rest = b''
+        else:
+            data = rest + block
+            cut = data.rfind(b'\n') + 1
+            data, rest = data[:cut], data[cut:]
+
+        # data holds whole lines only
+        out = []
+        pos = 0
+        end = len(data)
+        while pos < end:
+            if data[pos:pos + 1] == b'>':
+                eol = data.find(b'\n', pos)
+                if record >= 0 and not skipping:
+                    out.append(masker.end_record())
+                record += 1
+                skipping = skip is not None and record in skip
+                if not skipping:
+                    out.append(rewrite_header(data[pos:eol].rstrip(b'\r'), tag) + b'\n')
+                    num_records += 1
+                pos = eol + 1
+            else:
+                nxt = data.find(b'\n>', pos)
+                stop = end if nxt == -1 else nxt + 1
+                if not skipping:
+                    out.append(masker.feed(data[pos:stop].translate(None, b'\r\n')))
+                pos = stop
+        out = b''.join(out)
+        outfile.write(out)
+        num_bytes += len(out)
+
+    if record >= 0 and not skipping:
+        out = masker.end_record()
+        outfile.write(out)
+        num_bytes += len(out)
+    return num_records, num_bytes
+
+
 def my_func(args):
     """
     THIS IS THE ACCTUAL WORKFUNCTION THAT HAS TO BE EXECUTED MULTPLE TIMES.
     This function could be distributed to the cores requested.
     # do stuff
-    args = (taxid, infile-path, outfile-path)
+    args = (taxid, infile-path, outfile-path, accession, seq_rel_date,
+            ftp_path, assembly level, species tax-id), a job of
+            parse_assemblyfile(). Only the first three are used here, the
+            pipeline mode of getRefseqGenomic.py passes the first six.
     
-    return (args, res)
+    return (args, res, stats)
     """
     taxid = args[0]
     infilepath = args[1]
     outfilename = args[2]
+    start = timer()
     if not os.path.isfile(infilepath):
         sys.stderr.write('%s not found. SKIP\n'%(infilepath))
-        return (args, 0)
-    else:
-        fasta_records = SeqIO.parse(load_file(infilepath), "fasta")
-        outfile = new_file(outfilename)
-    
-    # here we iteracte over all records and change the header appropriately
+        return (args, 0, instrument.job_stats(start, error='input not found'))
+
+    infile = load_file(infilepath)
+    outfile = new_file(outfilename, OUTPUT['compress'], OUTPUT['level'], OUTPUT['threads'])
+    # here we stream the file and change each header appropriately
     # >seq1|kraken:taxid|12345 original stuff
-    for record in fasta_records:
-        record.id = '%s|kraken:taxid|%s'%(record.id, taxid)
-        SeqIO.write(record, outfile, "fasta")
-        
+    masker = new_masker()
+    if masker is None:
+        num_records, num_bytes = rewrite_headers(infile, outfile, taxid,
+                                                 skip=OUTPUT['skip'].get(infilepath))
+    else:
+        num_records, num_bytes = rewrite_masked(infile, outfile, taxid, masker,
+                                                skip=OUTPUT['skip'].get(infilepath))
+    infile.close()
     outfile.close()
-    return (args, 1)
+    stats = instrument.job_stats(start, os.path.getsize(infilepath), num_bytes, num_records)
+    if masker is not None:
+        stats['masked'] = masker.masked
+        stats['n_removed'] = masker.removed
+    return (args, 1, stats)
 
 
-def parse_assemblyfile(branch, genomictypes=["Complete Genome"], dirpath='./genomes/refseq/', krakendir='./kraken', gzip=False):
+def scan_headers(infile, blocksize=BLOCKSIZE):
+    """
+    Stream a fasta-file in large blocks and collect the sequence-ids (first
+    word of the header lines) without parsing the sequences.
+    return [seqid, ...] in file order
+    """
+    seqids = []
+    data = b'\n'  # so that a header in the first line is found
+    while True:
+        block = infile.read(blocksize)
+        data += block
+        pos = 0
+        while True:
+            start = data.find(b'\n>', pos)
+            if start == -1:
+                data = data[-1:]  # might be the line break before a header
+                break
+            eol = data.find(b'\n', start + 1)
+            if eol == -1:
+                if block:  # header continues in the next block
+                    data = data[start:]
+                    break
+                eol = len(data)
+            words = data[start + 2:eol].split(None, 1)
+            seqids.append(words[0] if words else b'')
+            pos = eol
+        if not block:
+            return seqids
+
+
+def link_file(filepath, linkpath):
+    """
+    Hard-link filepath to linkpath, replacing an old linkpath. Across file
+    systems a symlink is made instead.
+    """
+    if os.path.lexists(linkpath):
+        os.remove(linkpath)
+    try:
+        os.link(filepath, linkpath)
+    except OSError:
+        os.symlink(os.path.abspath(filepath), linkpath)
+
+
+def my_map_func(args):
+    """
+    Work function of the --map mode: write the sequence-id to tax-id map of
+    one assembly (into MAPS_DIR of the branch) and link its original file
+    into the branch directory.
+    args = (taxid, infile-path, map-path, ...)
+
+    return (args, res, stats) as my_func
+    """
+    taxid = args[0]
+    infilepath = args[1]
+    mappath = args[2]
+    start = timer()
+    if not os.path.isfile(infilepath):
+        sys.stderr.write('%s not found. SKIP\n'%(infilepath))
+        return (args, 0, instrument.job_stats(start, error='input not found'))
+
+    infile = load_file(infilepath)
+    seqids = scan_headers(infile)
+    infile.close()
+    tab = b'\t' + str(taxid).encode('ascii') + b'\n'
+    data = b''.join([seqid + tab for seqid in seqids])
+    outfile = open(mappath, 'wb')
+    outfile.write(data)
+    outfile.close()
+    krakendir = os.path.dirname(os.path.dirname(mappath))
+    link_file(infilepath, os.path.join(krakendir, os.path.basename(infilepath)))
+    return (args, 1, instrument.job_stats(start, os.path.getsize(infilepath), len(data), len(seqids)))
+
+
+def my_map_unit_func(jobs):
+    """ Work function of a work unit in --map mode, see my_unit_func. """
+    return [my_map_func(job) for job in jobs]
+
+
+def merge_maps(krakendir, mappaths):
+    """
+    Concatenate the maps of the assemblies of a branch, in order, into its
+    seqid2taxid.map. Missing maps (failed assemblies) are left out.
+    """
+    tmpname = os.path.join(krakendir, MAP_FNAME + '.tmp')
+    outfile = open(tmpname, 'wb')
+    for mappath in mappaths:
+        if os.path.isfile(mappath):
+            infile = open(mappath, 'rb')
+            outfile.write(infile.read())
+            infile.close()
+    outfile.close()
+    os.rename(tmpname, os.path.join(krakendir, MAP_FNAME))
+
+
+def my_unit_func(jobs):
+    """
+    Work function of a size-aware work unit: convert a number of (small)
+    assemblies one after the other.
+    return [(args, res, stats), ...] as my_func
+    """
+    return [my_func(job) for job in jobs]
+
+
+def my_sized_func(args):
+    """
+    Run a work function and hand back the input size of its work with the
+    result, for the progress bar.
+    args = (work_func, size, work)
+
+    return (size, work_func(work))
+    """
+    work_func, size, work = args
+    return (size, work_func(work))
+
+
+def my_shard_func(args):
+    """
+    Work function of the shard mode: convert a number of assemblies into one
+    library shard.
+    args = (shard-path, [job, ...])
+
+    return (args, [(shard, assembly, accession, taxid, start, end), ...], [(job, stats), ...])
+    with the uncompressed byte range [start, end) of each assembly in the shard.
+    """
+    shardpath, jobs = args
+    outfile = new_file(shardpath, OUTPUT['compress'], OUTPUT['level'], OUTPUT['threads'])
+    shard = os.path.basename(shardpath)
+    index = []
+    stats = []
+    offset = 0
+    for job in jobs:
+        taxid = job[0]
+        infilepath = job[1]
+        start = timer()
+        if not os.path.isfile(infilepath):
+            sys.stderr.write('%s not found. SKIP\n'%(infilepath))
+            stats.append((job, instrument.job_stats(start, error='input not found')))
+            continue
+        infile = load_file(infilepath)
+        masker = new_masker()
+        if masker is None:
+            num_records, num_bytes = rewrite_headers(infile, outfile, taxid,
+                                                     skip=OUTPUT['skip'].get(infilepath))
+        else:
+            num_records, num_bytes = rewrite_masked(infile, outfile, taxid, masker,
+                                                    skip=OUTPUT['skip'].get(infilepath))
+        infile.close()
+        index.append((shard, os.path.basename(infilepath), job[3], taxid,
+                      offset, offset + num_bytes))
+        job_stats = instrument.job_stats(start, os.path.getsize(infilepath), num_bytes, num_records)
+        if masker is not None:
+            job_stats['masked'] = masker.masked
+            job_stats['n_removed'] = masker.removed
+        stats.append((job, job_stats))
+        offset += num_bytes
+    outfile.close()
+    return (args, index, stats)
+
+
+def parse_size(size):
+    """ Parse a size like 500M or 4G into bytes. """
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+    size = size.strip().upper().rstrip('B')
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
+def uncompressed_size(filename):
+    """
+    Estimate the uncompressed size of a file. For gzip-files the sizes of
+    the blocks of bgzf-files (exact) or the size stored in the last four
+    bytes of the file are used (exact for single-member files below 4GB),
+    otherwise the size on disk.
+    """
+    if not os.path.isfile(filename):
+        return 0
+    size = os.path.getsize(filename)
+    if filename.split('.')[-1] != 'gz' or size < 4:
+        return size
+    bsize = compression.bgzf_size(filename)
+    if bsize is not None:
+        return bsize
+    infile = open(filename, 'rb')
+    infile.seek(-4, 2)
+    isize = struct.unpack('<I', infile.read(4))[0]
+    infile.close()
+    return max(isize, size)
+
+
+def input_size(filename):
+    """ Size of an input file on disk, 0 if it does not exist. """
+    if not os.path.isfile(filename):
+        return 0
+    return os.path.getsize(filename)
+
+
+def make_units(jobs, processes=1, unit_size=UNIT_SIZE):
+    """
+    Size-aware work units. The jobs are sorted by input size, largest first,
+    so that no large assembly is left to run on its own at the end. Small
+    assemblies are packed into units of about unit_size bytes, or less if
+    that would leave too few units to keep all processes busy, to save on
+    inter-process overhead.
+
+    return [(size, [job, ...]), ...], largest first
+    """
+    sized = [(input_size(job[1]), job) for job in jobs]
+    sized.sort(key=lambda x: x[0], reverse=True)
+    total = sum([size for size, job in sized])
+    target = max(1, min(unit_size, total // (processes * 4)))
+
+    units = []
+    unit = []
+    unit_bytes = 0
+    for size, job in sized:
+        if size >= target:
+            units.append((size, [job]))
+            continue
+        unit.append(job)
+        unit_bytes += size
+        if unit_bytes >= target:
+            units.append((unit_bytes, unit))
+            unit = []
+            unit_bytes = 0
+    if unit:
+        units.append((unit_bytes, unit))
+    return units
+
+
+def make_shards(jobs, shard_size, compress=None):
+    """
+    Pack the jobs of each branch directory, in order, into shards of about
+    shard_size bytes (estimated from the uncompressed input sizes). An
+    assembly larger than shard_size gets a shard of its own.
+
+    return [(shard-path, [job, ...]), ...]
+    """
+    template = 'library_%04i.fna'
+    if compress:
+        template += compression.EXTENSIONS[compress]
+    shards = []
+    counts = {}
+    size = 0
+    for job in jobs:
+        krakendir = os.path.dirname(job[2])
+        job_size = uncompressed_size(job[1])
+        if not shards or os.path.dirname(shards[-1][0]) != krakendir \
+           or (shards[-1][1] and size + job_size > shard_size):
+            counts[krakendir] = counts.get(krakendir, 0) + 1
+            shards.append((os.path.join(krakendir, template % counts[krakendir]), []))
+            size = 0
+        shards[-1][1].append(job)
+        size += job_size
+    return shards
+
+
+def write_index(krakendir, index):
+    """ Write the sidecar index of the library shards of a branch. """
+    outfile = open(os.path.join(krakendir, 'library.index.txt'), 'w')
+    outfile.write('#shard\tassembly\taccession\ttaxid\tstart\tend\n')
+    for row in index:
+        outfile.write('%s\t%s\t%s\t%s\t%i\t%i\n' % row)
+    outfile.close()
+
+
+def parse_assemblyfile(branch, genomictypes=["Complete Genome"], dirpath='./genomes/refseq/', krakendir='./kraken', compress=None, seqid_map=False):
     basedir = os.path.join(dirpath, branch)
     fname = 'assembly_summary.txt'
     krakendir = os.path.join(krakendir, branch)
@@ -194,37 +779,136 @@ def parse_assemblyfile(branch, genomictypes=["Complete Genome"], dirpath='./geno
         sys.exit(1)
     else:
         jobs = []
-        # read file, extract ftp paths and download each file
-        oR = csv.reader(load_file(os.path.join(basedir,fname)), delimiter = '\t')
-        d = {}
-        for a in oR:
-            try:
-                assembly_level =  a[11]
-            except:
-                continue
-
-            version_status =  a[10]
-            if version_status != 'latest':
-                continue
-        
-            if assembly_level == 'assembly_level':
-                continue
-            
-            d[assembly_level] = d.get(assembly_level, 0) + 1
-
-            if assembly_level in genomictypes:
-                name     = os.path.basename(a[19]) + '_genomic.fna.gz'
+        # parsed (and cached) column-wise, extract the assemblies to process
+        oSummary = assemblysummary.AssemblySummary(os.path.join(basedir, fname))
+        accessions = oSummary['accession']
+        taxids = oSummary['taxid']
+        species_taxids = oSummary['species_taxid']
+        levels = oSummary['assembly_level']
+        dates = oSummary['seq_rel_date']
+        ftp_paths = oSummary['ftp_path']
+        rows = oSummary.latest()
+        latest = set([accessions[i] for i in rows])
+        d = oSummary.level_stats()
+        for i in rows:
+            if levels[i] in genomictypes:
+                name     = os.path.basename(ftp_paths[i]) + '_genomic.fna.gz'
                 filepath = os.path.join(basedir, name)
-                taxid    = a[5]
+                taxid    = taxids[i]
 
-                if gzip:
-                    fnameTax = name.replace('.fna.gz', '.tax.fna.gz')  # store gziped files
-                else:
-                    fnameTax = name.replace('.fna.gz', '.tax.fna')
+                fnameTax = name.replace('.fna.gz', '.tax.fna')
+                if seqid_map:
+                    fnameTax = os.path.join(MAPS_DIR, name.replace('.fna.gz', '.map'))  # map of the assembly
+                elif compress:
+                    fnameTax += compression.EXTENSIONS[compress]  # store compressed files
 
-                jobs.append((taxid, filepath, os.path.join(krakendir, fnameTax)))
+                # (..., accession, seq_rel_date, ftp_path) are used for the manifest,
+                # assembly level and species tax-id to pick representatives in dedup_jobs()
+                species_taxid = species_taxids[i]
+                if not species_taxid.isdigit():
+                    species_taxid = taxid
+                jobs.append((taxid, filepath, os.path.join(krakendir, fnameTax),
+                             accessions[i], dates[i], ftp_paths[i], levels[i], species_taxid))
         
-    return jobs, d
+    return jobs, d, latest
+
+
+def filter_clade(jobs, clade):
+    """
+    Keep the jobs of assemblies whose tax-id is in clade (a set of tax-ids).
+    """
+    selected = [job for job in jobs if int(job[0]) in clade]
+    sys.stderr.write('Taxon selection: %i of %i assemblies\n' % (len(selected), len(jobs)))
+    return selected
+
+
+def dedup_jobs(jobs, krakendir, max_distance, sketch_size=dedup.SKETCH_SIZE, processes=1):
+    """
+    Deduplicate the assemblies of a branch before the library is built.
+    Within each species (species_taxid of assembly_summary.txt, the tax-id of
+    an assembly is often that of its strain), assemblies within max_distance
+    (Mash distance) of an assembly preferred over them are dropped, preferring
+    the better assembly level, then the larger input file. Of the records
+    left, exact duplicate sequences within a tax-id are kept only once.
+    Duplicates across tax-ids are kept, Kraken resolves them to their LCA
+    anyway.
+
+    Sketches are cached in <krakendir>/sketches/. Output files of dropped
+    assemblies left over from a previous run are removed.
+
+    return (jobs to keep, dropped jobs, {infile-path: set of record indices to skip})
+    """
+    sketchdir = os.path.join(krakendir, 'sketches')
+    if not os.path.exists(sketchdir):
+        os.makedirs(sketchdir)
+    present = [job for job in jobs if os.path.isfile(job[1])]
+    pool = Pool(processes=processes)
+    sketches = pool.map(dedup.cached_sketch,
+                        [(job[1], os.path.join(sketchdir, job[3] + '.sketch'), sketch_size)
+                         for job in present])
+    pool.close()
+
+    dSpecies = {}
+    for job, sketch in zip(present, sketches):
+        dSpecies.setdefault(job[7], []).append((job, sketch))
+
+    dropped = set()
+    dTaxa = {}  # kept assemblies per tax-id, in order of preference
+    for species_taxid in dSpecies:
+        group = dSpecies[species_taxid]
+        group.sort(key=lambda x: (dedup.LEVELS.index(x[0][6]) if x[0][6] in dedup.LEVELS else len(dedup.LEVELS),
+                                  -input_size(x[0][1]),
+                                  x[0][3]))
+        kept, dDropped = dedup.representatives([(job[3], sketch[1]) for job, sketch in group],
+                                               max_distance, sketch_size)
+        dropped.update(dDropped)
+        kept = set(kept)
+        for job, sketch in group:
+            if job[3] in kept:
+                dTaxa.setdefault(job[0], []).append((job, sketch))
+
+    skip = {}
+    for taxid in dTaxa:
+        skip.update(dedup.duplicate_records([(job[1], sketch[0]) for job, sketch in dTaxa[taxid]]))
+
+    jobs_dropped = [job for job in jobs if job[3] in dropped]
+    for job in jobs_dropped:
+        # the converted file, or the map and linked original in --map mode
+        for fname in [job[2], os.path.join(krakendir, os.path.basename(job[1]))]:
+            if os.path.lexists(fname):
+                os.remove(fname)
+    sys.stderr.write('Deduplication: kept %i of %i assemblies, %i duplicate records skipped\n'
+                     % (len(jobs) - len(jobs_dropped), len(jobs),
+                        sum([len(indices) for indices in skip.values()])))
+    return [job for job in jobs if job[3] not in dropped], jobs_dropped, skip
+
+
+def filter_manifest(krakendir, jobs, latest):
+    """
+    Diff the jobs of a branch against the manifest of previously processed
+    files. Jobs whose output file is current are dropped and the output files
+    of retired assemblies are removed.
+
+    return (jobs still to process, manifest of the branch)
+    """
+    dManifest = manifest.load_manifest(os.path.join(krakendir, manifest.FNAME))
+    records = {}
+    for job in jobs:
+        records[job[3]] = (job[4], job[5], job[2])
+    new, changed, current, retired = manifest.diff_manifest(dManifest, records, latest)
+
+    for accession in retired:
+        name = os.path.basename(dManifest[accession]['ftp_path']) + '_genomic'
+        fnames = [name + '.tax.fna', os.path.join(MAPS_DIR, name + '.map'), name + '.fna.gz']
+        for fname in fnames + [name + '.tax.fna' + ext for ext in set(compression.EXTENSIONS.values())]:
+            if os.path.isfile(os.path.join(krakendir, fname)):
+                os.remove(os.path.join(krakendir, fname))
+        del dManifest[accession]
+
+    sys.stderr.write('%s: %i new, %i changed, %i current, %i retired assemblies\n'
+                     % (krakendir, len(new), len(changed), len(current), len(retired)))
+    current = set(current)
+    return [job for job in jobs if job[3] not in current], dManifest
 
 
 def main():
@@ -237,18 +921,100 @@ def main():
     process_number = args.process_number
     if process_number < 1:
         parser.error('-p has to be > 0: EXIT.')
+    if args.threads < 1:
+        parser.error('--threads has to be > 0: EXIT.')
+    if args.gzip and not args.compress:
+        args.compress = 'bgzf'
+    if args.compress == 'zstd' and not compression.zstd_available():
+        parser.error('zstd output needs the zstandard module or the zstd tool: EXIT.')
+    if args.decompress != 'auto' and not compression.input_available(args.decompress):
+        parser.error('--decompress %s is not available: EXIT.' % args.decompress)
+    if args.str_shard_size:
+        try:
+            shard_size = parse_size(args.str_shard_size)
+        except ValueError:
+            parser.error('-s has to be a size like 500M or 4G: EXIT.')
+        if shard_size < 1:
+            parser.error('-s has to be > 0: EXIT.')
+        if args.incremental:
+            parser.error('-i can not be combined with -s: EXIT.')
+    if args.seqid_map:
+        if args.str_shard_size:
+            parser.error('-m can not be combined with -s: EXIT.')
+        if args.compress:
+            parser.error('-m writes no sequences, it can not be combined with -z/-c: EXIT.')
+
+    if args.dedup:
+        if dedup.numpy is None:
+            parser.error('--dedup needs numpy: EXIT.')
+        if args.dedup_distance < 0:
+            parser.error('--dedup-distance has to be >= 0: EXIT.')
+        if args.sketch_size < 1:
+            parser.error('--sketch-size has to be > 0: EXIT.')
+
+    mask = None
+    if args.dust or args.max_n_run is not None:
+        if masking.numpy is None:
+            parser.error('--dust and --max-n-run need numpy: EXIT.')
+        if args.seqid_map:
+            parser.error('-m writes no sequences, it can not be combined with --dust or --max-n-run: EXIT.')
+        if args.max_n_run is not None and args.max_n_run < 1:
+            parser.error('--max-n-run has to be > 0: EXIT.')
+        if args.dust:
+            mask = (args.dust_threshold, args.max_n_run)
+        else:
+            mask = (None, args.max_n_run)
+
+    clade = None
+    if args.str_taxon:
+        if not args.str_nodes or not os.path.isfile(args.str_nodes):
+            parser.error('--taxon needs nodes.dmp, use --nodes: EXIT.')
+        try:
+            taxa = [int(s) for s in args.str_taxon.split(',')]
+        except ValueError:
+            parser.error('--taxon has to be tax-ids separated by comma: EXIT.')
+        oNodes = taxonomy.NodesTable(args.str_nodes)
+        for tax in taxa:
+            if tax not in oNodes:
+                parser.error('tax-id %i not found in %s: EXIT.' % (tax, args.str_nodes))
+        clade = oNodes.clade(taxa)
 
     job_list = []
+    dManifests = {}
+    dSkip = {}
+    dMaps = {}  # krakendir => maps of all selected assemblies, in --map mode
     for branch in branches:
-        job_list_br, dStats = parse_assemblyfile(branch,
-                                                 types,
-                                                 dirpath,
-                                                 args.str_kraken,
-                                                 args.gzip)
+        job_list_br, dStats, latest = parse_assemblyfile(branch,
+                                                         types,
+                                                         dirpath,
+                                                         args.str_kraken,
+                                                         args.compress,
+                                                         args.seqid_map)
+        if clade is not None and not args.assemblystats:
+            job_list_br = filter_clade(job_list_br, clade)
+        if args.dedup and not args.assemblystats:
+            job_list_br, dropped, skip = dedup_jobs(job_list_br,
+                                                    os.path.join(args.str_kraken, branch),
+                                                    args.dedup_distance,
+                                                    args.sketch_size,
+                                                    process_number)
+            dSkip.update(skip)
+            if args.seqid_map and skip:
+                sys.stderr.write('Deduplication: -m links the original files, duplicate records are kept\n')
+        if args.seqid_map:
+            dMaps[os.path.join(args.str_kraken, branch)] = [job[2] for job in job_list_br]
+        if args.incremental and not args.assemblystats:
+            krakendir = os.path.join(args.str_kraken, branch)
+            job_list_br, dManifests[krakendir] = filter_manifest(krakendir,
+                                                                 job_list_br,
+                                                                 latest)
+            if args.dedup:
+                # dropped assemblies are no longer part of the library
+                for job in dropped:
+                    dManifests[krakendir].pop(job[3], None)
         job_list += job_list_br
         if args.assemblystats:
-            status = dStats.keys()
-            status.sort()
+            status = sorted(dStats)
             sys.stdout.write('Branch: %s\n'%branch)
             for s in status:
                 sys.stdout.write('%s\t%i\n' %(s,dStats[s]))
@@ -257,6 +1023,8 @@ def main():
             if not os.path.exists(os.path.join(args.str_kraken, branch)):
                 sys.stdout.write('Make directory for kraken-files: %s\n'%(os.path.join(args.str_kraken, branch)))
                 os.makedirs(os.path.join(args.str_kraken, branch))
+            if args.seqid_map and not os.path.exists(os.path.join(args.str_kraken, branch, MAPS_DIR)):
+                os.makedirs(os.path.join(args.str_kraken, branch, MAPS_DIR))
 
     # exit if only stats should be displayed
     if args.assemblystats:
@@ -267,45 +1035,81 @@ def main():
     #-------------------------------------------------------------------------
     # For timing
     start_time = timer()  # very crude timing
+    runlog = instrument.RunLog(args.str_log, 'getKrakenFna.py')
     # create pool of workers ---------------------
-    pool = Pool(processes=process_number)
-
-    # "chunksize"" usually only makes a noticable performance
-    # difference for very large iterables
-    # Here I set it to 1 to get the progress bar working nicly
-    # Otherwise it will not give the correct number of processes left
-    # to process but rather the chunksize number.
-    chunksize = 1
-    result_list = pool.map_async(my_func, job_list, chunksize=chunksize)
+    pool = Pool(processes=process_number,
+                initializer=init_worker,
+                initargs=(args.compress, args.compress_level, args.threads, dSkip, mask,
+                          compression.input_method(args.decompress)))
+
+    if args.str_shard_size:
+        # each shard is written by one worker, largest first
+        shards = make_shards(job_list, shard_size, args.compress)
+        work = [(sum([input_size(job[1]) for job in jobs]), (shard, jobs)) for shard, jobs in shards]
+        work.sort(key=lambda x: x[0], reverse=True)
+        work_func = my_shard_func
+        # remove shards of a previous run
+        for branch in branches:
+            for fname in glob.glob(os.path.join(args.str_kraken, branch, 'library_*.fna*')):
+                os.remove(fname)
+    else:
+        # largest assemblies first, small ones packed into larger units
+        work = make_units(job_list, process_number)
+        if args.seqid_map:
+            work_func = my_map_unit_func
+        else:
+            work_func = my_unit_func
+
+    # results come back as they complete, the progress follows the bytes
+    # of input, as the assemblies differ in size by orders of magnitude
+    result_iter = pool.imap_unordered(my_sized_func,
+                                      [(work_func, size, item) for size, item in work])
     pool.close()  # No more work
 
-    jobs_total = len(job_list)
-    # Progress bar
-    #==============================
-    # This can be changed to make progressbar bigger or smaller
-    progress_bar_length = 50
-    #==============================
-    while not result_list.ready():
-        num_not_done = result_list._number_left
-        num_done = jobs_total - num_not_done
-        num_bar_done = num_done * progress_bar_length / jobs_total
-        bar_str = ('=' * num_bar_done).ljust(progress_bar_length)
-        percent = int(num_done * 100 / jobs_total)
-        sys.stderr.write("JOBS (%s): [%s] (%s) %s%%\r" % (str(num_not_done).rjust(len(str(jobs_total))),
-                                                          bar_str,
-                                                          str(num_done).rjust(len(str(jobs_total))),
-                                                          str(percent).rjust(3)))
-
-        sys.stderr.flush()
-        time.sleep(1)  # wait a bit: here we test every sec
-    # Finish the progress bar
-    bar_str = '=' * progress_bar_length
-    sys.stderr.write("JOBS (%s): [%s] (%i) 100%%\n" % ('0'.rjust(len(str(jobs_total))),
-                                                       bar_str,
-                                                       jobs_total))
-    #result_list = result_list.get()
+    progress = instrument.Progress(len(job_list), sum([size for size, item in work]))
+    progress.write()
+    results = []
+    for size, result in result_iter:
+        results.append(result)
+        if args.str_shard_size:
+            job_stats = result[2]
+        else:
+            job_stats = [(job, stats) for job, res, stats in result]
+        for job, stats in job_stats:
+            runlog.job('convert', os.path.basename(job[1]), stats, accession=job[3])
+        progress.update(len(job_stats), size)
+    progress.finish()
     # --------------------------------------------
 
+    if args.str_shard_size:
+        dIndex = {}
+        for shard, index, stats in results:
+            krakendir = os.path.dirname(shard[0])
+            dIndex[krakendir] = dIndex.get(krakendir, []) + index
+        for krakendir in dIndex:
+            # shards complete in any order
+            write_index(krakendir, sorted(dIndex[krakendir], key=lambda row: (row[0], row[4])))
+
+    for krakendir in dMaps:
+        merge_maps(krakendir, dMaps[krakendir])
+
+    if args.incremental:
+        # record the processed files in the manifests
+        done = [job for unit in results for job, res, stats in unit if res == 1]
+        pool = Pool(processes=process_number)
+        entries = pool.map(manifest.make_entry,
+                           [(job[3], job[4], job[5], job[2]) for job in done])
+        pool.close()
+        for job, entry in zip(done, entries):
+            if entry is not None:
+                krakendir = os.path.dirname(job[2])
+                if args.seqid_map:  # the maps are in MAPS_DIR of the branch
+                    krakendir = os.path.dirname(krakendir)
+                dManifests[krakendir][job[3]] = entry
+        for krakendir in dManifests:
+            manifest.write_manifest(os.path.join(krakendir, manifest.FNAME), dManifests[krakendir])
+
+    runlog.close()
     end_time = timer()
     sys.stderr.write('PROCESS-TIME: %.1f sec\nDONE.\n\n' % (end_time - start_time))
 
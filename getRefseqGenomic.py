@@ -24,19 +24,22 @@ LICENCE
 template version: 1.6 (2016/11/09)
 """
 from timeit import default_timer as timer
-from multiprocessing import Pool
+from multiprocessing import Pool, cpu_count
+from multiprocessing.pool import ThreadPool
 import sys
 import os
 import os.path
 import argparse
-import csv
-import gzip
-import bz2
-import zipfile
 import urllib
-import hashlib
-import subprocess
+import threading
 import time
+import manifest
+import assemblysummary
+import taxonomy
+import transport
+import instrument
+import getKrakenFna
+import compression
 
 
 __version__ = '0.0.1'
@@ -47,7 +50,7 @@ __author__ = 'Sebastian Schmeier'
 
 def parse_cmdline():
     """ Parse command-line args. """
-    description = 'Download fasta-genomic sequences from ncbi using rsync.'
+    description = 'Download fasta-genomic sequences from ncbi using rsync or https.'
     version = 'version %s, date %s' % (__version__, __date__)
     epilog = 'Copyright %s (%s)' % (__author__, __email__)
 
@@ -73,6 +76,22 @@ def parse_cmdline():
         default="Complete Genome",
         help='Assembly - level of genomic sequences to include, separated by comma. For example: Chromosome,Contig,Scaffold. [default="Complete Genome"]')
 
+    parser.add_argument(
+        '--taxon',
+        dest='str_taxon',
+        metavar='TAXIDS',
+        type=str,
+        default=None,
+        help='Only download the assemblies of these clades: tax-ids separated by comma, each selecting itself and all tax-ids below it, e.g. 543 for all Enterobacteriaceae. Needs --nodes. [default: all]')
+
+    parser.add_argument(
+        '--nodes',
+        dest='str_nodes',
+        metavar='FILE',
+        type=str,
+        default=None,
+        help='Kraken taxonomy nodes.dmp file for --taxon.')
+
     parser.add_argument('-a',
         '--assembly',
         dest='assemblystats',
@@ -80,6 +99,92 @@ def parse_cmdline():
         action='store_true',
         help='Print assembly stats for branches and exits.')
 
+    parser.add_argument('-B',
+        '--batch',
+        dest='batch',
+        default=False,
+        action='store_true',
+        help='Batched transfers: group files by ftp-directory prefix and move each group with a few long-lived sessions (rsync --files-from, or one kept-alive https connection) instead of one call per file.')
+
+    parser.add_argument(
+        '--batch-size',
+        dest='batch_size',
+        metavar='INT',
+        type=int,
+        default=1000,
+        help='Number of files transferred per session in --batch mode. [default: 1000]')
+
+    parser.add_argument('-i',
+        '--incremental',
+        dest='incremental',
+        default=False,
+        action='store_true',
+        help='Incremental refresh: diff assembly_summary.txt against the manifest of previous downloads and only transfer new or changed assemblies. Files of retired assemblies (no longer "latest") are removed.')
+
+    parser.add_argument('-t',
+        '--transport',
+        dest='transport',
+        choices=transport.TRANSPORTS,
+        default='rsync',
+        help='Transport used for the downloads. https reuses connections across files, resumes partial downloads and verifies files against md5checksums.txt. [default: rsync]')
+
+    parser.add_argument(
+        '--base-url',
+        dest='base_url',
+        metavar='URL',
+        type=str,
+        default=None,
+        help='Base url of the ncbi ftp-server or a mirror of it (for rsync also a local directory). [default: rsync://ftp.ncbi.nlm.nih.gov or https://ftp.ncbi.nlm.nih.gov]')
+
+    parser.add_argument(
+        '--verify',
+        dest='verify',
+        default=False,
+        action='store_true',
+        help='Verify the downloaded files against the md5checksums.txt of their assemblies and download mismatching files again. Files are hashed by -p processes, digests are cached in md5cache.txt by size and mtime, so unchanged files are not hashed again.')
+
+    parser.add_argument(
+        '--log',
+        dest='str_log',
+        metavar='FILE',
+        type=str,
+        default=None,
+        help='Append a machine-readable run log (JSON lines) to FILE: wall time, bytes and failure reason of each download (and conversion) and the totals of the run.')
+
+    group2 = parser.add_argument_group('Pipeline',
+                                       'Convert genomes for Kraken while downloading:')
+
+    group2.add_argument('-k',
+        '--kraken',
+        dest='str_kraken',
+        metavar='DIR',
+        type=str,
+        default=None,
+        help='Hand each genome to a conversion process as soon as its download completed and write its Kraken-ready fasta-file (as getKrakenFna.py does) to DIR/<branch>.')
+
+    group2.add_argument(
+        '--convert-processes',
+        dest='convert_processes',
+        metavar='INT',
+        type=int,
+        default=1,
+        help='Number of conversion processes in -k mode. [default: 1]')
+
+    group2.add_argument(
+        '--queue-size',
+        dest='queue_size',
+        metavar='INT',
+        type=int,
+        default=16,
+        help='Maximum number of downloads (or batches with -B) waiting for conversion in -k mode. Further downloads only start once the conversions caught up. [default: 16]')
+
+    group2.add_argument(
+        '--drop-raw',
+        dest='drop_raw',
+        default=False,
+        action='store_true',
+        help='Remove the downloaded .fna.gz-file once it is converted in -k mode.')
+
     group1 = parser.add_argument_group('Threading',
                                        'Multithreading arguments:')
 
@@ -91,9 +196,39 @@ def parse_cmdline():
         dest='process_number',
         default=1,
         help=
-        'Number of sub-processes (concurrent downloads) to use.'+\
-        ' It is only logical to not give more processes'+\
-        ' than cpus/cores are available. [default: 1]')
+        'Number of concurrent downloads. Downloads run on threads of'+\
+        ' one process that wait for the network, so this is not bound'+\
+        ' to the number of cpus/cores. [default: 1]')
+
+    group1.add_argument(
+        '--rate',
+        metavar='FLOAT',
+        type=float,
+        dest='rate',
+        default=0.0,
+        help=
+        'Maximum number of transfers started per second per host,'+\
+        ' 0 for no limit. At 5, ~70000 single-file transfers take'+\
+        ' at least ~3.9 h, whatever -p is. [default: 0]')
+
+    group1.add_argument(
+        '--retries',
+        metavar='INT',
+        type=int,
+        dest='retries',
+        default=3,
+        help=
+        'Number of retries of a failed transfer. [default: 3]')
+
+    group1.add_argument(
+        '--backoff',
+        metavar='SEC',
+        type=float,
+        dest='backoff',
+        default=10.0,
+        help=
+        'Wait before the first retry of a failed transfer, doubled with'+\
+        ' each further retry. [default: 10]')
 
     # if no arguments supplied print help
     if len(sys.argv)==1:
@@ -104,16 +239,20 @@ def parse_cmdline():
     return args, parser
 
 
+# transport of the downloads and verification of the downloaded files
+# (--verify), set in main()
+TRANSPORT = None
+VERIFIER = None
+# retcode of a downloaded file that does not match its md5 checksum
+CORRUPT = -1
+
+
 def load_file(filename):
     """ LOADING FILES """
     if filename in ['-', 'stdin']:
         filehandle = sys.stdin
-    elif filename.split('.')[-1] == 'gz':
-        filehandle = gzip.open(filename)
-    elif filename.split('.')[-1] == 'bz2':
-        filehandle = bz2.BZFile(filename)
-    elif filename.split('.')[-1] == 'zip':
-        filehandle = zipfile.Zipfile(filename)
+    elif filename.split('.')[-1] in ['gz', 'bz2', 'zip']:
+        filehandle = compression.open_input(filename)
     else:
         filehandle = open(filename)
     return filehandle
@@ -125,50 +264,399 @@ def my_func(args):
     This function could be distributed to the cores requested.
     # do stuff
     Here we download a file, get a status and adjust fasta-header
-    return (args, res)
+    return (args, res, stats)
     """
     fname = args[0]
     dnlurl = args[1]
     dest_dir = args[2]
-    rsync_cmd = "rsync --times --copy-links --partial -aq %s %s"
-    retcode = subprocess.call(rsync_cmd % (dnlurl, dest_dir), shell=True)
-    return (args, retcode)
+    start = timer()
+    # with --verify the files are checked by the VERIFIER instead
+    retcode = TRANSPORT.fetch(dnlurl, dest_dir, verify=VERIFIER is None)
+    if retcode == 0 and VERIFIER is not None:
+        retcode = VERIFIER.check([args])[0]
+    return (args, retcode, download_stats(start, os.path.join(dest_dir, fname), retcode))
+
+
+def download_stats(start, filepath, retcode):
+    """ Stats of a download that started at start (timer()). """
+    if retcode == CORRUPT:
+        return instrument.job_stats(start, error='md5 mismatch')
+    elif retcode != 0:
+        return instrument.job_stats(start, error=TRANSPORT.describe(retcode))
+    if os.path.isfile(filepath):
+        return instrument.job_stats(start, bytes_in=os.path.getsize(filepath))
+    return instrument.job_stats(start)
+
+
+class Verifier(object):
+    """
+    --verify: check downloaded files against the md5checksums.txt of their
+    assembly directories. The download threads check each download (or
+    batch) right after its transfer, so verified genomes go on to conversion
+    at once and mismatching files are retried like failed transfers. The
+    checksum files of a batch are fetched in one session of the transport and
+    the files are hashed by a pool of processes. Digests are taken from the
+    digest cache (and the manifest) of a directory as long as size and mtime
+    of a file are unchanged.
+    """
+    def __init__(self, dest_dirs, processes=1):
+        # fork before any download thread runs
+        self.pool = Pool(processes=min(processes, cpu_count()))
+        self.lock = threading.Lock()
+        self.verified = 0
+        self.mismatched = 0
+        self.unverified = 0
+        self.digests = {}
+        for dest_dir in dest_dirs:
+            self.digests[dest_dir] = manifest.load_digests(os.path.join(dest_dir, manifest.DIGESTS_FNAME))
+            # the manifest of incremental runs holds digests as well
+            dManifest = manifest.load_manifest(os.path.join(dest_dir, manifest.FNAME))
+            for entry in dManifest.values():
+                name = os.path.basename(entry['ftp_path']) + '_genomic.fna.gz'
+                self.digests[dest_dir].setdefault(name, (entry['size'], entry['mtime'], entry['md5']))
+
+    def check(self, jobs):
+        """
+        Verify the downloaded files of jobs that share an ftp-directory
+        prefix. Files that do not match are removed.
+        return [0 or CORRUPT, ...] per job, 0 as well if there is no checksum
+        """
+        if not jobs:
+            return []
+        prefix = split_url(jobs[0][1])[0]
+        upstream = TRANSPORT.fetch_md5sums_many(prefix,
+                                                [os.path.dirname(split_url(job[1])[1]) for job in jobs])
+        local = {}  # filepath => md5
+        to_hash = []
+        self.lock.acquire()
+        for job in jobs:
+            filepath = os.path.join(job[2], job[0])
+            md5 = manifest.cached_md5(self.digests.setdefault(job[2], {}), filepath)
+            if md5 is not None:
+                local[filepath] = md5
+            elif os.path.isfile(filepath):
+                to_hash.append(filepath)
+        self.lock.release()
+        for filepath, size, mtime, md5 in self.pool.map(manifest.file_digest, to_hash):
+            local[filepath] = md5
+            self.lock.acquire()
+            self.digests[os.path.dirname(filepath)][os.path.basename(filepath)] = (size, mtime, md5)
+            self.lock.release()
+
+        retcodes = []
+        self.lock.acquire()
+        for job, md5sums in zip(jobs, upstream):
+            filepath = os.path.join(job[2], job[0])
+            md5 = (md5sums or {}).get(job[0], None)
+            if md5 is None or filepath not in local:
+                self.unverified += 1
+                retcodes.append(0)
+            elif md5 == local[filepath]:
+                self.verified += 1
+                retcodes.append(0)
+            else:
+                self.mismatched += 1
+                retcodes.append(CORRUPT)
+                os.remove(filepath)
+                del self.digests[job[2]][job[0]]
+                sys.stderr.write('ERROR: %s: md5 mismatch\n' % job[1])
+        self.lock.release()
+        return retcodes
+
+    def close(self):
+        """ Write the digest caches. """
+        self.pool.close()
+        self.pool.join()
+        for dest_dir in self.digests:
+            manifest.write_digests(os.path.join(dest_dir, manifest.DIGESTS_FNAME), self.digests[dest_dir])
+        sys.stderr.write('Verification: %i verified, %i mismatching (downloaded again), %i without checksum\n'
+                         % (self.verified, self.mismatched, self.unverified))
+
+
+def retry_download(job, result):
+    """ The job again if its transfer failed for a reason worth retrying. """
+    if TRANSPORT.retryable(result[1]):
+        return job
+    return None
+
+
+def retry_batch(batch, results):
+    """
+    A batch of the files of a batch whose transfer failed for a reason worth
+    retrying, None if there are none.
+    """
+    jobs = [job for job, retcode, stats in results if TRANSPORT.retryable(retcode)]
+    if not jobs:
+        return None
+    return (batch[0], batch[1], jobs)
+
+
+def merge_batch(results, new_results):
+    """ Results of a batch with those of the retried files replaced. """
+    dNew = dict([(result[0][4], result) for result in new_results])
+    return [dNew.get(result[0][4], result) for result in results]
+
+
+def split_url(dnlurl):
+    """
+    Split a download url into the prefix shared by many assemblies,
+    e.g. rsync://ftp.ncbi.nlm.nih.gov/genomes/all/, and the file path
+    relative to it.
+    """
+    idx = dnlurl.find('/all/')
+    if idx == -1:
+        prefix = os.path.dirname(os.path.dirname(dnlurl)) + '/'
+    else:
+        prefix = dnlurl[:idx + len('/all/')]
+    return prefix, dnlurl[len(prefix):]
+
+
+def make_batches(jobs, batch_size=1000):
+    """
+    Group jobs by ftp-directory prefix and destination and cut each group into
+    batches of at most batch_size files.
+    return [(prefix, dest_dir, [job, ...]), ...]
+    """
+    groups = {}
+    keys = []
+    for job in jobs:
+        key = (split_url(job[1])[0], job[2])
+        if key not in groups:
+            groups[key] = []
+            keys.append(key)
+        groups[key].append(job)
+
+    batches = []
+    for key in keys:
+        group = groups[key]
+        for i in range(0, len(group), batch_size):
+            batches.append((key[0], key[1], group[i:i + batch_size]))
+    return batches
+
+
+def my_batch_func(args):
+    """
+    Transfer a batch of files in one session of the transport (one rsync
+    --files-from session, or one kept-alive https connection).
+    args = (prefix, dest_dir, [job, ...])
+
+    The wall time in the stats of each file is that of the whole batch.
+    return [(job, retcode, stats), ...]
+    """
+    prefix, dest_dir, jobs = args
+    start = timer()
+    retcodes = TRANSPORT.fetch_many(prefix,
+                                    [split_url(job[1])[1] for job in jobs],
+                                    dest_dir,
+                                    verify=VERIFIER is None)
+    if VERIFIER is not None:
+        done = [i for i, retcode in enumerate(retcodes) if retcode == 0]
+        for i, retcode in zip(done, VERIFIER.check([jobs[i] for i in done])):
+            retcodes[i] = retcode
+    results = []
+    for job, retcode in zip(jobs, retcodes):
+        stats = download_stats(start, os.path.join(dest_dir, job[0]), retcode)
+        stats['batch'] = len(jobs)
+        results.append((job, retcode, stats))
+    return results
+
+
+def my_convert_func(args):
+    """
+    Work function of the pipeline mode: convert a downloaded genome with the
+    work function of getKrakenFna.py.
+    args = (job, kraken-file path, drop_raw)
+
+    Errors are reported instead of raised, so that the pipeline never waits
+    for a conversion that died.
+    return (job, res, stats), res is 1 if converted
+    """
+    job, outpath, drop_raw = args
+    filepath = os.path.join(job[2], job[0])
+    start = timer()
+    try:
+        conv_args, res, stats = getKrakenFna.my_func((job[7], filepath, outpath, job[4], job[5], job[6]))
+    except Exception as e:
+        sys.stderr.write('ERROR: converting %s: %s\n' % (filepath, e))
+        return (job, 0, instrument.job_stats(start, error=str(e)))
+    if drop_raw and res == 1:
+        os.remove(filepath)
+    return (job, res, stats)
+
+
+class ConversionPipeline(object):
+    """
+    Pipeline mode: downloaded genomes are converted by a pool of processes
+    while the download threads carry on. At most queue_size downloads (or
+    batches) are downloaded but not yet converted: a download takes a slot
+    before it starts and the slot is freed once its genomes are converted.
+    """
+    def __init__(self, krakendir, processes=1, queue_size=16, drop_raw=False):
+        self.krakendir = krakendir
+        self.drop_raw = drop_raw
+        # fork before any download thread runs
+        self.pool = Pool(processes=processes)
+        self.slots = threading.BoundedSemaphore(queue_size)
+        self.results = []
+
+    def outpath(self, job):
+        """ Path of the Kraken-ready file of a job. """
+        return os.path.join(self.krakendir, job[3], job[0].replace('.fna.gz', '.tax.fna'))
+
+    def submit(self, jobs):
+        """ Queue the conversion of the downloaded jobs of one download. """
+        if not jobs:
+            self.slots.release()
+            return
+        self.results.append(self.pool.map_async(my_convert_func,
+                                                [(job, self.outpath(job), self.drop_raw) for job in jobs],
+                                                chunksize=1,
+                                                callback=self._converted))
+
+    def _converted(self, results):
+        self.slots.release()
+
+    def finish(self):
+        """
+        Wait for all conversions.
+        return [(job, res, stats), ...]
+        """
+        self.pool.close()
+        self.pool.join()
+        results = []
+        for result in self.results:
+            results += result.get()
+        return results
+
+
+def url_host(url):
+    """ Host part of a url, e.g. ftp.ncbi.nlm.nih.gov. """
+    return url.split('://', 1)[-1].split('/', 1)[0]
+
+
+class DownloadScheduler(object):
+    """
+    Run download jobs on a pool of threads. Each thread only waits for its
+    transfer, so many concurrent transfers are cheap.
+    Transfer starts are limited to rate per second and host, and failed
+    transfers are retried with exponential backoff. What is retried is up to
+    the caller, e.g. only the failed files of a batch, and nothing after a
+    permanent error.
+    """
+    def __init__(self, concurrency=1, rate=0.0, retries=3, backoff=10.0):
+        self.pool = ThreadPool(concurrency)
+        self.rate = rate
+        self.retries = retries
+        self.backoff = backoff
+        self.lock = threading.Lock()
+        self.next_start = {}  # host => earliest time of the next transfer start
+
+    def wait_turn(self, host):
+        """ Block until a transfer to host may start. """
+        if self.rate <= 0:
+            return
+        self.lock.acquire()
+        now = time.time()
+        start = max(now, self.next_start.get(host, now))
+        self.next_start[host] = start + 1.0 / self.rate
+        self.lock.release()
+        if start > now:
+            time.sleep(start - now)
+
+    def run_job(self, func, job, host, retry, merge=None):
+        """ Run func(job) with rate limit and retries. """
+        self.wait_turn(host)
+        result = func(job)
+        for attempt in range(self.retries):
+            job = retry(job, result)
+            if job is None:
+                break
+            time.sleep(self.backoff * 2 ** attempt)
+            self.wait_turn(host)
+            if merge is None:
+                result = func(job)
+            else:
+                result = merge(result, func(job))
+        return result
+
+    def imap_unordered(self, func, jobs, host_func, retry, slots=None, merge=None):
+        """
+        Run func on all jobs, results are returned as they complete.
+        host_func(job) gives the host a job connects to. retry(job, result)
+        gives what has to be run again, None if nothing, and merge(result,
+        result of the retry) combines the results of the attempts (default:
+        the last result). If given, a job waits for one of the slots (a
+        semaphore) before it starts.
+        """
+        def run(job):
+            if slots is not None:
+                slots.acquire()
+            return self.run_job(func, job, host_func(job), retry, merge)
+        results = self.pool.imap_unordered(run, jobs)
+        self.pool.close()  # No more work
+        return results
 
 
 def parse_assemblyfile(branch, genomictypes=["Complete Genome"], dest_dir='genomes'):
     fname = 'genomes/refseq/%s/assembly_summary.txt' % branch
-    url = 'rsync://ftp.ncbi.nlm.nih.gov/%s' %(fname)
+    url = TRANSPORT.url(fname)
+    retcode = TRANSPORT.fetch(url, os.path.dirname(fname), verify=False)
 
-    rsync_cmd = "rsync -R --times --copy-links --partial -aq %s %s"
-    retcode = subprocess.call(rsync_cmd % (url, dest_dir), shell=True)
-   
     jobs = []
-    # read file, extract ftp paths and download each file
-    oR = csv.reader(load_file(fname), delimiter = '\t')
-    d = {}
-    for a in oR:
-        
-        try:
-            assembly_level =  a[11]
-        except:
-            continue
+    # parsed (and cached) column-wise, extract ftp paths and download each file
+    oSummary = assemblysummary.AssemblySummary(fname)
+    accessions = oSummary['accession']
+    levels = oSummary['assembly_level']
+    dates = oSummary['seq_rel_date']
+    ftp_paths = oSummary['ftp_path']
+    taxids = oSummary['taxid']
+    rows = oSummary.latest()
+    latest = set([accessions[i] for i in rows])
+    d = oSummary.level_stats()
+    for i in rows:
+        if levels[i] in genomictypes:
+            ftp_path = ftp_paths[i]
+            name     = os.path.basename(ftp_path) + '_genomic.fna.gz'
+            dnlurl   = TRANSPORT.url(os.path.join(ftp_path, name))
+            # (..., accession, seq_rel_date, ftp_path) are used for the manifest,
+            # taxid for the conversion in pipeline mode
+            jobs.append((name, dnlurl, 'genomes/refseq/%s' % branch, branch,
+                         accessions[i], dates[i], ftp_path, taxids[i]))
+    return jobs, retcode, d, latest
 
-        version_status =  a[10]
-        if version_status != 'latest':
-            continue
-    
-        if assembly_level == 'assembly_level':
-            continue
 
-        d[assembly_level] = d.get(assembly_level, 0) + 1
+def filter_clade(jobs, clade):
+    """
+    Keep the jobs of assemblies whose tax-id is in clade (a set of tax-ids).
+    """
+    selected = [job for job in jobs if int(job[7]) in clade]
+    sys.stderr.write('Taxon selection: %i of %i assemblies\n' % (len(selected), len(jobs)))
+    return selected
 
-        if assembly_level in genomictypes:
-            ftp_path = a[19]
-            name     = os.path.basename(ftp_path) + '_genomic.fna.gz'
-            dnlurl   = os.path.join(ftp_path, name)
-            dnlurl = dnlurl.replace('ftp://', 'rsync://')
-            jobs.append((name, dnlurl, 'genomes/refseq/%s' % branch, branch))
-    return jobs, retcode, d
+
+def filter_manifest(dest_dir, jobs, latest):
+    """
+    Diff the jobs of a branch against the manifest of previous downloads.
+    Jobs whose local file is current are dropped and the files of retired
+    assemblies are removed.
+
+    return (jobs still to transfer, manifest of the branch)
+    """
+    dManifest = manifest.load_manifest(os.path.join(dest_dir, manifest.FNAME))
+    records = {}
+    for job in jobs:
+        records[job[4]] = (job[5], job[6], os.path.join(job[2], job[0]))
+    new, changed, current, retired = manifest.diff_manifest(dManifest, records, latest)
+
+    for accession in retired:
+        name = os.path.basename(dManifest[accession]['ftp_path']) + '_genomic.fna.gz'
+        transport.remove_download(os.path.join(dest_dir, name))
+        del dManifest[accession]
+
+    sys.stderr.write('%s: %i new, %i changed, %i current, %i retired assemblies\n'
+                     % (dest_dir, len(new), len(changed), len(current), len(retired)))
+    current = set(current)
+    return [job for job in jobs if job[4] not in current], dManifest
 
 
 def main():
@@ -178,17 +666,52 @@ def main():
     process_number = args.process_number
     if process_number < 1:
         parser.error('-p has to be > 0: EXIT.')
+    if args.retries < 0:
+        parser.error('--retries has to be >= 0: EXIT.')
+    if args.str_kraken:
+        if args.convert_processes < 1:
+            parser.error('--convert-processes has to be > 0: EXIT.')
+        if args.queue_size < 1:
+            parser.error('--queue-size has to be > 0: EXIT.')
+        if args.drop_raw and args.incremental:
+            parser.error('--drop-raw can not be combined with -i, the manifest needs the downloaded files: EXIT.')
+    elif args.drop_raw:
+        parser.error('--drop-raw needs -k: EXIT.')
+
+    global TRANSPORT, VERIFIER
+    TRANSPORT = transport.make_transport(args.transport, args.base_url)
 
     branches = [s.strip() for s in args.str_branch.split(',')]
     types = [s.strip() for s in args.str_level.split(',')]
 
+    clade = None
+    if args.str_taxon:
+        if not args.str_nodes or not os.path.isfile(args.str_nodes):
+            parser.error('--taxon needs nodes.dmp, use --nodes: EXIT.')
+        try:
+            taxa = [int(s) for s in args.str_taxon.split(',')]
+        except ValueError:
+            parser.error('--taxon has to be tax-ids separated by comma: EXIT.')
+        oNodes = taxonomy.NodesTable(args.str_nodes)
+        for tax in taxa:
+            if tax not in oNodes:
+                parser.error('tax-id %i not found in %s: EXIT.' % (tax, args.str_nodes))
+        clade = oNodes.clade(taxa)
+
     job_list = []
+    dManifests = {}
     for branch in branches:
-        job_list_branch, retcode, dStats = parse_assemblyfile(branch, types, 'genomes')
+        job_list_branch, retcode, dStats, latest = parse_assemblyfile(branch, types, 'genomes')
+        if clade is not None and not args.assemblystats:
+            job_list_branch = filter_clade(job_list_branch, clade)
+        if args.incremental and not args.assemblystats:
+            dest_dir = 'genomes/refseq/%s' % branch
+            job_list_branch, dManifests[dest_dir] = filter_manifest(dest_dir,
+                                                                    job_list_branch,
+                                                                    latest)
         job_list += job_list_branch
         if args.assemblystats:
-            status = dStats.keys()
-            status.sort()
+            status = sorted(dStats)
             sys.stdout.write('Branch: %s\n'%branch)
             for s in status:
                 sys.stdout.write('%s\t%i\n' %(s,dStats[s]))
@@ -201,33 +724,89 @@ def main():
     # MULTITHREADING
     #-------------------------------------------------------------------------
     start_time = timer()  # very crude timing
-    # create pool of workers ---------------------
-    pool = Pool(processes = process_number)
-    result_list = pool.map_async(my_func, job_list, chunksize=1)  # chunksize=1 for correct progressbar
-    pool.close()  # No more work
-
+    runlog = instrument.RunLog(args.str_log, 'getRefseqGenomic.py')
+    pipeline = None
+    slots = None
+    if args.str_kraken:
+        for branch in branches:
+            krakendir = os.path.join(args.str_kraken, branch)
+            if not os.path.exists(krakendir):
+                os.makedirs(krakendir)
+        pipeline = ConversionPipeline(args.str_kraken,
+                                      args.convert_processes,
+                                      args.queue_size,
+                                      args.drop_raw)
+        slots = pipeline.slots
+    if args.verify:
+        VERIFIER = Verifier(set([job[2] for job in job_list]), process_number)
+    # create pool of download threads ------------
+    scheduler = DownloadScheduler(process_number, args.rate, args.retries, args.backoff)
     jobs_total = len(job_list)
-    progress_bar_length = 50
-    #==============================
-    while not result_list.ready():
-        num_not_done = result_list._number_left
-        num_done = jobs_total - num_not_done
-        num_bar_done = num_done * progress_bar_length / jobs_total
-        bar_str = ('=' * num_bar_done).ljust(progress_bar_length)
-        percent = int(num_done * 100 / jobs_total)
-        sys.stderr.write("JOBS (%s): [%s] (%s) %s%%\r" % (str(num_not_done).rjust(len(str(jobs_total))),
-                                                          bar_str,
-                                                          str(num_done).rjust(len(str(jobs_total))),
-                                                          str(percent).rjust(3)))
-
-        sys.stderr.flush()
-        time.sleep(2)  # wait a bit: here we test every 2 sec
-    # Finish the progress bar
-    bar_str = '=' * progress_bar_length
-    sys.stderr.write("JOBS (%s): [%s] (%i) 100%%\n" % ('0'.rjust(len(str(jobs_total))),
-                                                       bar_str,
-                                                       jobs_total))
+
+    if args.batch:
+        # a few long-lived sessions, each moving many files
+        batches = make_batches(job_list, args.batch_size)
+        result_iter = scheduler.imap_unordered(my_batch_func,
+                                               batches,
+                                               lambda batch: url_host(batch[0]),
+                                               retry_batch,
+                                               slots,
+                                               merge_batch)
+    else:
+        result_iter = scheduler.imap_unordered(my_func,
+                                               job_list,
+                                               lambda job: url_host(job[1]),
+                                               retry_download,
+                                               slots)
+
+    failed = []
+    corrupt = []
+    progress = instrument.Progress(jobs_total)
+    progress.write()
+    for results in result_iter:
+        if not args.batch:
+            results = [results]
+        for job, retcode, stats in results:
+            runlog.job('download', job[0], stats, accession=job[4], retcode=retcode)
+        failed += [job for job, retcode, stats in results if retcode != 0]
+        corrupt += [job for job, retcode, stats in results if retcode == CORRUPT]
+        if pipeline is not None:
+            pipeline.submit([job for job, retcode, stats in results if retcode == 0])
+        progress.update(len(results), sum([stats['bytes_in'] for job, retcode, stats in results]))
+    progress.finish()
+
+    if VERIFIER is not None:
+        VERIFIER.close()
+    for job in corrupt:
+        sys.stderr.write('CORRUPT: %s\n' % job[1])
+
+    for job in failed:
+        sys.stderr.write('FAILED: %s\n' % job[1])
+
+    if pipeline is not None:
+        converted = pipeline.finish()
+        for job, res, stats in converted:
+            runlog.job('convert', job[0], stats, accession=job[4])
+        num_converted = len([job for job, res, stats in converted if res == 1])
+        sys.stderr.write('CONVERTED: %i of %i genomes into %s\n' % (num_converted,
+                                                                   jobs_total,
+                                                                   args.str_kraken))
+
+    if args.incremental:
+        # record the transferred files in the manifests
+        failed = set([job[4] for job in failed])
+        done = [job for job in job_list if job[4] not in failed]
+        pool = Pool(processes = min(process_number, cpu_count()))
+        entries = pool.map(manifest.make_entry,
+                           [(job[4], job[5], job[6], os.path.join(job[2], job[0])) for job in done])
+        pool.close()
+        for job, entry in zip(done, entries):
+            if entry is not None:
+                dManifests[job[2]][job[4]] = entry
+        for dest_dir in dManifests:
+            manifest.write_manifest(os.path.join(dest_dir, manifest.FNAME), dManifests[dest_dir])
     #result_list = result_list.get()
+    runlog.close()
     end_time = timer()
     sys.stderr.write('PROCESS-TIME: %.1f sec\nDONE.\n\n' % (end_time - start_time))
     #-------------------------------------------------------------------------
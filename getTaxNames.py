@@ -25,6 +25,8 @@ template version: 1.5 (2016/09/09)
 """
 from timeit import default_timer as timer
 from signal import signal, SIGPIPE, SIG_DFL
+from multiprocessing import Pool
+from array import array
 import sys
 import os
 import os.path
@@ -32,9 +34,14 @@ import argparse
 import csv
 import collections
 import gzip
-import bz2
-import zipfile
 import time
+import taxonomy
+import compression
+
+try:
+    import numpy  # non-standard lib, optional: only needed for --eval-ranks
+except ImportError:
+    numpy = None
 
 # increase the csv field size
 csv.field_size_limit(sys.maxsize)
@@ -49,6 +56,18 @@ __date__ = '2017/01/04'
 __email__ = 's.schmeier@gmail.com'
 __author__ = 'Sebastian Schmeier'
 
+# bytes of the result file annotated per work unit
+CHUNKSIZE = 32 * 1024 * 1024
+# lines per work unit if the input can not be split by byte offsets
+# (stdin, compressed files)
+CHUNKLINES = 200000
+
+# read-only taxonomy tables used by annotate_chunk(), set in each worker by
+# init_worker(). Each worker opens the binary caches of names.dmp (memory-mapped,
+# so shared between the workers) and nodes.dmp itself instead of receiving
+# pickled copies, with any start method of multiprocessing.
+TABLES = {}
+
 
 def parse_cmdline():
     """ Parse command-line args. """
@@ -83,6 +102,34 @@ def parse_cmdline():
                         default=None,
                         help='Out-file. [default: "stdout"]')
 
+    parser.add_argument(
+        '--nodes',
+        metavar='FILE',
+        dest='str_nodes',
+        default=None,
+        help='Kraken taxonomy nodes.dmp file, needed for --lineage and --ranks. [default: nodes.dmp next to names.dmp]')
+
+    parser.add_argument(
+        '--lineage',
+        action='store_true',
+        dest='lineage',
+        default=False,
+        help='Attach the full lineage (scientific names from the top down, separated by ";") of each assigned tax-id. [default: False]')
+
+    parser.add_argument(
+        '--ranks',
+        metavar='STRING',
+        dest='str_ranks',
+        default=None,
+        help='Attach one column per rank with the scientific name of the assigned tax-id at that rank, ranks separated by comma, e.g. species,genus,phylum. [default: None]')
+
+    parser.add_argument(
+        '--report',
+        action='store_true',
+        dest='report',
+        default=False,
+        help='Instead of annotating each read, count reads per tax-id and write a kraken-report style summary (percent, clade reads, direct reads, rank code, tax-id, indented name). Needs nodes.dmp. [default: False]')
+
     parser.add_argument(
         '--eval',
         action='store_true',
@@ -90,6 +137,35 @@ def parse_cmdline():
         default=False,
         help='Calc sen/spec. EXPERIMENTAL [default: False]')
 
+    parser.add_argument(
+        '--eval-ranks',
+        metavar='STRING',
+        dest='str_eval_ranks',
+        default=None,
+        help='Implies --eval. Sensitivity, precision and F1 per rank, ranks separated by comma, e.g. species,genus,family. A read counts as correct at a rank if the assigned tax-id has the same ancestor at that rank as the true tax-id, assignments above the rank are not counted as calls. Needs numpy and nodes.dmp. [default: None]')
+
+    parser.add_argument(
+        '--eval-table',
+        metavar='FILE',
+        dest='str_eval_table',
+        default=None,
+        help='Write the per-taxon table of --eval-ranks to FILE. [default: None]')
+
+    group1 = parser.add_argument_group('Threading',
+                                       'Multithreading arguments:')
+
+    group1.add_argument(
+        '-p',
+        '--processes',
+        metavar='INT',
+        type=int,
+        dest='process_number',
+        default=1,
+        help=
+        'Number of sub-processes annotating chunks of the result file.'+\
+        ' It is only logical to not give more processes'+\
+        ' than cpus/cores are available. [default: 1]')
+
     args = parser.parse_args()
     return args, parser
 
@@ -98,89 +174,408 @@ def load_file(filename):
     """ LOADING FILES """
     if filename in ['-', 'stdin']:
         filehandle = sys.stdin
-    elif filename.split('.')[-1] == 'gz':
-        filehandle = gzip.open(filename)
-    elif filename.split('.')[-1] == 'bz2':
-        filehandle = bz2.BZFile(filename)
-    elif filename.split('.')[-1] == 'zip':
-        filehandle = zipfile.Zipfile(filename)
+    elif filename.split('.')[-1] in ['gz', 'bz2', 'zip']:
+        filehandle = compression.open_input(filename)
     else:
         filehandle = open(filename)
     return filehandle
 
 
-def main():
-    """ The main funtion. """
-    args, parser = parse_cmdline()
-
-    # create outfile object
-    if not args.outfile_name:
-        outfileobj = sys.stdout
-    elif args.outfile_name in ['-', 'stdout']:
-        outfileobj = sys.stdout
-    elif args.outfile_name.split('.')[-1] == 'gz':
-        outfileobj = gzip.open(args.outfile_name, 'wb')
+def lineage_columns(tax, oNodes, oNames, ranks, full_lineage):
+    """
+    Extra output columns of a tax-id: the full lineage if requested and the
+    scientific names at the selected ranks.
+    """
+    cols = []
+    if full_lineage:
+        cols.append(';'.join([oNames.names('scientific_name', t) or str(t)
+                              for t in oNodes.lineage(tax) if t != 1]))
+    for rank in ranks:
+        t = oNodes.at_rank(tax, rank)
+        if t is None:
+            cols.append('')
+        else:
+            cols.append(oNames.names('scientific_name', t) or str(t))
+    return cols
+
+
+def file_chunks(filename, chunksize=CHUNKSIZE):
+    """
+    Split a file into byte ranges of about chunksize bytes, each ending at a
+    line end.
+    return generator of (filename, start, end)
+    """
+    size = os.path.getsize(filename)
+    infile = open(filename, 'rb')
+    start = 0
+    while start < size:
+        end = start + chunksize
+        if end >= size:
+            end = size
+        else:
+            infile.seek(end)
+            infile.readline()
+            end = infile.tell()
+        yield (filename, start, end)
+        start = end
+    infile.close()
+
+
+def line_chunks(filehandle, num_lines=CHUNKLINES):
+    """ Split a stream into lists of num_lines lines. """
+    lines = []
+    for line in filehandle:
+        lines.append(line)
+        if len(lines) == num_lines:
+            yield lines
+            lines = []
+    if lines:
+        yield lines
+
+
+def read_chunk(chunk):
+    """
+    Lines of a chunk, either a byte range (filename, start, end) or a list of
+    lines.
+    """
+    if isinstance(chunk, tuple):
+        filename, start, end = chunk
+        infile = open(filename, 'rb')
+        infile.seek(start)
+        lines = infile.read(end - start).splitlines()
+        infile.close()
     else:
-        outfileobj = open(args.outfile_name, 'w')
-
-    # build the tax dict
-    oF = load_file(args.str_names)
-    reader = csv.reader(oF, delimiter = '\t')
-    dict_tax = {}
-    for a in reader:
-        name_type = '_'.join(a[6].split(' '))
-        if name_type not in dict_tax:
-            dict_tax[name_type] = {}
-
-        tax = int(a[0])
-        dict_tax[name_type][tax] = dict_tax[name_type].get(tax, []) + [a[2]]
-    oF.close()
-
-    # load results
-    oF = load_file(args.str_file)
-    reader = csv.reader(oF, delimiter ='\t')
-
-    list_keys = ['scientific_name',
-                     'authority',
-                     'synonym',
-                     'type_material',
-                     'genbank_common_name',
-                     'equivalent_name',
-                     'genbank_synonym',
-                     'blast_name']
-    
+        lines = chunk
+    if lines and not isinstance(lines[0], str):
+        lines = [line.decode('utf-8') for line in lines]
+    return lines
+
+
+def init_worker(names_path, nodes_path, ranks, lineage, evaluate, eval_ranks):
+    """ Set up the taxonomy tables of a worker (and of the main process). """
+    TABLES['names'] = taxonomy.NamesCache(names_path)
+    TABLES['nodes'] = None
+    if nodes_path:
+        TABLES['nodes'] = taxonomy.NodesTable(nodes_path)
+    TABLES['ranks'] = ranks
+    TABLES['lineage'] = lineage
+    TABLES['eval'] = evaluate
+    TABLES['eval_ranks'] = eval_ranks
+    TABLES['memo'] = {}  # memoized extra columns per tax-id
+
+
+def annotate_chunk(chunk):
+    """
+    THIS IS THE WORKFUNCTION THAT IS DISTRIBUTED TO THE PROCESSES.
+    Annotate a chunk of the result file, either a byte range
+    (filename, start, end) or a list of lines, with the tables in TABLES.
+
+    return (annotated text, #rows, #unclassified, #correct, true tax-ids, assigned tax-ids)
+    """
+    lines = read_chunk(chunk)
+
+    oNames = TABLES['names']
+    oNodes = TABLES['nodes']
+    ranks = TABLES['ranks']
+    lineage = TABLES['lineage']
+    evaluate = TABLES['eval']
+    dLineage = TABLES['memo']
+    num_cols = len(ranks) + int(lineage)
+    # (true, assigned) tax-id pairs for --eval-ranks, 0 = unclassified
+    trues = array('I')
+    preds = array('I')
+    collect = bool(TABLES['eval_ranks'])
+
+    out = []
     iNum = 0
     iNotC = 0
     iCorrect = 0
-    for a in reader:
+    for a in csv.reader(lines, delimiter ='\t'):
         iNum += 1
         if a[0] == 'C':
             name = ''
             name_test = ''
 
             tax = int(a[2])
-        
-            for key in list_keys:
-                if tax in dict_tax[key]:
-                    name = '%s:%s'%(key,'|'.join(dict_tax[key][tax]))
-                    break
+            name = oNames.best_name(tax)
             
-            if args.eval:
+            if evaluate:
                 tax_test = int(a[1].split('|')[-1].strip())
 
                 if tax_test == tax:
                     iCorrect += 1
-            
-                for key in list_keys:
-                    if tax_test in dict_tax[key]:
-                        name_test = '%s:%s'%(key,'|'.join(dict_tax[key][tax_test]))
-                        break
-                    
-            outfileobj.write('%s\t%s\t%s\n' % ('\t'.join(a), name, name_test))
+                name_test = oNames.best_name(tax_test)
+                if collect:
+                    trues.append(tax_test)
+                    preds.append(tax)
+
+            extra = ''
+            if num_cols:
+                if tax not in dLineage:
+                    dLineage[tax] = '\t' + '\t'.join(lineage_columns(tax, oNodes, oNames, ranks, lineage))
+                extra = dLineage[tax]
+
+            out.append('%s\t%s\t%s%s\n' % ('\t'.join(a), name, name_test, extra))
                 
         else:
-            outfileobj.write('%s\t''\t''\n' % ('\t'.join(a)))        
+            out.append('%s\t''\t''%s\n' % ('\t'.join(a), '\t' * num_cols))
             iNotC += 1
+            if collect:
+                trues.append(int(a[1].split('|')[-1].strip()))
+                preds.append(0)
+    return ''.join(out), iNum, iNotC, iCorrect, trues, preds
+
+
+def count_chunk(chunk):
+    """
+    Work function of the report mode: count the reads per assigned tax-id in a
+    chunk, unclassified reads are counted as tax-id 0.
+    return ({tax-id: reads}, #rows)
+    """
+    counts = {}
+    iNum = 0
+    for line in read_chunk(chunk):
+        if not line:
+            continue
+        iNum += 1
+        a = line.split('\t', 3)
+        if a[0] == 'C':
+            tax = int(a[2])
+        else:
+            tax = 0
+        counts[tax] = counts.get(tax, 0) + 1
+    return counts, iNum
+
+
+RANK_CODES = {'superkingdom': 'D',
+              'kingdom': 'K',
+              'phylum': 'P',
+              'class': 'C',
+              'order': 'O',
+              'family': 'F',
+              'genus': 'G',
+              'species': 'S'}
+
+
+def write_report(outfileobj, counts, iNum, oNodes, oNames):
+    """
+    Roll the direct read counts up the taxonomy and write a kraken-report
+    style summary. Only tax-ids with reads in their clade are reported,
+    children sorted by clade reads. Tax-ids missing from nodes.dmp are
+    reported directly below the root.
+    """
+    clade = {}
+    children = {}
+    for tax in counts:
+        if tax == 0:
+            continue
+        lineage = oNodes.lineage(tax)
+        if not lineage:
+            lineage = (1, tax)
+        parent = None
+        for node in lineage:
+            clade[node] = clade.get(node, 0) + counts[tax]
+            if parent is not None:
+                children.setdefault(parent, set()).add(node)
+            parent = node
+
+    def write_row(tax, depth):
+        if tax == 0:
+            rank_code = 'U'
+            name = 'unclassified'
+        else:
+            rank_code = RANK_CODES.get(oNodes.get_rank(tax), '-')
+            name = oNames.names('scientific_name', tax) or str(tax)
+        pct = 100.0 * clade.get(tax, counts.get(tax, 0)) / max(iNum, 1)
+        outfileobj.write('%6.2f\t%i\t%i\t%s\t%i\t%s%s\n' % (pct,
+                                                           clade.get(tax, counts.get(tax, 0)),
+                                                           counts.get(tax, 0),
+                                                           rank_code,
+                                                           tax,
+                                                           '  ' * depth,
+                                                           name))
+
+    if 0 in counts:
+        write_row(0, 0)
+    # depth-first from the root(s), iterative to not hit the recursion limit
+    kids = set()
+    for tax in children:
+        kids.update(children[tax])
+    roots = [tax for tax in clade if tax not in kids]
+    stack = [(tax, 0) for tax in sorted(roots, key=lambda t: clade[t])]
+    while stack:
+        tax, depth = stack.pop()
+        write_row(tax, depth)
+        kids = sorted(children.get(tax, []), key=lambda t: (clade[t], -t))
+        stack += [(kid, depth + 1) for kid in kids]
+
+
+def rank_ancestors(oNodes, rank):
+    """
+    Ancestor at rank (or the tax-id itself if it has that rank) of every
+    tax-id, 0 if there is none. All tax-ids are walked up the parent array
+    at once, one vectorized step per tree level.
+    return numpy array indexed by tax-id
+    """
+    parent = numpy.frombuffer(oNodes.parent, dtype=numpy.uint32).astype(numpy.int64)
+    rank_of = numpy.frombuffer(oNodes.rank_of, dtype=numpy.uint8)
+    anc = numpy.zeros(len(parent), dtype=numpy.int64)
+    if rank not in oNodes.rank_index:
+        return anc
+    rank_idx = oNodes.rank_index[rank]
+    is_rank = (rank_of == rank_idx) & (parent != 0)
+
+    node = numpy.arange(len(parent), dtype=numpy.int64)
+    while True:
+        hit = (anc == 0) & is_rank[node]
+        anc[hit] = node[hit]
+        parent_node = parent[node]
+        if (parent_node == node).all():
+            break
+        node = parent_node
+    return anc
+
+
+def safe_div(a, b):
+    if b == 0:
+        return 0.0
+    return float(a) / b
+
+
+def evaluate_ranks(trues, preds, oNodes, ranks):
+    """
+    Sensitivity, precision and F1 per rank from the (true, assigned) tax-id
+    pairs, see --eval-ranks.
+    return [(rank, summary, per-taxon rows), ...] with
+    summary = (reads, called, correct, sensitivity, precision, f1) and
+    rows = [(tax-id, reads, called, correct, sensitivity, precision, f1), ...]
+    """
+    size = len(oNodes.parent)
+    true = numpy.frombuffer(trues, dtype=numpy.uint32).astype(numpy.int64)
+    pred = numpy.frombuffer(preds, dtype=numpy.uint32).astype(numpy.int64)
+    true[true >= size] = 0
+    pred[pred >= size] = 0
+
+    results = []
+    for rank in ranks:
+        anc = rank_ancestors(oNodes, rank)
+        true_r = anc[true]
+        pred_r = anc[pred]
+        has_true = true_r > 0
+        called = has_true & (pred_r > 0)
+        correct = called & (true_r == pred_r)
+
+        num_true = int(has_true.sum())
+        num_called = int(called.sum())
+        num_correct = int(correct.sum())
+        sens = safe_div(num_correct, num_true)
+        prec = safe_div(num_correct, num_called)
+        summary = (num_true, num_called, num_correct, sens, prec, safe_div(2 * sens * prec, sens + prec))
+
+        true_counts = numpy.bincount(true_r[has_true], minlength=size)
+        called_counts = numpy.bincount(pred_r[called], minlength=size)
+        correct_counts = numpy.bincount(true_r[correct], minlength=size)
+        rows = []
+        for tax in numpy.nonzero(true_counts + called_counts)[0]:
+            sens_t = safe_div(correct_counts[tax], true_counts[tax])
+            prec_t = safe_div(correct_counts[tax], called_counts[tax])
+            rows.append((int(tax), int(true_counts[tax]), int(called_counts[tax]),
+                         int(correct_counts[tax]), sens_t, prec_t,
+                         safe_div(2 * sens_t * prec_t, sens_t + prec_t)))
+        results.append((rank, summary, rows))
+    return results
+
+
+def main():
+    """ The main funtion. """
+    args, parser = parse_cmdline()
+    if args.process_number < 1:
+        parser.error('-p has to be > 0: EXIT.')
+
+    # create outfile object
+    if not args.outfile_name:
+        outfileobj = sys.stdout
+    elif args.outfile_name in ['-', 'stdout']:
+        outfileobj = sys.stdout
+    elif args.outfile_name.split('.')[-1] == 'gz':
+        outfileobj = gzip.open(args.outfile_name, 'wb')
+    else:
+        outfileobj = open(args.outfile_name, 'w')
+
+    # parent/rank table for lineages
+    ranks = []
+    if args.str_ranks:
+        ranks = [s.strip() for s in args.str_ranks.split(',')]
+    eval_ranks = []
+    if args.str_eval_ranks:
+        eval_ranks = [s.strip() for s in args.str_eval_ranks.split(',')]
+        args.eval = True
+        if numpy is None:
+            parser.error('--eval-ranks needs numpy: EXIT.')
+    if args.report and (args.eval or args.lineage or ranks):
+        parser.error('--report can not be combined with --eval, --lineage or --ranks: EXIT.')
+    nodes_path = None
+    if args.lineage or ranks or args.report or eval_ranks:
+        if not args.str_nodes:
+            args.str_nodes = os.path.join(os.path.dirname(args.str_names), 'nodes.dmp')
+        if not os.path.isfile(args.str_nodes):
+            parser.error('nodes.dmp not found at %s, use --nodes: EXIT.' % args.str_nodes)
+        nodes_path = args.str_nodes
+
+    # name lookup on the binary cache of names.dmp, parent/rank table for
+    # lineages. Loaded here first, so the caches exist before the workers start.
+    table_args = (args.str_names, nodes_path, ranks, args.lineage, args.eval, eval_ranks)
+    init_worker(*table_args)
+    oNames = TABLES['names']
+    oNodes = TABLES['nodes']
+
+    # load results: plain files are split by byte offsets and read by the
+    # workers themselves, streams are handed out in blocks of lines
+    if args.str_file not in ['-', 'stdin'] and \
+       args.str_file.split('.')[-1] not in ['gz', 'bz2', 'zip']:
+        chunks = file_chunks(args.str_file)
+    else:
+        chunks = line_chunks(load_file(args.str_file))
+
+    if args.report:
+        work_func = count_chunk
+    else:
+        work_func = annotate_chunk
+    if args.process_number > 1:
+        pool = Pool(processes=args.process_number, initializer=init_worker, initargs=table_args)
+        results = pool.imap(work_func, chunks)  # keeps the input order
+    else:
+        pool = None
+        results = (work_func(chunk) for chunk in chunks)
+
+    if args.report:
+        # only a tax-id => reads table is kept in memory
+        counts = {}
+        iNum = 0
+        for counts_chunk, num in results:
+            iNum += num
+            for tax in counts_chunk:
+                counts[tax] = counts.get(tax, 0) + counts_chunk[tax]
+        if pool is not None:
+            pool.close()
+        write_report(outfileobj, counts, iNum, oNodes, oNames)
+        outfileobj.close()
+        return
+
+    iNum = 0
+    iNotC = 0
+    iCorrect = 0
+    trues = array('I')
+    preds = array('I')
+    for text, num, notc, correct, trues_chunk, preds_chunk in results:
+        outfileobj.write(text)
+        iNum += num
+        iNotC += notc
+        iCorrect += correct
+        trues.extend(trues_chunk)
+        preds.extend(preds_chunk)
+    if pool is not None:
+        pool.close()
 
     if args.eval:
         adj = len(str(iNum))
@@ -200,6 +595,21 @@ def main():
         sys.stderr.write('# %s (%s %%) / %i classified.\n' %(str(iNum-iNotC).rjust(adj), pct_c, iNum))
         sys.stderr.write('## %s (%s %%) / %i correct [ as in assigned the exact same tax-id ].\n' %(str(iCorrect).rjust(adj), pct_cor, iNum-iNotC))
         sys.stderr.write('## %s (%s %%) / %i incorrect\n' %(str(iNum-iNotC-iCorrect).rjust(adj), pct_incor, iNum-iNotC))
+
+    if eval_ranks:
+        results = evaluate_ranks(trues, preds, oNodes, eval_ranks)
+        sys.stderr.write('### rank\treads\tcalled\tcorrect\tsensitivity\tprecision\tF1\n')
+        for rank, summary, rows in results:
+            sys.stderr.write('### %s\t%i\t%i\t%i\t%.4f\t%.4f\t%.4f\n' % ((rank,) + summary))
+        if args.str_eval_table:
+            outfile = open(args.str_eval_table, 'w')
+            outfile.write('#rank\ttaxid\tname\treads\tcalled\tcorrect\tsensitivity\tprecision\tF1\n')
+            for rank, summary, rows in results:
+                for row in rows:
+                    name = oNames.names('scientific_name', row[0]) or ''
+                    outfile.write('%s\t%i\t%s\t%i\t%i\t%i\t%.4f\t%.4f\t%.4f\n'
+                                  % ((rank, row[0], name) + row[1:]))
+            outfile.close()
         
 
         
@@ -0,0 +1,183 @@
+#!/usr/bin/env python2
+"""
+NAME: instrument.py
+=========
+
+DESCRIPTION
+===========
+Progress, throughput and timing instrumentation shared by getRefseqGenomic.py
+and getKrakenFna.py.
+
+Progress    progress bar on stderr with live throughput (MB/s, genomes/s) and
+            ETA, updated as results come in (no polling).
+RunLog      machine-readable run log, one JSON object per line: a "start"
+            line with the command line, one "job" line per download or
+            conversion (wall time, bytes in and out, records, error) and an
+            "end" line with the totals of the run per stage.
+
+Work functions time themselves with job_stats() and hand the stats back with
+their result, as they may run in another process.
+
+VERSION HISTORY
+===============
+
+0.0.1   2026/10/18    Initial version.
+
+LICENCE
+=======
+2016, copyright Sebastian Schmeier (s.schmeier@gmail.com), sschmeier.com
+
+template version: 1.6 (2016/11/09)
+"""
+from timeit import default_timer as timer
+import sys
+import time
+import json
+import threading
+
+
+__version__ = '0.0.1'
+__date__ = '2026/10/18'
+__email__ = 's.schmeier@gmail.com'
+__author__ = 'Sebastian Schmeier'
+
+
+MB = 1024.0 ** 2
+
+
+def job_stats(start, bytes_in=0, bytes_out=0, records=0, error=None):
+    """
+    Stats of one job, start is the timer() value at its start.
+    return {seconds, bytes_in, bytes_out, records, error}
+    """
+    return {'seconds': round(timer() - start, 4),
+            'bytes_in': bytes_in,
+            'bytes_out': bytes_out,
+            'records': records,
+            'error': error}
+
+
+def format_eta(seconds):
+    """ Seconds as h:mm:ss. """
+    seconds = int(seconds)
+    return '%i:%02i:%02i' % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+class Progress(object):
+    """
+    Progress bar with throughput and ETA. The bar follows the bytes if
+    bytes_total is given (jobs differ in size by orders of magnitude),
+    otherwise the number of jobs.
+    """
+    def __init__(self, jobs_total, bytes_total=None, unit='genomes', length=50):
+        self.jobs_total = jobs_total
+        self.bytes_total = bytes_total
+        self.unit = unit
+        self.length = length
+        self.jobs_done = 0
+        self.bytes_done = 0
+        self.start = timer()
+
+    def fraction(self):
+        if self.bytes_total is not None:
+            return float(self.bytes_done) / max(self.bytes_total, 1)
+        return float(self.jobs_done) / max(self.jobs_total, 1)
+
+    def rates(self):
+        """ return (MB/s, jobs/s) since the start """
+        elapsed = max(timer() - self.start, 1e-6)
+        return self.bytes_done / MB / elapsed, self.jobs_done / elapsed
+
+    def update(self, jobs=0, bytes_done=0):
+        """ Add finished jobs and bytes and redraw the bar. """
+        self.jobs_done += jobs
+        self.bytes_done += bytes_done
+        self.write()
+
+    def status(self):
+        mb_s, jobs_s = self.rates()
+        fraction = self.fraction()
+        if fraction > 0:
+            eta = format_eta((timer() - self.start) * (1 - fraction) / fraction)
+        else:
+            eta = '-:--:--'
+        return '%.1f MB/s %.1f %s/s ETA %s' % (mb_s, jobs_s, self.unit, eta)
+
+    def write(self):
+        width = len(str(self.jobs_total))
+        fraction = min(self.fraction(), 1.0)
+        bar_str = ('=' * int(fraction * self.length)).ljust(self.length)
+        sys.stderr.write("JOBS (%s): [%s] (%s) %s%% %s\r" % (str(self.jobs_total - self.jobs_done).rjust(width),
+                                                            bar_str,
+                                                            str(self.jobs_done).rjust(width),
+                                                            str(int(fraction * 100)).rjust(3),
+                                                            self.status()))
+        sys.stderr.flush()
+
+    def finish(self):
+        """ Finish the bar and write the throughput of the run. """
+        mb_s, jobs_s = self.rates()
+        sys.stderr.write("JOBS (%s): [%s] (%i) 100%%%s\n" % ('0'.rjust(len(str(self.jobs_total))),
+                                                             '=' * self.length,
+                                                             self.jobs_total,
+                                                             ' ' * 36))
+        sys.stderr.write('THROUGHPUT: %.1f MB/s, %.1f %s/s\n' % (mb_s, jobs_s, self.unit))
+
+
+class RunLog(object):
+    """
+    JSONL run log. Without a filename nothing is written, so callers do not
+    have to check whether logging is switched on. Safe to use from several
+    threads.
+    """
+    def __init__(self, filename=None, script=None):
+        self.lock = threading.Lock()
+        self.start = timer()
+        self.totals = {}  # stage => {jobs, failed, bytes_in, bytes_out, records[, masked, n_removed]}
+        if filename:
+            self.outfile = open(filename, 'a')
+        else:
+            self.outfile = None
+        self.write({'event': 'start',
+                    'script': script,
+                    'argv': sys.argv[1:]})
+
+    def write(self, obj):
+        if self.outfile is None:
+            return
+        obj['time'] = round(time.time(), 3)
+        self.lock.acquire()
+        try:
+            self.outfile.write(json.dumps(obj, sort_keys=True) + '\n')
+            self.outfile.flush()
+        finally:
+            self.lock.release()
+
+    def job(self, stage, name, stats, **fields):
+        """ Log one job of a stage (e.g. download, convert) with its stats. """
+        self.lock.acquire()
+        if stage not in self.totals:
+            self.totals[stage] = {'jobs': 0, 'failed': 0, 'bytes_in': 0, 'bytes_out': 0, 'records': 0}
+        totals = self.totals[stage]
+        totals['jobs'] += 1
+        if stats.get('error'):
+            totals['failed'] += 1
+        for key in ('bytes_in', 'bytes_out', 'records'):
+            totals[key] += stats.get(key) or 0
+        # optional counters, e.g. masked and n_removed of the conversion
+        for key in ('masked', 'n_removed'):
+            if key in stats:
+                totals[key] = totals.get(key, 0) + stats[key]
+        self.lock.release()
+        obj = {'event': 'job', 'stage': stage, 'name': name}
+        obj.update(stats)
+        obj.update(fields)
+        self.write(obj)
+
+    def close(self):
+        """ Log the totals of the run. """
+        self.write({'event': 'end',
+                    'seconds': round(timer() - self.start, 3),
+                    'stages': self.totals})
+        if self.outfile is not None:
+            self.outfile.close()
@@ -0,0 +1,205 @@
+#!/usr/bin/env python2
+"""
+NAME: manifest.py
+=========
+
+DESCRIPTION
+===========
+Persistent on-disk manifest of assemblies handled by getRefseqGenomic.py and
+getKrakenFna.py, keyed by assembly accession. For each assembly it records the
+upstream seq_rel_date and ftp_path from assembly_summary.txt plus the size,
+mtime and md5 checksum of the local file. Diffing a new assembly_summary.txt
+against the manifest tells which assemblies are new, changed, current or
+retired, so incremental refreshes only touch what changed upstream.
+
+The manifest is a tab-separated text file with one assembly per line.
+
+The digest cache (md5cache.txt) holds the size, mtime and md5 checksum of
+each verified file of a directory, so files that are unchanged since their
+last verification are not hashed again.
+
+VERSION HISTORY
+===============
+
+0.0.1   2026/10/18    Initial version.
+
+LICENCE
+=======
+2016, copyright Sebastian Schmeier (s.schmeier@gmail.com), sschmeier.com
+
+template version: 1.6 (2016/11/09)
+"""
+import os
+import os.path
+import csv
+import hashlib
+
+
+__version__ = '0.0.1'
+__date__ = '2026/10/18'
+__email__ = 's.schmeier@gmail.com'
+__author__ = 'Sebastian Schmeier'
+
+
+FNAME = 'manifest.txt'
+FIELDS = ['accession', 'seq_rel_date', 'ftp_path', 'size', 'mtime', 'md5']
+DIGESTS_FNAME = 'md5cache.txt'
+
+
+def load_manifest(filename):
+    """
+    Read a manifest file.
+    return {accession: {field: value}}, empty if the file does not exist.
+    """
+    manifest = {}
+    if not os.path.isfile(filename):
+        return manifest
+
+    for a in csv.reader(open(filename), delimiter='\t'):
+        if not a or a[0][0] == '#':
+            continue
+        entry = dict(zip(FIELDS, a))
+        entry['size'] = int(entry['size'])
+        entry['mtime'] = int(entry['mtime'])
+        manifest[entry['accession']] = entry
+    return manifest
+
+
+def write_manifest(filename, manifest):
+    """
+    Write a manifest file. The file is written to a temporary name first and
+    then renamed, so an interrupted run never leaves a truncated manifest.
+    """
+    tmpname = '%s.tmp' % filename
+    outfile = open(tmpname, 'w')
+    outfile.write('#%s\n' % '\t'.join(FIELDS))
+    for accession in sorted(manifest):
+        entry = manifest[accession]
+        outfile.write('%s\n' % '\t'.join([str(entry[f]) for f in FIELDS]))
+    outfile.close()
+    os.rename(tmpname, filename)
+
+
+def file_md5(filename, blocksize=1 << 20):
+    """ md5 hex-digest of a file, read in large blocks. """
+    md5 = hashlib.md5()
+    infile = open(filename, 'rb')
+    block = infile.read(blocksize)
+    while block:
+        md5.update(block)
+        block = infile.read(blocksize)
+    infile.close()
+    return md5.hexdigest()
+
+
+def file_digest(filepath):
+    """
+    Digest of a file. Top-level function so that it can be distributed with
+    Pool.map.
+    return (filepath, size, mtime, md5)
+    """
+    stat = os.stat(filepath)
+    return (filepath, stat.st_size, int(stat.st_mtime), file_md5(filepath, 4 << 20))
+
+
+def load_digests(filename):
+    """
+    Read a digest cache file.
+    return {filename: (size, mtime, md5)}, empty if the file does not exist.
+    """
+    digests = {}
+    if not os.path.isfile(filename):
+        return digests
+    for a in csv.reader(open(filename), delimiter='\t'):
+        if len(a) != 4 or a[0][0] == '#':
+            continue
+        digests[a[0]] = (int(a[1]), int(a[2]), a[3])
+    return digests
+
+
+def write_digests(filename, digests):
+    """ Write a digest cache file (via a temporary file as write_manifest). """
+    tmpname = '%s.tmp' % filename
+    outfile = open(tmpname, 'w')
+    outfile.write('#filename\tsize\tmtime\tmd5\n')
+    for name in sorted(digests):
+        outfile.write('%s\t%i\t%i\t%s\n' % ((name,) + tuple(digests[name])))
+    outfile.close()
+    os.rename(tmpname, filename)
+
+
+def cached_md5(digests, filepath):
+    """
+    md5 of filepath from digests ({filename: (size, mtime, md5)}) if the file
+    is unchanged since, else None.
+    """
+    cached = digests.get(os.path.basename(filepath), None)
+    if cached is None:
+        return None
+    stat = os.stat(filepath)
+    if cached[0] == stat.st_size and cached[1] == int(stat.st_mtime):
+        return cached[2]
+    return None
+
+
+def make_entry(args):
+    """
+    Build the manifest entry of a local file. Top-level function so that it
+    can be distributed with Pool.map.
+    args = (accession, seq_rel_date, ftp_path, filepath)
+
+    return entry or None if the file does not exist.
+    """
+    accession, seq_rel_date, ftp_path, filepath = args
+    if not os.path.isfile(filepath):
+        return None
+    stat = os.stat(filepath)
+    return {'accession': accession,
+            'seq_rel_date': seq_rel_date,
+            'ftp_path': ftp_path,
+            'size': stat.st_size,
+            'mtime': int(stat.st_mtime),
+            'md5': file_md5(filepath)}
+
+
+def is_current(entry, seq_rel_date, ftp_path, filepath):
+    """
+    True if the manifest entry matches the upstream record and the local file
+    is still the one that was recorded (same size and mtime).
+    """
+    if entry is None:
+        return False
+    if entry['seq_rel_date'] != seq_rel_date or entry['ftp_path'] != ftp_path:
+        return False
+    if not os.path.isfile(filepath):
+        return False
+    stat = os.stat(filepath)
+    return stat.st_size == entry['size'] and int(stat.st_mtime) == entry['mtime']
+
+
+def diff_manifest(manifest, records, latest):
+    """
+    Diff upstream records against the manifest.
+    records = {accession: (seq_rel_date, ftp_path, filepath)} of the selected assemblies
+    latest = set of all accessions that are 'latest' upstream
+
+    Accessions in the manifest that are no longer 'latest' upstream are
+    retired. Assemblies that are only excluded by the current selection
+    (e.g. another assembly level) are left alone.
+
+    return (new, changed, current, retired) lists of accessions
+    """
+    new = []
+    changed = []
+    current = []
+    for accession in records:
+        seq_rel_date, ftp_path, filepath = records[accession]
+        entry = manifest.get(accession, None)
+        if entry is None:
+            new.append(accession)
+        elif is_current(entry, seq_rel_date, ftp_path, filepath):
+            current.append(accession)
+        else:
+            changed.append(accession)
+    retired = [accession for accession in manifest if accession not in latest]
+    return new, changed, current, retired
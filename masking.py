@@ -0,0 +1,186 @@
+#!/usr/bin/env python2
+"""
+NAME: masking.py
+=========
+
+DESCRIPTION
+===========
+Masking of the sequences written by getKrakenFna.py.
+
+DUST    low-complexity regions are scored DUST-style: windows of 64 triplets
+        (66 bases) with a step of 32 get the score sum(c_t * (c_t - 1) / 2) /
+        (l - 1) over the counts c_t of the 64 triplets and the number l of
+        triplets in the window. Windows scoring above the threshold are
+        hard-masked with N, so that Kraken does not build k-mers from them.
+N-runs  runs of N longer than a maximum length are cut down to it. A single
+        N already breaks every k-mer spanning it.
+
+The sequence of a record is fed in pieces and processed in chunks of about
+CHUNK_SIZE bases with numpy, so memory stays bounded for chromosomes of any
+length. The output is wrapped at LINE_WIDTH bases per line.
+
+Needs numpy.
+
+VERSION HISTORY
+===============
+
+0.0.1   2026/10/18    Initial version.
+
+LICENCE
+=======
+2016, copyright Sebastian Schmeier (s.schmeier@gmail.com), sschmeier.com
+
+template version: 1.6 (2016/11/09)
+"""
+import dedup
+from dedup import numpy
+
+
+__version__ = '0.0.1'
+__date__ = '2026/10/18'
+__email__ = 's.schmeier@gmail.com'
+__author__ = 'Sebastian Schmeier'
+
+
+DUST_THRESHOLD = 20.0
+WINDOW = 64  # triplets per window
+STEP = 32
+CHUNK_SIZE = 1 << 20
+LINE_WIDTH = 80
+
+
+def dust_windows(seq, final=False):
+    """
+    Score the windows of a piece of sequence that starts at a window start.
+    Unless final, only windows that lie completely within seq are scored.
+    return (scores, number of windows)
+    """
+    n = len(seq)
+    if final:
+        num = (max(n - 2, 1) + STEP - 1) // STEP
+    else:
+        num = (n - WINDOW - 2) // STEP + 1
+    if num <= 0:
+        return numpy.zeros(0), 0
+    codes = dedup.CODES.take(seq[:min(n, (num + 1) * STEP + 2)])
+    # triplet codes 0..63, 64 for triplets with other bases than ACGT
+    invalid = codes == 4
+    triplets = ((codes[:-2] << 4) | (codes[1:-1] << 2) | codes[2:]) & 63
+    triplets[invalid[:-2] | invalid[1:-1] | invalid[2:]] = 64
+
+    # triplet counts per half window, a window is two neighbouring halves
+    padded = numpy.full((num + 1) * STEP, 64, dtype=numpy.int32)
+    padded[:len(triplets)] = triplets
+    padded = padded.reshape(num + 1, STEP)
+    padded += (numpy.arange(num + 1, dtype=numpy.int32) * 65)[:, None]
+    counts = numpy.bincount(padded.ravel(), minlength=(num + 1) * 65).reshape(num + 1, 65)
+    counts[:, 64] = 0  # kept in place, contiguous rows are faster
+    # sum c(c - 1) / 2 of the window counts c = a + b of two halves a and b
+    squares = numpy.einsum('ij,ij->i', counts, counts)
+    cross = numpy.einsum('ij,ij->i', counts[:num], counts[1:])
+    num_triplets = counts.sum(axis=1)
+    num_triplets = num_triplets[:num] + num_triplets[1:]
+    pairs = (squares[:num] + squares[1:] + 2 * cross - num_triplets) // 2
+    return pairs / numpy.maximum(num_triplets - 1, 1).astype(float), num
+
+
+class Masker(object):
+    """
+    Streaming masking of the records of a fasta-file:
+    new_record(), feed(sequence piece), ..., end_record(), each returns the
+    masked and wrapped sequence lines ready to be written.
+    """
+    def __init__(self, threshold=DUST_THRESHOLD, max_n_run=None, dust=True,
+                 width=LINE_WIDTH, chunk_size=CHUNK_SIZE):
+        self.threshold = threshold
+        self.max_n_run = max_n_run
+        self.dust = dust
+        self.width = width
+        self.chunk_size = chunk_size
+        self.masked = 0  # bases masked by DUST
+        self.removed = 0  # N removed from long runs
+        self.new_record()
+
+    def new_record(self):
+        self.buf = b''
+        self.pending = numpy.zeros(0, dtype=bool)  # masks of windows scored already
+        self.n_run = 0  # length of the N-run at the end of the output
+        self.column = 0
+
+    def feed(self, seq):
+        """ Add a piece of sequence (without line breaks) of the current record. """
+        self.buf += seq
+        if len(self.buf) < self.chunk_size:
+            return b''
+        return self.process(False)
+
+    def end_record(self):
+        """ Finish the current record. """
+        out = self.process(True)
+        if self.column:
+            out += b'\n'
+        self.new_record()
+        return out
+
+    def process(self, final):
+        seq = numpy.frombuffer(self.buf, dtype=numpy.uint8)
+        n = len(seq)
+        mask = numpy.zeros(n, dtype=bool)
+        mask[:len(self.pending)] = self.pending
+        done = n
+        if self.dust:
+            scores, num = dust_windows(seq, final)
+            if not final:
+                done = min(num * STEP, n)
+            starts = numpy.nonzero(scores > self.threshold)[0] * STEP
+            if len(starts):
+                # mark the bases of the masked windows
+                edges = numpy.zeros(n + 1, dtype=numpy.int32)
+                numpy.add.at(edges, starts, 1)
+                numpy.add.at(edges, numpy.minimum(starts + WINDOW + 2, n), -1)
+                mask |= numpy.cumsum(edges)[:n] > 0
+        self.buf = self.buf[done:]
+        self.pending = mask[done:]
+
+        out = seq[:done].copy()
+        mask = mask[:done]
+        self.masked += int(numpy.count_nonzero(mask & (dedup.CODES[out] != 4)))
+        out[mask] = ord('N')
+        if self.max_n_run is not None:
+            out = self.collapse(out)
+        return self.wrap(out)
+
+    def collapse(self, out):
+        """ Cut N-runs down to max_n_run, continuing the run of the last chunk. """
+        is_n = (out == ord('N')) | (out == ord('n'))
+        if not is_n.any():
+            if len(out):
+                self.n_run = 0
+            return out
+        total = numpy.cumsum(is_n)
+        # N before the current position in the same run
+        run = total - numpy.maximum.accumulate(numpy.where(is_n, 0, total))
+        first = numpy.nonzero(~is_n)[0]
+        lead = first[0] if len(first) else len(out)
+        run[:lead] += self.n_run
+        keep = ~is_n | (run <= self.max_n_run)
+        self.n_run = int(run[-1]) if is_n[-1] else 0
+        self.removed += len(out) - int(numpy.count_nonzero(keep))
+        return out[keep]
+
+    def wrap(self, out):
+        """ Lines of width bases, continuing the last line of the record. """
+        if not len(out):
+            return b''
+        head = self.width - self.column
+        if len(out) < head:
+            self.column += len(out)
+            return out.tobytes()
+        rest = out[head:]
+        rows = len(rest) // self.width
+        lines = numpy.empty((rows, self.width + 1), dtype=numpy.uint8)
+        lines[:, :self.width] = rest[:rows * self.width].reshape(rows, self.width)
+        lines[:, self.width] = ord('\n')
+        tail = rest[rows * self.width:]
+        self.column = len(tail)
+        return out[:head].tobytes() + b'\n' + lines.tobytes() + tail.tobytes()
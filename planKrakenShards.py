@@ -0,0 +1,362 @@
+#!/usr/bin/env python2
+"""
+NAME: planKrakenShards.py
+=========
+
+DESCRIPTION
+===========
+Split the Kraken library written by getKrakenFna.py into size-balanced
+partitions (shards), so that each shard can be built into its own Kraken
+database by kraken-build in parallel, e.g. on separate nodes, within a
+given memory budget.
+
+Related assemblies are kept together: the assemblies are ordered
+depth-first along the taxonomy, so each shard is a contiguous range of the
+tree, and every cut is placed at the boundary between the highest-level
+clades found within --slack of the balanced shard size.
+
+For each shard a manifest of its library files (shard_0001.txt, ...) or a
+library directory of hard links (--link) is written, plus plan.txt with the
+shard of each assembly.
+
+Libraries of the header-only mode of getKrakenFna.py (-m) are supported: the
+linked .fna.gz-files are sharded and each shard gets the part of
+seqid2taxid.map of its assemblies (shard_0001.map, or seqid2taxid.map in its
+library directory). Libraries written in large shards (getKrakenFna.py -s)
+cannot be split by assembly and have to be converted per assembly.
+
+VERSION HISTORY
+===============
+
+0.0.1   2026/10/18    Initial version.
+
+LICENCE
+=======
+2016, copyright Sebastian Schmeier (s.schmeier@gmail.com), sschmeier.com
+
+template version: 1.6 (2016/11/09)
+"""
+import sys
+import os
+import os.path
+import argparse
+import bisect
+import glob
+import taxonomy
+import compression
+import getKrakenFna
+
+
+__version__ = '0.0.1'
+__date__ = '2026/10/18'
+__email__ = 's.schmeier@gmail.com'
+__author__ = 'Sebastian Schmeier'
+
+
+def parse_cmdline():
+    """ Parse command-line args. """
+    ## parse cmd-line -----------------------------------------------------------
+    description = "Split the Kraken library of getKrakenFna.py into size-balanced shards of related clades, to build each shard with kraken-build in parallel."
+    version = 'version %s, date %s' % (__version__, __date__)
+    epilog = 'Copyright %s (%s)' % (__author__, __email__)
+
+    parser = argparse.ArgumentParser(description=description, epilog=epilog)
+
+    parser.add_argument('--version',
+                        action='version',
+                        version='%s' % (version))
+
+    parser.add_argument(
+        dest='str_kraken',
+        metavar='KrakenDB-DIR',
+        type=str,
+        help='Directory of the processed fasta-files of getKrakenFna.py.')
+
+    parser.add_argument(
+        dest='str_nodes',
+        metavar='nodes.dmp',
+        type=str,
+        help='Kraken taxonomy nodes.dmp file.')
+
+    parser.add_argument('-b',
+        '--branch',
+        dest='str_branch',
+        metavar='BRANCH',
+        type=str,
+        default="bacteria,viral,fungi,protozoa,archaea",
+        help='Branches of organisms to include separated by comma, e.g. bacteria, fungi, etc. [default=" bacteria,viral,fungi,protozoa,archaea"]')
+
+    parser.add_argument('-l',
+        '--level',
+        dest='str_level',
+        metavar='LEVEL',
+        type=str,
+        default="Complete Genome",
+        help='Assembly - level of genomic sequences to include, separated by comma, as given to getKrakenFna.py. [default="Complete Genome"]')
+
+    parser.add_argument('-d',
+        '--dir',
+        dest='str_dir',
+        metavar='DIRECTORY',
+        type=str,
+        default="./genomes/refseq/",
+        help='Base directory for refseq fasta-files, as given to getKrakenFna.py. [default="./genomes/refseq/"]')
+
+    parser.add_argument('-n',
+        '--shards',
+        dest='num_shards',
+        metavar='INT',
+        type=int,
+        default=None,
+        help='Number of shards.')
+
+    parser.add_argument('-s',
+        '--max-size',
+        dest='str_max_size',
+        metavar='SIZE',
+        type=str,
+        default=None,
+        help='Maximum library size of a shard, e.g. 40G. kraken-build needs memory in proportion to the library size. With -n, the larger number of shards is used.')
+
+    parser.add_argument(
+        '--slack',
+        dest='slack',
+        metavar='FLOAT',
+        type=float,
+        default=0.05,
+        help='A shard may deviate from the balanced size by this fraction, to cut between higher-level clades. [default: 0.05]')
+
+    parser.add_argument('-o',
+        '--out',
+        dest='str_out',
+        metavar='DIR',
+        type=str,
+        default=None,
+        help='Output directory of the shard manifests. [default: KrakenDB-DIR/shards]')
+
+    parser.add_argument(
+        '--link',
+        dest='link',
+        default=False,
+        action='store_true',
+        help='Also create a library directory per shard (shard_0001/, ...) with hard links to its files.')
+
+    # if no arguments supplied print help
+    if len(sys.argv)==1:
+        parser.print_help()
+        sys.exit(1)
+
+    args = parser.parse_args()
+    return args, parser
+
+
+def library_file(job, seqid_map=False):
+    """
+    The converted file of a job (uncompressed or compressed), None if it
+    has not been converted. With seqid_map, jobs of the -m mode of
+    getKrakenFna.py: the original file linked into the branch directory, if
+    the map of the assembly (job[2]) has been written.
+    """
+    if seqid_map:
+        # job[2] = <krakendir>/<branch>/maps/<name>.map
+        filepath = os.path.join(os.path.dirname(os.path.dirname(job[2])), os.path.basename(job[1]))
+        if os.path.isfile(job[2]) and os.path.isfile(filepath):
+            return filepath
+        return None
+    for ext in [''] + sorted(set(compression.EXTENSIONS.values())):
+        if os.path.isfile(job[2] + ext):
+            return job[2] + ext
+    return None
+
+
+def write_map(filename, mappaths):
+    """ Concatenate the seqid2taxid maps of the assemblies of a shard. """
+    outfile = open(filename, 'wb')
+    for mappath in mappaths:
+        infile = open(mappath, 'rb')
+        outfile.write(infile.read())
+        infile.close()
+    outfile.close()
+
+
+def format_size(size):
+    """ Size in bytes as e.g. 3.9G. """
+    for unit in ['', 'K', 'M', 'G']:
+        if size < 1024:
+            return '%.1f%s' % (size, unit)
+        size /= 1024.0
+    return '%.1fT' % size
+
+
+def common_prefix(a, b):
+    """ Length of the common prefix of two lineages. """
+    i = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        i += 1
+    return i
+
+
+def plan_shards(sizes, lineages, num_shards, slack=0.05):
+    """
+    Cut a sequence of assemblies, in depth-first taxonomic order, into
+    num_shards contiguous shards of about the same size. Each cut lies within
+    slack * (balanced size) of its balanced position and, among those
+    positions, between the two assemblies with the shallowest common
+    ancestor, i.e. between the highest-level clades.
+
+    return [start index of each shard, ..., len(sizes)]
+    """
+    num_shards = max(1, min(num_shards, len(sizes)))
+    ends = [0]  # ends[i] = size of the assemblies before i
+    for size in sizes:
+        ends.append(ends[-1] + size)
+    total = ends[-1]
+    balanced = float(total) / num_shards
+
+    cuts = [0]
+    for k in range(1, num_shards):
+        # cut i lies between assembly i-1 and i, at least one assembly per shard
+        first = cuts[-1] + 1
+        last = len(sizes) - (num_shards - k)
+        target = k * balanced
+        lo = bisect.bisect_left(ends, target - slack * balanced, first, last + 1)
+        hi = bisect.bisect_right(ends, target + slack * balanced, first, last + 1)
+        candidates = range(lo, hi)
+        if not candidates:
+            # nothing within slack: the position next to the target
+            i = min(max(bisect.bisect_left(ends, target, first, last + 1), first), last)
+            if i > first and target - ends[i - 1] < ends[i] - target:
+                i -= 1
+            candidates = [i]
+        cuts.append(min(candidates,
+                        key=lambda i: (common_prefix(lineages[i - 1], lineages[i]),
+                                       abs(ends[i] - target))))
+    cuts.append(len(sizes))
+    return cuts
+
+
+def main():
+    """ The main function. """
+    args, parser = parse_cmdline()
+
+    if args.num_shards is None and args.str_max_size is None:
+        parser.error('give the number of shards (-n) and/or their maximum size (-s): EXIT.')
+    if args.num_shards is not None and args.num_shards < 1:
+        parser.error('-n has to be > 0: EXIT.')
+    max_size = None
+    if args.str_max_size:
+        try:
+            max_size = getKrakenFna.parse_size(args.str_max_size)
+        except ValueError:
+            parser.error('-s has to be a size like 500M or 40G: EXIT.')
+        if max_size < 1:
+            parser.error('-s has to be > 0: EXIT.')
+    if not 0 <= args.slack < 0.5:
+        parser.error('--slack has to be >= 0 and < 0.5: EXIT.')
+    if not os.path.isfile(args.str_nodes):
+        parser.error('nodes.dmp not found: %s: EXIT.' % args.str_nodes)
+
+    branches = [s.strip() for s in args.str_branch.split(',')]
+    types = [s.strip() for s in args.str_level.split(',')]
+    oNodes = taxonomy.NodesTable(args.str_nodes)
+
+    # the library files with their size, lineage and seqid2taxid map (-m)
+    library = []
+    missing = 0
+    for branch in branches:
+        krakendir = os.path.join(args.str_kraken, branch)
+        seqid_map = False
+        jobs, dStats, latest = getKrakenFna.parse_assemblyfile(branch,
+                                                               types,
+                                                               args.str_dir,
+                                                               args.str_kraken)
+        if not [job for job in jobs if library_file(job)]:
+            # no files per assembly: a library of the -m or -s mode
+            if os.path.isfile(os.path.join(krakendir, getKrakenFna.MAP_FNAME)):
+                seqid_map = True
+                jobs, dStats, latest = getKrakenFna.parse_assemblyfile(branch,
+                                                                       types,
+                                                                       args.str_dir,
+                                                                       args.str_kraken,
+                                                                       seqid_map=True)
+            elif os.path.isfile(os.path.join(krakendir, 'library.index.txt')):
+                sys.stderr.write("ERROR: the library of branch '%s' is written in large shards (getKrakenFna.py -s), which cannot be split by assembly.\nConvert it per assembly first, i.e. run getKrakenFna.py without -s.\nEXIT\n\n" % branch)
+                sys.exit(1)
+        for job in jobs:
+            filepath = library_file(job, seqid_map)
+            if filepath is None:
+                missing += 1
+                continue
+            mappath = None
+            if seqid_map:
+                mappath = job[2]
+            lineage = oNodes.lineage(int(job[0])) or (0, int(job[0]))  # unknown tax-ids last
+            # kraken-build reads the library file, compressed ones unpacked
+            library.append((lineage, job[3], filepath, job, getKrakenFna.uncompressed_size(filepath), mappath))
+    if missing:
+        sys.stderr.write('%i assemblies not converted by getKrakenFna.py, left out\n' % missing)
+    if not library:
+        sys.stderr.write('No converted assemblies found in %s.\nEXIT\n\n' % args.str_kraken)
+        sys.exit(1)
+
+    # depth-first along the taxonomy: sorted lineages keep clades together
+    library.sort(key=lambda x: (x[0][0] == 0,) + x[:2])
+    sizes = [x[4] for x in library]
+    lineages = [x[0] for x in library]
+    total = sum(sizes)
+    num_shards = args.num_shards or 1
+    if max_size:
+        # shards may grow by 2 * slack through the cuts
+        num_shards = max(num_shards, -(-int(total * (1 + 2 * args.slack)) // max_size))
+    cuts = plan_shards(sizes, lineages, num_shards, args.slack)
+
+    outdir = args.str_out or os.path.join(args.str_kraken, 'shards')
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+    # remove the shards of a previous plan
+    for fname in glob.glob(os.path.join(outdir, 'shard_*.txt')) + glob.glob(os.path.join(outdir, 'shard_*.map')) + glob.glob(os.path.join(outdir, 'shard_*', '*')):
+        os.remove(fname)
+    for dirname in glob.glob(os.path.join(outdir, 'shard_*' + os.sep)):
+        os.rmdir(dirname)
+    planfile = open(os.path.join(outdir, 'plan.txt'), 'w')
+    planfile.write('#shard\tassembly\taccession\ttaxid\tsize\n')
+    for k in range(len(cuts) - 1):
+        shard = 'shard_%04i' % (k + 1)
+        members = library[cuts[k]:cuts[k + 1]]
+        manifest = open(os.path.join(outdir, shard + '.txt'), 'w')
+        for lineage, accession, filepath, job, size, mappath in members:
+            manifest.write('%s\n' % os.path.abspath(filepath))
+            planfile.write('%s\t%s\t%s\t%s\t%i\n' % (shard, os.path.basename(filepath), accession, job[0], size))
+        manifest.close()
+        mappaths = [x[5] for x in members if x[5]]
+        if mappaths:
+            write_map(os.path.join(outdir, shard + '.map'), mappaths)
+        if args.link:
+            sharddir = os.path.join(outdir, shard)
+            if not os.path.exists(sharddir):
+                os.makedirs(sharddir)
+            for lineage, accession, filepath, job, size, mappath in members:
+                # -m libraries hold links to the original files
+                getKrakenFna.link_file(os.path.realpath(filepath), os.path.join(sharddir, os.path.basename(filepath)))
+            if mappaths:
+                write_map(os.path.join(sharddir, getKrakenFna.MAP_FNAME), mappaths)
+
+        # the common ancestor of a range in depth-first order is the one of its ends
+        depth = common_prefix(members[0][0], members[-1][0])
+        if depth and members[0][0][0] != 0:
+            clade = members[0][0][depth - 1]
+            clade = '%i (%s)' % (clade, oNodes.get_rank(clade))
+        else:
+            clade = 'n/a'
+        shard_size = sum([x[4] for x in members])
+        sys.stdout.write('%s\t%i assemblies\t%s\tclade %s\n' % (shard, len(members), format_size(shard_size), clade))
+        if max_size and shard_size > max_size:
+            sys.stderr.write('WARNING: %s is larger than %s\n' % (shard, args.str_max_size))
+    planfile.close()
+    return
+
+
+if __name__ == '__main__':
+    sys.exit(main())
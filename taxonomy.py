@@ -0,0 +1,404 @@
+#!/usr/bin/env python2
+"""
+NAME: taxonomy.py
+=========
+
+DESCRIPTION
+===========
+Fast access to the NCBI taxonomy dump files (names.dmp, nodes.dmp) used by
+the Kraken database.
+
+names.dmp is converted once into a compact binary cache next to it
+(names.dmp.cache): per name type a sorted array of taxids and an array of
+offsets into a blob of names. The cache is memory-mapped on load, so
+repeated invocations start in milliseconds and concurrent jobs share the
+same pages. It is rebuilt automatically when names.dmp changes (size or
+mtime).
+
+nodes.dmp is loaded into arrays indexed by taxid (parent taxid and rank),
+likewise cached in binary form (nodes.dmp.cache). Lineages are memoized per
+taxid, so walking the tree for many reads stays linear.
+
+VERSION HISTORY
+===============
+
+0.0.1   2026/10/18    Initial version.
+
+LICENCE
+=======
+2016, copyright Sebastian Schmeier (s.schmeier@gmail.com), sschmeier.com
+
+template version: 1.6 (2016/11/09)
+"""
+from array import array
+import sys
+import os
+import os.path
+import mmap
+import struct
+
+
+__version__ = '0.0.1'
+__date__ = '2026/10/18'
+__email__ = 's.schmeier@gmail.com'
+__author__ = 'Sebastian Schmeier'
+
+
+NAMES_MAGIC = b'NAMESDMP\x01'
+NODES_MAGIC = b'NODESDMP\x01'
+# array typecode of an unsigned 64bit integer ('Q' is not available in python2)
+try:
+    array('Q')
+    UINT64 = 'Q'
+except ValueError:
+    UINT64 = 'L'
+# order in which name types are tried for the best name of a taxon
+NAME_TYPES = ['scientific_name',
+              'authority',
+              'synonym',
+              'type_material',
+              'genbank_common_name',
+              'equivalent_name',
+              'genbank_synonym',
+              'blast_name']
+
+
+def _to_bytes(text):
+    if isinstance(text, bytes):
+        return text
+    return text.encode('utf-8')
+
+
+def _to_str(data):
+    if isinstance(data, str):
+        return data
+    return data.decode('utf-8')
+
+
+def _array_bytes(arr):
+    """ Little-endian bytes of an array. """
+    if sys.byteorder != 'little':
+        arr.byteswap()
+    if hasattr(arr, 'tobytes'):
+        return arr.tobytes()
+    return arr.tostring()
+
+
+def _source_stamp(filename):
+    stat = os.stat(filename)
+    return stat.st_size, int(stat.st_mtime)
+
+
+def parse_names(filename):
+    """
+    Parse names.dmp.
+    return {name_type: {taxid: [name, ...]}}
+    """
+    dict_tax = {}
+    infile = open(filename, 'rb')
+    for line in infile:
+        a = line.rstrip(b'\t|\r\n').split(b'\t|\t')
+        name_type = _to_str(a[3]).replace(' ', '_')
+        if name_type not in dict_tax:
+            dict_tax[name_type] = {}
+        taxnames = dict_tax[name_type]
+        tax = int(a[0])
+        if tax in taxnames:
+            taxnames[tax].append(a[1])
+        else:
+            taxnames[tax] = [a[1]]
+    infile.close()
+    return dict_tax
+
+
+def build_names_cache(filename):
+    """
+    Serialise names.dmp into the binary cache layout.
+
+    layout: magic, (source size, source mtime, number of name types),
+    per type (name, number of taxa, offset taxids, offset name offsets),
+    blob offset, then the sections. Taxids are sorted uint32, name offsets
+    are uint64 (n+1 entries) into the blob. Synonyms of a taxon are stored
+    joined by '|'.
+    return bytes
+    """
+    size, mtime = _source_stamp(filename)
+    dict_tax = parse_names(filename)
+    name_types = sorted(dict_tax)
+
+    header_len = len(NAMES_MAGIC) + struct.calcsize('<qqI')
+    for name_type in name_types:
+        header_len += struct.calcsize('<H') + len(_to_bytes(name_type)) + struct.calcsize('<QQQ')
+    header_len += struct.calcsize('<Q')
+
+    header = [NAMES_MAGIC, struct.pack('<qqI', size, mtime, len(name_types))]
+    sections = []
+    blob = []
+    blob_len = 0
+    offset = header_len
+    for name_type in name_types:
+        taxnames = dict_tax[name_type]
+        taxids = array('I', sorted(taxnames))
+        offsets = array(UINT64, [blob_len])
+        for tax in taxids:
+            names = b'|'.join(taxnames[tax])
+            blob.append(names)
+            blob_len += len(names)
+            offsets.append(blob_len)
+        bname = _to_bytes(name_type)
+        header.append(struct.pack('<H', len(bname)) + bname +
+                      struct.pack('<QQQ', len(taxids), offset, offset + 4 * len(taxids)))
+        sections.append(_array_bytes(taxids))
+        sections.append(_array_bytes(offsets))
+        offset += 4 * len(taxids) + 8 * len(offsets)
+    header.append(struct.pack('<Q', offset))
+    return b''.join(header + sections + blob)
+
+
+class NamesCache(object):
+    """
+    Read-only name lookup on the (memory-mapped) binary cache of names.dmp.
+    The cache is (re)built on first use or when names.dmp changed. If the
+    cache can not be written next to names.dmp it is kept in memory.
+    """
+    def __init__(self, filename, name_types=NAME_TYPES):
+        self.filename = filename
+        self.name_types = name_types
+        self.cachename = filename + '.cache'
+        self.buf = self._load()
+        self.toc = {}
+        self.best = {}  # memoized best names
+
+        pos = len(NAMES_MAGIC) + struct.calcsize('<qqI')
+        num_types = struct.unpack_from('<qqI', self.buf, len(NAMES_MAGIC))[2]
+        for i in range(num_types):
+            name_len = struct.unpack_from('<H', self.buf, pos)[0]
+            pos += 2
+            name_type = _to_str(self.buf[pos:pos + name_len])
+            pos += name_len
+            self.toc[name_type] = struct.unpack_from('<QQQ', self.buf, pos)
+            pos += struct.calcsize('<QQQ')
+        self.blob_offset = struct.unpack_from('<Q', self.buf, pos)[0]
+
+    def _is_current(self):
+        if not os.path.isfile(self.cachename):
+            return False
+        infile = open(self.cachename, 'rb')
+        header = infile.read(len(NAMES_MAGIC) + struct.calcsize('<qqI'))
+        infile.close()
+        if not header.startswith(NAMES_MAGIC):
+            return False
+        size, mtime, num_types = struct.unpack_from('<qqI', header, len(NAMES_MAGIC))
+        return (size, mtime) == _source_stamp(self.filename)
+
+    def _load(self):
+        if not self._is_current():
+            data = build_names_cache(self.filename)
+            tmpname = '%s.%i.tmp' % (self.cachename, os.getpid())
+            try:
+                outfile = open(tmpname, 'wb')
+                outfile.write(data)
+                outfile.close()
+                os.rename(tmpname, self.cachename)
+            except (IOError, OSError):
+                sys.stderr.write('Could not write %s, names are kept in memory.\n' % self.cachename)
+                if os.path.isfile(tmpname):
+                    os.remove(tmpname)
+                return data
+        infile = open(self.cachename, 'rb')
+        buf = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+        infile.close()
+        return buf
+
+    def names(self, name_type, tax):
+        """ Names of type name_type of a taxid joined by '|', or None. """
+        if name_type not in self.toc:
+            return None
+        num, taxids_offset, offsets_offset = self.toc[name_type]
+        buf = self.buf
+        lo = 0
+        hi = num
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if struct.unpack_from('<I', buf, taxids_offset + 4 * mid)[0] < tax:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == num or struct.unpack_from('<I', buf, taxids_offset + 4 * lo)[0] != tax:
+            return None
+        start, end = struct.unpack_from('<QQ', buf, offsets_offset + 8 * lo)
+        return _to_str(buf[self.blob_offset + start:self.blob_offset + end])
+
+    def best_name(self, tax):
+        """
+        First available name of a taxid in the order of self.name_types,
+        formatted as name_type:name1|name2, or '' if there is none.
+        """
+        if tax in self.best:
+            return self.best[tax]
+        name = ''
+        for name_type in self.name_types:
+            names = self.names(name_type, tax)
+            if names is not None:
+                name = '%s:%s' % (name_type, names)
+                break
+        self.best[tax] = name
+        return name
+
+
+def parse_nodes(filename):
+    """
+    Parse nodes.dmp into arrays indexed by taxid.
+    return (parent array, rank-index array, list of rank names)
+    """
+    parents = {}
+    ranks = {}
+    rank_names = []
+    rank_index = {}
+    infile = open(filename, 'rb')
+    for line in infile:
+        a = line.split(b'\t|\t', 3)
+        rank = _to_str(a[2])
+        if rank not in rank_index:
+            rank_index[rank] = len(rank_names)
+            rank_names.append(rank)
+        tax = int(a[0])
+        parents[tax] = int(a[1])
+        ranks[tax] = rank_index[rank]
+    infile.close()
+
+    size = max(parents) + 1 if parents else 1
+    parent = array('I', [0]) * size
+    rank = array('B', [0]) * size
+    for tax in parents:
+        parent[tax] = parents[tax]
+        rank[tax] = ranks[tax]
+    return parent, rank, rank_names
+
+
+class NodesTable(object):
+    """
+    Array-backed parent/rank table of nodes.dmp. Taxids not in nodes.dmp have
+    parent 0. The arrays are cached in nodes.dmp.cache and reloaded from there
+    while nodes.dmp is unchanged.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.cachename = filename + '.cache'
+        self.parent, self.rank_of, self.rank_names = self._load()
+        self.rank_index = dict([(rank, i) for i, rank in enumerate(self.rank_names)])
+        self.lineages = {}  # memoized lineages
+        self.children = None  # parent => children, built on first use
+
+    def _load(self):
+        size, mtime = _source_stamp(self.filename)
+        header_fmt = '<qqII'
+        if os.path.isfile(self.cachename):
+            infile = open(self.cachename, 'rb')
+            header = infile.read(len(NODES_MAGIC) + struct.calcsize(header_fmt))
+            if header.startswith(NODES_MAGIC):
+                c_size, c_mtime, num, ranks_len = struct.unpack_from(header_fmt, header, len(NODES_MAGIC))
+                if (c_size, c_mtime) == (size, mtime):
+                    rank_names = _to_str(infile.read(ranks_len)).split('\t')
+                    parent = array('I')
+                    parent.fromfile(infile, num)
+                    rank = array('B')
+                    rank.fromfile(infile, num)
+                    infile.close()
+                    if sys.byteorder != 'little':
+                        parent.byteswap()
+                    return parent, rank, rank_names
+            infile.close()
+
+        parent, rank, rank_names = parse_nodes(self.filename)
+        ranks = _to_bytes('\t'.join(rank_names))
+        tmpname = '%s.%i.tmp' % (self.cachename, os.getpid())
+        try:
+            outfile = open(tmpname, 'wb')
+            outfile.write(NODES_MAGIC + struct.pack(header_fmt, size, mtime, len(parent), len(ranks)))
+            outfile.write(ranks)
+            outfile.write(_array_bytes(array('I', parent)))
+            outfile.write(_array_bytes(rank))
+            outfile.close()
+            os.rename(tmpname, self.cachename)
+        except (IOError, OSError):
+            sys.stderr.write('Could not write %s.\n' % self.cachename)
+            if os.path.isfile(tmpname):
+                os.remove(tmpname)
+        return parent, rank, rank_names
+
+    def __contains__(self, tax):
+        return 0 < tax < len(self.parent) and self.parent[tax] != 0
+
+    def get_parent(self, tax):
+        """ Parent taxid, or 0 for unknown taxids. """
+        if tax in self:
+            return self.parent[tax]
+        return 0
+
+    def get_rank(self, tax):
+        """ Rank name of a taxid, or None for unknown taxids. """
+        if tax in self:
+            return self.rank_names[self.rank_of[tax]]
+        return None
+
+    def lineage(self, tax):
+        """
+        Taxids from the root down to tax, () for unknown taxids.
+        Lineages are memoized, so each node of the tree is walked only once.
+        """
+        if tax in self.lineages:
+            return self.lineages[tax]
+        # walk up until a memoized lineage or the root is reached
+        path = []
+        node = tax
+        while node in self and node not in self.lineages:
+            path.append(node)
+            parent = self.parent[node]
+            if parent == node:
+                break
+            node = parent
+        lineage = self.lineages.get(node, ())
+        for node in reversed(path):
+            lineage = lineage + (node,)
+            self.lineages[node] = lineage
+        if tax not in self.lineages:
+            self.lineages[tax] = ()
+        return self.lineages[tax]
+
+    def descendants(self, tax):
+        """
+        All tax-ids below tax (not including tax itself). The child index
+        is built on first use.
+        """
+        if self.children is None:
+            self.children = {}
+            parent = self.parent
+            for node in range(1, len(parent)):
+                if parent[node] != 0 and parent[node] != node:
+                    self.children.setdefault(parent[node], []).append(node)
+        result = []
+        stack = list(self.children.get(tax, []))
+        while stack:
+            node = stack.pop()
+            result.append(node)
+            stack += self.children.get(node, [])
+        return result
+
+    def clade(self, taxa):
+        """ Set of the tax-ids of taxa and of all tax-ids below them. """
+        result = set()
+        for tax in taxa:
+            result.add(tax)
+            result.update(self.descendants(tax))
+        return result
+
+    def at_rank(self, tax, rank):
+        """ Ancestor of tax (or tax itself) at the given rank, or None. """
+        if rank not in self.rank_index:
+            return None
+        rank_idx = self.rank_index[rank]
+        for node in self.lineage(tax):
+            if self.rank_of[node] == rank_idx:
+                return node
+        return None
@@ -0,0 +1,62 @@
+"""
+Tests of findKrakenFnaByTax.py, run from the repository directory with
+
+    python -m unittest discover tests
+"""
+import csv
+import gzip
+import bz2
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import findKrakenFnaByTax
+
+
+TAXA = b'562\n1280\textra\n\n562\n'
+
+
+class LoadFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def read_rows(self, filename):
+        filehandle = findKrakenFnaByTax.load_file(filename)
+        rows = [row for row in csv.reader(filehandle, delimiter='\t')]
+        if hasattr(filehandle, 'close'):
+            filehandle.close()
+        return rows
+
+    def test_gzip(self):
+        filename = os.path.join(self.tmpdir, 'taxa.txt.gz')
+        outfile = gzip.open(filename, 'wb')
+        outfile.write(TAXA)
+        outfile.close()
+        self.assertEqual(self.read_rows(filename), [['562'], ['1280', 'extra'], [], ['562']])
+
+    def test_bz2(self):
+        filename = os.path.join(self.tmpdir, 'taxa.txt.bz2')
+        outfile = bz2.BZ2File(filename, 'wb')
+        outfile.write(TAXA)
+        outfile.close()
+        self.assertEqual(self.read_rows(filename), [['562'], ['1280', 'extra'], [], ['562']])
+
+    def test_plain(self):
+        filename = os.path.join(self.tmpdir, 'taxa.txt')
+        outfile = open(filename, 'wb')
+        outfile.write(TAXA)
+        outfile.close()
+        self.assertEqual(self.read_rows(filename), [['562'], ['1280', 'extra'], [], ['562']])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,472 @@
+#!/usr/bin/env python2
+"""
+NAME: transport.py
+=========
+
+DESCRIPTION
+===========
+Transports used by getRefseqGenomic.py to fetch files from the ncbi
+ftp-server (or a mirror of it).
+
+Backends:
+rsync   one rsync call per file, or one rsync session per batch of files
+        (--files-from). Incomplete files are kept in PARTIAL_DIR, never under
+        their final name, and the files a session completed are taken from
+        its itemized output. The base url can also be a local mirror
+        directory.
+https   plain http(s) requests. Each download thread keeps its connection to
+        a host open and reuses it for all its files (keep-alive). Files are
+        downloaded to <name>.part, partial downloads are resumed with Range
+        requests (If-Range) and new files are verified against the
+        md5checksums.txt of their assembly directory before they are moved
+        into place. The validators the server sent for a file (Last-Modified,
+        ETag, size) are kept in <name>.headers: a local file is only checked
+        for changes upstream (If-None-Match, If-Modified-Since) while its size
+        and mtime match them, otherwise it is downloaded again.
+
+The ftp_path of an assembly (ftp://ftp.ncbi.nlm.nih.gov/genomes/all/...) is
+mapped onto a transport by replacing its scheme and host with the base url.
+
+VERSION HISTORY
+===============
+
+0.0.1   2026/10/18    Initial version.
+
+LICENCE
+=======
+2016, copyright Sebastian Schmeier (s.schmeier@gmail.com), sschmeier.com
+
+template version: 1.6 (2016/11/09)
+"""
+import sys
+import os
+import os.path
+import errno
+import shutil
+import socket
+import subprocess
+import tempfile
+import threading
+from email.utils import parsedate_tz, mktime_tz
+
+try:
+    import httplib  # python2
+    from urlparse import urlsplit
+except ImportError:
+    import http.client as httplib  # python3
+    from urllib.parse import urlsplit
+import manifest
+
+
+__version__ = '0.0.1'
+__date__ = '2026/10/18'
+__email__ = 's.schmeier@gmail.com'
+__author__ = 'Sebastian Schmeier'
+
+
+TRANSPORTS = ['rsync', 'https']
+DEFAULT_BASE_URLS = {'rsync': 'rsync://ftp.ncbi.nlm.nih.gov',
+                     'https': 'https://ftp.ncbi.nlm.nih.gov'}
+BLOCKSIZE = 1 << 20
+MD5_FNAME = 'md5checksums.txt'
+# suffix of the file with the validators of a https download
+HEADERS_EXT = '.headers'
+# directory (within the destination) of the incomplete files of rsync
+PARTIAL_DIR = '.rsync-partial'
+# common rsync exit codes
+RSYNC_ERRORS = {5: 'error starting client-server protocol',
+                10: 'error in socket I/O',
+                12: 'error in rsync protocol data stream',
+                23: 'partial transfer due to error',
+                24: 'partial transfer due to vanished source files',
+                30: 'timeout in data send/receive',
+                35: 'timeout waiting for daemon connection'}
+
+
+def server_path(url):
+    """ Path of a url on its server, e.g. /genomes/all/GCF/... """
+    if '://' not in url:
+        return url
+    parts = urlsplit(url)
+    return parts.path
+
+
+def parse_md5sums(text):
+    """ Parse the text of a md5checksums.txt, return {filename: md5}. """
+    d = {}
+    for line in text.splitlines():
+        a = line.split()
+        if len(a) == 2:
+            d[os.path.basename(a[1])] = a[0].lower()
+    return d
+
+
+def http_mtime(date):
+    """ Timestamp of an http date, None if it can not be parsed. """
+    if date and parsedate_tz(date):
+        return mktime_tz(parsedate_tz(date))
+    return None
+
+
+def response_validators(res):
+    """
+    Validators of a response: {'last_modified', 'etag', 'size'}, size is the
+    size of the whole file (None if unknown).
+    """
+    size = None
+    content_range = res.getheader('Content-Range')
+    if content_range:
+        total = content_range.rsplit('/', 1)[-1].strip()
+        if total.isdigit():
+            size = int(total)
+    elif res.status == 200 and (res.getheader('Content-Length') or '').isdigit():
+        size = int(res.getheader('Content-Length'))
+    return {'last_modified': res.getheader('Last-Modified') or '',
+            'etag': res.getheader('ETag') or '',
+            'size': size}
+
+
+def load_validators(filepath):
+    """
+    Validators of a downloaded file from <filepath>.headers.
+    return dict as response_validators(), None if there are none
+    """
+    try:
+        infile = open(filepath + HEADERS_EXT)
+        a = infile.read().rstrip('\n').split('\t')
+        infile.close()
+    except (IOError, OSError):
+        return None
+    if len(a) != 3 or not a[2].isdigit():
+        return None
+    return {'last_modified': a[0], 'etag': a[1], 'size': int(a[2])}
+
+
+def write_validators(filepath, validators):
+    """ Keep the validators of a download in <filepath>.headers. """
+    outfile = open(filepath + HEADERS_EXT, 'w')
+    outfile.write('%s\t%s\t%s\n' % (validators['last_modified'],
+                                     validators['etag'],
+                                     '' if validators['size'] is None else validators['size']))
+    outfile.close()
+
+
+def remove_download(filepath):
+    """ Remove a (partial) download and its validators. """
+    for name in [filepath, filepath + HEADERS_EXT]:
+        if os.path.isfile(name):
+            os.remove(name)
+
+
+def makedirs(dirname):
+    """ Create dirname and its parents, if missing. """
+    try:
+        os.makedirs(dirname)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+class RsyncTransport(object):
+    """ Fetch files with rsync. """
+    name = 'rsync'
+
+    def __init__(self, base_url=None):
+        if base_url is None:
+            base_url = DEFAULT_BASE_URLS['rsync']
+        self.base_url = base_url.rstrip('/')
+
+    def url(self, path):
+        """ Url of path (an ftp-url or server path) on this transport. """
+        return '%s/%s' % (self.base_url, server_path(path).lstrip('/'))
+
+    def describe(self, retcode):
+        """ Failure reason of a retcode. """
+        return 'rsync exit code %i: %s' % (retcode, RSYNC_ERRORS.get(retcode, 'error'))
+
+    def retryable(self, retcode):
+        """ Whether a failure with retcode may succeed when retried. """
+        return retcode != 0
+
+    def fetch(self, url, dest_dir, verify=True):
+        """
+        Fetch one file into dest_dir. rsync checks the transferred data
+        itself, verify is ignored.
+        return retcode, 0 on success
+        """
+        makedirs(dest_dir)
+        rsync_cmd = ['rsync', '--times', '--copy-links', '--partial-dir=%s' % PARTIAL_DIR,
+                     '-aq', url, dest_dir]
+        return subprocess.call(rsync_cmd)
+
+    def fetch_many(self, prefix, paths, dest_dir, verify=True):
+        """
+        Fetch files with one rsync session. paths are relative to prefix,
+        the files are flattened into dest_dir. If the session did not finish
+        cleanly, only the files rsync itemized as transferred or up to date
+        count as done, all others get the retcode of the session.
+        return [retcode, ...] per path
+        """
+        makedirs(dest_dir)
+        fd, listname = tempfile.mkstemp(prefix='rsync-files.', suffix='.txt')
+        listfile = os.fdopen(fd, 'w')
+        for path in paths:
+            listfile.write('%s\n' % path)
+        listfile.close()
+
+        # -ii itemizes unchanged files as well, %b logs a file only once its
+        # transfer completed
+        rsync_cmd = ['rsync', '--times', '--copy-links', '--partial-dir=%s' % PARTIAL_DIR,
+                     '-a', '-ii', '--no-motd', '--out-format=%i %b %n',
+                     '--no-relative', '--files-from=%s' % listname,
+                     prefix, dest_dir]
+        proc = subprocess.Popen(rsync_cmd, stdout=subprocess.PIPE)
+        output = proc.communicate()[0]
+        retcode = proc.returncode
+        os.remove(listname)
+        if retcode == 0:
+            return [0] * len(paths)
+
+        done = set()
+        for line in output.decode('utf-8', 'replace').splitlines():
+            a = line.split(None, 2)
+            if len(a) == 3 and a[0][1:2] == 'f':
+                done.add(os.path.basename(a[2]))
+        return [0 if os.path.basename(path) in done else retcode for path in paths]
+
+    def fetch_md5sums_many(self, prefix, dirpaths):
+        """
+        Fetch and parse the md5checksums.txt of directories (relative to
+        prefix) with one rsync session.
+        return [{filename: md5}, ...] per directory, empty if there is none,
+        None if the transfer failed.
+        """
+        tmpdir = tempfile.mkdtemp(prefix='md5sums.')
+        try:
+            listname = os.path.join(tmpdir, 'files.txt')
+            listfile = open(listname, 'w')
+            for dirpath in dirpaths:
+                listfile.write('%s/%s\n' % (dirpath.strip('/'), MD5_FNAME))
+            listfile.close()
+            # the files keep their directories below tmpdir/md5
+            rsync_cmd = ['rsync', '--times', '--copy-links', '--partial-dir=%s' % PARTIAL_DIR,
+                         '-aq', '--no-motd', '--files-from=%s' % listname,
+                         prefix, os.path.join(tmpdir, 'md5')]
+            retcode = subprocess.call(rsync_cmd)
+            results = []
+            for dirpath in dirpaths:
+                filepath = os.path.join(tmpdir, 'md5', dirpath.strip('/'), MD5_FNAME)
+                if os.path.isfile(filepath):
+                    results.append(parse_md5sums(open(filepath).read()))
+                elif retcode in (0, 23):  # no such file
+                    results.append({})
+                else:
+                    results.append(None)
+            return results
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+class HttpsTransport(object):
+    """ Fetch files with http(s) requests over keep-alive connections. """
+    name = 'https'
+
+    def __init__(self, base_url=None, timeout=60):
+        if base_url is None:
+            base_url = DEFAULT_BASE_URLS['https']
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.local = threading.local()  # connections of the current thread
+
+    def url(self, path):
+        """ Url of path (an ftp-url or server path) on this transport. """
+        return '%s/%s' % (self.base_url, server_path(path).lstrip('/'))
+
+    def describe(self, retcode):
+        """ Failure reason of a retcode. """
+        if retcode >= 100:
+            return 'HTTP %i' % retcode
+        return 'connection error or md5 mismatch'
+
+    def retryable(self, retcode):
+        """
+        Whether a failure with retcode may succeed when retried: client
+        errors (4xx) are permanent, except for timeouts and rate limits.
+        """
+        if retcode == 0:
+            return False
+        return not (400 <= retcode < 500) or retcode in (408, 429)
+
+    def _connection(self, scheme, netloc):
+        conns = getattr(self.local, 'conns', None)
+        if conns is None:
+            conns = self.local.conns = {}
+        key = (scheme, netloc)
+        if key not in conns:
+            if scheme == 'https':
+                conns[key] = httplib.HTTPSConnection(netloc, timeout=self.timeout)
+            else:
+                conns[key] = httplib.HTTPConnection(netloc, timeout=self.timeout)
+        return conns[key]
+
+    def request(self, url, headers=None):
+        """
+        GET url on the connection of this thread. A connection the server has
+        closed in the meantime is re-opened once.
+        return response, its body has to be read before the next request
+        """
+        parts = urlsplit(url)
+        path = parts.path
+        if parts.query:
+            path = '%s?%s' % (path, parts.query)
+        conn = self._connection(parts.scheme, parts.netloc)
+        for attempt in range(2):
+            try:
+                conn.request('GET', path, headers=headers or {})
+                return conn.getresponse()
+            except (httplib.HTTPException, socket.error):
+                conn.close()
+                if attempt == 1:
+                    raise
+
+    def md5sums(self, dirurl):
+        """
+        Parse md5checksums.txt of a directory.
+        return {filename: md5}, empty if there is none.
+        """
+        res = self.request('%s/%s' % (dirurl, MD5_FNAME))
+        data = res.read()
+        if res.status != 200:
+            return {}
+        return parse_md5sums(data.decode('ascii', 'replace'))
+
+    def fetch_md5sums(self, dirurl):
+        """
+        As md5sums, but None if the request failed.
+        """
+        try:
+            return self.md5sums(dirurl)
+        except (httplib.HTTPException, socket.error, IOError, OSError) as e:
+            sys.stderr.write('ERROR: %s: %s\n' % (dirurl, e))
+            return None
+
+    def fetch_md5sums_many(self, prefix, dirpaths):
+        """
+        As fetch_md5sums for directories relative to prefix, one after the
+        other over the connection of this thread.
+        return [{filename: md5}, ...] per directory
+        """
+        return [self.fetch_md5sums(prefix + dirpath.strip('/')) for dirpath in dirpaths]
+
+    def fetch(self, url, dest_dir, verify=True):
+        """
+        Fetch one file into dest_dir.
+        return retcode, 0 on success, else the http status or 1.
+        """
+        try:
+            return self._fetch(url, dest_dir, verify)
+        except (httplib.HTTPException, socket.error, IOError, OSError) as e:
+            sys.stderr.write('ERROR: %s: %s\n' % (url, e))
+            return 1
+
+    def _fetch(self, url, dest_dir, verify):
+        makedirs(dest_dir)
+        name = url.rstrip('/').split('/')[-1]
+        filepath = os.path.join(dest_dir, name)
+        partpath = filepath + '.part'
+
+        headers = {}
+        validators = load_validators(filepath)
+        part = load_validators(partpath)
+        if os.path.isfile(filepath) and validators is not None \
+           and os.path.getsize(filepath) == validators['size'] \
+           and http_mtime(validators['last_modified']) in (None, int(os.path.getmtime(filepath))) \
+           and (validators['etag'] or validators['last_modified']):
+            # the local file is the one the server sent: ask for changes
+            if validators['etag']:
+                headers['If-None-Match'] = validators['etag']
+            if validators['last_modified']:
+                headers['If-Modified-Since'] = validators['last_modified']
+        elif os.path.isfile(partpath) and part is not None:
+            # resume, unless the file changed since (weak ETags can not be used)
+            etag = part['etag']
+            if etag.startswith('W/'):
+                etag = ''
+            if etag or part['last_modified']:
+                headers['Range'] = 'bytes=%i-' % os.path.getsize(partpath)
+                headers['If-Range'] = etag or part['last_modified']
+
+        res = self.request(url, headers)
+        if res.status == 304:
+            res.read()
+            return 0
+        elif res.status == 416:
+            # nothing left to fetch: the .part is complete only if it has the size of the file
+            res.read()
+            size = response_validators(res)['size'] or (part or {}).get('size')
+            if part is None or os.path.getsize(partpath) != size:
+                remove_download(partpath)
+                sys.stderr.write('ERROR: %s: stale partial download removed\n' % url)
+                return 1
+            validators = part
+        elif res.status in (200, 206):
+            validators = response_validators(res)
+            if res.status == 206:
+                content_range = res.getheader('Content-Range') or ''
+                start = content_range.replace('bytes', '').strip().split('-')[0]
+                if part is None or start != str(os.path.getsize(partpath)):
+                    res.read()
+                    remove_download(partpath)
+                    sys.stderr.write('ERROR: %s: unexpected range %s\n' % (url, content_range))
+                    return 1
+                for key in ['last_modified', 'etag']:
+                    validators[key] = validators[key] or part[key]
+                outfile = open(partpath, 'ab')
+            else:
+                outfile = open(partpath, 'wb')
+            # written first, so that an interrupted download can be resumed
+            write_validators(partpath, validators)
+            block = res.read(BLOCKSIZE)
+            while block:
+                outfile.write(block)
+                block = res.read(BLOCKSIZE)
+            outfile.close()
+            if validators['size'] is not None and os.path.getsize(partpath) != validators['size']:
+                sys.stderr.write('ERROR: %s: incomplete download\n' % url)
+                return 1
+        else:
+            res.read()
+            sys.stderr.write('ERROR: %s: HTTP %i %s\n' % (url, res.status, res.reason))
+            return res.status
+
+        if verify:
+            md5 = self.md5sums(url[:url.rstrip('/').rfind('/')]).get(name, None)
+            if md5 is not None and md5 != manifest.file_md5(partpath):
+                remove_download(partpath)
+                sys.stderr.write('ERROR: %s: md5 mismatch\n' % url)
+                return 1
+
+        os.rename(partpath, filepath)
+        write_validators(filepath, validators)
+        remove_download(partpath)
+        mtime = http_mtime(validators['last_modified'])
+        if mtime is not None:
+            os.utime(filepath, (mtime, mtime))
+        return 0
+
+    def fetch_many(self, prefix, paths, dest_dir, verify=True):
+        """
+        Fetch files one after the other over the connection of this thread.
+        paths are relative to prefix, the files are flattened into dest_dir.
+        return [retcode, ...] per path
+        """
+        return [self.fetch(prefix + path, dest_dir, verify) for path in paths]
+
+
+def make_transport(name, base_url=None):
+    """ Create one of TRANSPORTS. """
+    if name == 'rsync':
+        return RsyncTransport(base_url)
+    elif name == 'https':
+        return HttpsTransport(base_url)
+    raise ValueError('unknown transport: %s' % name)